@@ -0,0 +1,596 @@
+"""
+Benchmarks for the workflow's Python code.
+
+Builds synthetic data directories in a temporary location and
+times the workflow's startup stages against them, e.g.:
+
+python benchmark_workflow.py discovery --runs 100 1000 10000
+python benchmark_workflow.py discovery --runs 1000 --latency-ms 2 --workers 16
+python benchmark_workflow.py dag --runs 100 1000 10000
+python benchmark_workflow.py stages --files 1000 --size-dist lognormal:4M:0.5 --output new.json
+python benchmark_workflow.py stages --files 1000 --size-dist lognormal:4M:0.5 --rerun --output rerun.json
+python benchmark_workflow.py compare old.json new.json
+"""
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import re
+import statistics
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from argparse import ArgumentParser
+
+import make_test_data
+
+WORKFLOW_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "workflow"
+)
+COMMON_SMK = os.path.join(WORKFLOW_DIR, "rules", "common.smk")
+SNAKEFILE = os.path.join(WORKFLOW_DIR, "Snakefile")
+CONFIG = os.path.join(WORKFLOW_DIR, "..", ".test", "config", "config.yaml")
+RESULTS_VERSION = 1
+
+PROJ_DIR_REGEX = r"^(\d{6,8})_([a-zA-Z0-9\-]+)_([a-zA-Z0-9\-]+)_([a-zA-Z0-9\-_]+)$"
+SAMPLES_PER_PROJECT = 5
+RUNS_PER_SAMPLE = 2
+
+
+def parse_args(args):
+    parser = ArgumentParser(description="Benchmark workflow stages.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    discovery = subparsers.add_parser(
+        "discovery", help="Snakefile run discovery with and without the index."
+    )
+    discovery.add_argument(
+        "--runs",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="Numbers of historical runs to benchmark.",
+    )
+    discovery.add_argument(
+        "--pending",
+        type=float,
+        default=0.05,
+        help="Fraction of runs that are pending archiving.",
+    )
+    discovery.add_argument(
+        "--latency-ms",
+        type=float,
+        default=0,
+        help="Latency added to each directory stat and listing, "
+        "as on a network filesystem.",
+    )
+    discovery.add_argument(
+        "--workers",
+        type=int,
+        default=16,
+        help="Discovery workers of the concurrent scans.",
+    )
+
+    dag = subparsers.add_parser(
+        "dag", help="Snakemake DAG build time and memory (requires snakemake)."
+    )
+    dag.add_argument(
+        "--runs",
+        type=int,
+        nargs="+",
+        default=[100, 1000, 10000],
+        help="Numbers of pending runs to benchmark.",
+    )
+    dag.add_argument(
+        "--snakemake", default="snakemake", help="Snakemake executable to use."
+    )
+
+    stages = subparsers.add_parser(
+        "stages",
+        help="Time of each workflow rule on one synthetic run (requires snakemake).",
+    )
+    add_data_arguments(stages)
+    stages.add_argument("--cores", type=int, default=4, help="Snakemake cores.")
+    stages.add_argument(
+        "--repeat", type=int, default=3, help="Number of runs; the median is reported."
+    )
+    stages.add_argument(
+        "--config",
+        nargs="+",
+        default=[],
+        help="Snakemake config overrides, e.g. shard_size=1G.",
+    )
+    stages.add_argument(
+        "--snakemake", default="snakemake", help="Snakemake executable to use."
+    )
+    stages.add_argument(
+        "--rerun",
+        action="store_true",
+        help="Time processing the run again (e.g. after its transfer directory "
+        "was removed) with the checksums cached by a first, untimed run.",
+    )
+    stages.add_argument("--output", help="JSON file to write the results to.")
+
+    compare = subparsers.add_parser(
+        "compare",
+        help="Compare two stages results (of either workflow or auto_archive).",
+    )
+    compare.add_argument("baseline", help="Results of the baseline version.")
+    compare.add_argument("results", help="Results of the version to check.")
+    compare.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Fraction a stage may slow down by before it is reported as a regression.",
+    )
+    compare.add_argument(
+        "--min-seconds",
+        type=float,
+        default=0.5,
+        help="Ignore differences smaller than this many seconds.",
+    )
+    return parser.parse_args(args)
+
+
+def add_data_arguments(parser):
+    """
+    Arguments describing the synthetic run (see make_test_data.py)
+    """
+    parser.add_argument(
+        "--files", type=int, default=1000, help="Number of files per data directory."
+    )
+    parser.add_argument(
+        "--size-dist",
+        default="lognormal:1M:0.5",
+        help="File size distribution, e.g. fixed:4M or lognormal:20M:0.5.",
+    )
+    parser.add_argument(
+        "--barcodes", type=int, default=0, help="Number of barcode directories."
+    )
+    parser.add_argument(
+        "--compressibility",
+        type=float,
+        default=0.0,
+        help="Fraction (0-1) by which the data can be compressed.",
+    )
+    parser.add_argument("--seed", type=int, default=1, help="Random seed.")
+
+
+def get_config(data_dir, **kwargs):
+    config = {
+        "data_dir": data_dir,
+        "transfer_dir": "_transfer",
+        "extra_dirs": [],
+        "ignore_dirs": [],
+        "file_types": ["reports", "fastq", "pod5", "fast5", "bam", "checksums"],
+        "proj_dir_regex": PROJ_DIR_REGEX,
+        "end_of_run_file_regex": r"^sequencing_summary\w*\.txt",
+        "ignore_proj_regex": False,
+        "check_if_complete": True,
+        "transfer": False,
+        "delete_on_transfer": False,
+        "threads": 1,
+        "discovery_index": "",
+    }
+    config.update(kwargs)
+    return config
+
+
+def make_synthetic_data_dir(data_dir, n_runs, pending_fraction):
+    """
+    Create n_runs finished runs, of which all but pending_fraction
+    have already been archived (i.e., have a file counts log).
+    """
+    n_pending = int(n_runs * pending_fraction)
+    for i in range(n_runs):
+        project = (
+            f"20230101_wehi_lab_proj{i // (SAMPLES_PER_PROJECT * RUNS_PER_SAMPLE):05d}"
+        )
+        sample = f"sample_{(i // RUNS_PER_SAMPLE) % SAMPLES_PER_PROJECT}"
+        run = f"20230101_1111_2F_PAK1234_{i:08x}"
+        run_dir = os.path.join(data_dir, project, sample, run)
+        for subdir in ["fastq_pass", "fastq_fail", "pod5", "other_reports"]:
+            os.makedirs(os.path.join(run_dir, subdir))
+        open(os.path.join(run_dir, "sequencing_summary_PAK1234.txt"), "w").close()
+        open(os.path.join(run_dir, "report_PAK1234.html"), "w").close()
+        if i >= n_pending:
+            logs_dir = os.path.join(
+                data_dir, project, f"_transfer_{sample}_{run}", "logs"
+            )
+            os.makedirs(logs_dir)
+            open(os.path.join(logs_dir, f"{project}_file_counts.txt"), "w").close()
+
+    # age the tree so that listings are not considered too recent to cache
+    past = time.time() - 3600
+    for dirpath, _, _ in os.walk(data_dir):
+        os.utime(dirpath, (past, past))
+
+
+def load_common(config):
+    """
+    Execute common.smk as the Snakefile does, returning its namespace.
+    """
+    namespace = {
+        "config": config,
+        "workflow": types.SimpleNamespace(basedir=WORKFLOW_DIR),
+    }
+    with open(COMMON_SMK) as f:
+        code = compile(f.read(), COMMON_SMK, "exec")
+    with contextlib.redirect_stdout(io.StringIO()):
+        exec(code, namespace)
+        namespace["get_outputs"](config["file_types"])
+    return namespace
+
+
+def timed_startup(config):
+    start = time.perf_counter()
+    namespace = load_common(config)
+    return time.perf_counter() - start, namespace
+
+
+class SlowMetadataOS:
+    """
+    Stands in for the os module of discovery_index, adding
+    latency seconds to each stat and directory listing
+    """
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+    def stat(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return os.stat(*args, **kwargs)
+
+    def scandir(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return os.scandir(*args, **kwargs)
+
+
+def get_discovered(namespace):
+    return [namespace[key] for key in ("projects", "samples", "runs", "runs_uid")]
+
+
+def benchmark_discovery(args):
+    sys.path.insert(0, os.path.join(WORKFLOW_DIR, "scripts"))
+    import discovery_index
+
+    if args.latency_ms:
+        discovery_index.os = SlowMetadataOS(args.latency_ms / 1000)
+    print(
+        f"{'runs':>8}{'pending':>9}{'no index (s)':>14}{'concurrent (s)':>16}"
+        f"{'cold (s)':>10}{'warm (s)':>10}"
+    )
+    for n_runs in args.runs:
+        tmp_dir = tempfile.mkdtemp(prefix="wf_bench_")
+        try:
+            data_dir = os.path.join(tmp_dir, "data")
+            make_synthetic_data_dir(data_dir, n_runs, args.pending)
+            index = os.path.join(tmp_dir, "index.sqlite")
+
+            # serial scan, then concurrent scans without and with the index
+            no_index, namespace = timed_startup(
+                get_config(data_dir, discovery_workers=1)
+            )
+            concurrent, concurrent_namespace = timed_startup(
+                get_config(data_dir, discovery_workers=args.workers)
+            )
+            if get_discovered(concurrent_namespace) != get_discovered(namespace):
+                raise RuntimeError("Concurrent discovery found different runs.")
+            cold, _ = timed_startup(
+                get_config(
+                    data_dir, discovery_index=index, discovery_workers=args.workers
+                )
+            )
+            warm, _ = timed_startup(
+                get_config(
+                    data_dir, discovery_index=index, discovery_workers=args.workers
+                )
+            )
+            print(
+                f"{n_runs:>8}{len(namespace['runs']):>9}{no_index:>14.3f}"
+                f"{concurrent:>16.3f}{cold:>10.3f}{warm:>10.3f}"
+            )
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def time_dry_run(snakemake, workdir, data_dir):
+    """
+    Run a snakemake dry-run, returning its wall time
+    in seconds and peak memory use in MB.
+    """
+    cmd = [
+        snakemake,
+        "--snakefile",
+        SNAKEFILE,
+        "--directory",
+        workdir,
+        "--cores",
+        "1",
+        "--dry-run",
+        "--quiet",
+        "--config",
+        f"data_dir={data_dir}",
+    ]
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    _, status, rusage = os.wait4(proc.pid, 0)
+    seconds = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(proc.stderr.read().decode())
+    return seconds, rusage.ru_maxrss / 1024
+
+
+def benchmark_dag(args):
+    print(f"{'runs':>8}{'dry-run (s)':>13}{'peak RSS (MB)':>15}")
+    for n_runs in args.runs:
+        tmp_dir = tempfile.mkdtemp(prefix="wf_bench_")
+        try:
+            data_dir = os.path.join(tmp_dir, "data")
+            make_synthetic_data_dir(data_dir, n_runs, pending_fraction=1)
+            os.makedirs(os.path.join(tmp_dir, "config"))
+            shutil.copy(CONFIG, os.path.join(tmp_dir, "config", "config.yaml"))
+
+            seconds, peak_mb = time_dry_run(args.snakemake, tmp_dir, data_dir)
+            print(f"{n_runs:>8}{seconds:>13.2f}{peak_mb:>15.0f}")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def make_synthetic_run(run_dir, args, subdirs):
+    """
+    Create one finished run from the data arguments,
+    returning its number of files and size in bytes
+    """
+    make_test_data.random.seed(args.seed)
+    flowcell, run_hex = os.path.basename(run_dir).split("_")[-2:]
+    make_test_data.make_run(
+        run_dir,
+        subdirs,
+        flowcell,
+        run_hex,
+        True,
+        n_files=args.files,
+        get_size=make_test_data.get_size_sampler(args.size_dist),
+        barcodes=args.barcodes,
+        compressibility=args.compressibility,
+    )
+    n_files, n_bytes = 0, 0
+    for dirpath, _, filenames in os.walk(run_dir):
+        for filename in filenames:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(dirpath, filename))
+    return n_files, n_bytes
+
+
+def get_version():
+    """
+    Returns the git version of the code being benchmarked, if known
+    """
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=WORKFLOW_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_job_counts(output):
+    """
+    Returns the number of jobs of each rule from the
+    "Job stats" table snakemake prints when it starts
+    """
+    match = re.search(r"Job stats:\n.*?\n-+\s+-+\n(.*?)\n\s*\n", output, re.DOTALL)
+    if not match:
+        return {}
+    counts = {}
+    for line in match.group(1).splitlines():
+        rule, count = line.split()
+        if rule != "total":
+            counts[rule] = int(count)
+    return counts
+
+
+def run_workflow(args, workdir, data_dir, config=()):
+    """
+    Run the workflow once (with config overrides added to
+    args.config), returning its wall time and the total
+    time of each rule's jobs in seconds
+    """
+    stats_file = os.path.join(workdir, "stats.json")
+    cmd = (
+        [
+            args.snakemake,
+            "--snakefile",
+            SNAKEFILE,
+            "--directory",
+            workdir,
+            "--cores",
+            str(args.cores),
+            "--stats",
+            stats_file,
+            "--config",
+            f"data_dir={data_dir}",
+            "extra_dirs=[]",
+        ]
+        + list(config)
+        + args.config
+    )
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr)
+
+    job_counts = parse_job_counts(proc.stderr)
+    with open(stats_file) as f:
+        stats = json.load(f)
+    stages = {}
+    for rule, rule_stats in stats["rules"].items():
+        if rule == "all":
+            continue
+        jobs = job_counts.get(rule, 1)
+        stages[rule] = {"jobs": jobs, "seconds": rule_stats["mean-runtime"] * jobs}
+    return seconds, stages
+
+
+def summarise_repeats(repeats):
+    """
+    Combine the stages of repeated runs, keeping the
+    median time (and the individual times) of each
+    """
+    stages = {}
+    for name in sorted({name for repeat in repeats for name in repeat}):
+        times = [repeat[name]["seconds"] for repeat in repeats if name in repeat]
+        stages[name] = {
+            "jobs": next(repeat[name]["jobs"] for repeat in repeats if name in repeat),
+            "seconds": statistics.median(times),
+            "repeats": times,
+        }
+    return stages
+
+
+def make_results(tool, args, n_files, n_bytes, wall_times, stages):
+    params = {k: v for k, v in vars(args).items() if k not in ["benchmark", "output"]}
+    for stage in stages.values():
+        if stage.get("bytes") and stage["seconds"]:
+            stage["mb_per_s"] = stage["bytes"] / 1e6 / stage["seconds"]
+    wall_seconds = statistics.median(wall_times)
+    return {
+        "results_version": RESULTS_VERSION,
+        "tool": tool,
+        "version": get_version(),
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": {
+            "name": platform.node(),
+            "cpus": os.cpu_count(),
+            "python": platform.python_version(),
+        },
+        "params": params,
+        "data": {"files": n_files, "bytes": n_bytes},
+        "wall_seconds": wall_seconds,
+        "mb_per_s": n_bytes / 1e6 / wall_seconds,
+        "stages": stages,
+    }
+
+
+def print_results(results):
+    print(
+        f"{results['data']['files']} files, {results['data']['bytes'] / 1e6:.1f} MB, "
+        f"{results['wall_seconds']:.2f} s ({results['mb_per_s']:.1f} MB/s)"
+    )
+    print(f"{'stage':<32}{'jobs':>6}{'seconds':>10}{'MB/s':>10}")
+    for name, stage in results["stages"].items():
+        mb_per_s = f"{stage['mb_per_s']:.1f}" if "mb_per_s" in stage else "-"
+        print(f"{name:<32}{stage['jobs']:>6}{stage['seconds']:>10.2f}{mb_per_s:>10}")
+
+
+def write_results(results, output):
+    print_results(results)
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=1)
+
+
+def benchmark_stages(args):
+    tmp_dir = tempfile.mkdtemp(prefix="wf_bench_")
+    try:
+        data_dir = os.path.join(tmp_dir, "data")
+        project_dir = os.path.join(data_dir, "20230101_wehi_lab_bench")
+        run_dir = os.path.join(
+            project_dir, "sample", "20230101_1111_2F_PAK1234_0bench0"
+        )
+        n_files, n_bytes = make_synthetic_run(
+            run_dir, args, ["pod5", "fastq_pass", "fastq_fail", "other_reports"]
+        )
+        os.makedirs(os.path.join(tmp_dir, "config"))
+        shutil.copy(CONFIG, os.path.join(tmp_dir, "config", "config.yaml"))
+
+        cache_dir = os.path.join(tmp_dir, "checksum_cache")
+        config = [f"checksum_cache_dir={cache_dir}"]
+
+        def reset():
+            for name in os.listdir(project_dir):
+                if name.startswith("_transfer"):
+                    shutil.rmtree(os.path.join(project_dir, name))
+            shutil.rmtree(os.path.join(tmp_dir, ".snakemake"), ignore_errors=True)
+            if not args.rerun:
+                shutil.rmtree(cache_dir, ignore_errors=True)
+
+        if args.rerun:
+            reset()
+            run_workflow(args, tmp_dir, data_dir, config)
+
+        wall_times, repeats = [], []
+        for _ in range(args.repeat):
+            reset()
+            seconds, stages = run_workflow(args, tmp_dir, data_dir, config)
+            wall_times.append(seconds)
+            repeats.append(stages)
+
+        results = make_results(
+            "workflow", args, n_files, n_bytes, wall_times, summarise_repeats(repeats)
+        )
+        write_results(results, args.output)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def compare_results(args):
+    """
+    Print the change in time of each stage, returning
+    1 if any stage has slowed down beyond the tolerance
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+    if baseline["params"] != results["params"]:
+        print("Warning: results were produced with different parameters.")
+
+    regressions = []
+    print(f"{'stage':<32}{'baseline (s)':>14}{'new (s)':>10}{'change':>9}")
+    rows = [("(wall)", baseline["wall_seconds"], results["wall_seconds"])]
+    for name in sorted(set(baseline["stages"]) | set(results["stages"])):
+        old = baseline["stages"].get(name, {}).get("seconds")
+        new = results["stages"].get(name, {}).get("seconds")
+        rows.append((name, old, new))
+    for name, old, new in rows:
+        if old is None or new is None:
+            print(f"{name:<32}{old or '-':>14}{new or '-':>10}")
+            continue
+        change = (new - old) / old if old else 0
+        flag = ""
+        if change > args.tolerance and new - old > args.min_seconds:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:<32}{old:>14.2f}{new:>10.2f}{change:>+9.0%}{flag}")
+    return 1 if regressions else 0
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    if args.benchmark == "discovery":
+        benchmark_discovery(args)
+    elif args.benchmark == "dag":
+        benchmark_dag(args)
+    elif args.benchmark == "stages":
+        benchmark_stages(args)
+    elif args.benchmark == "compare":
+        sys.exit(compare_results(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,221 @@
+"""
+Creates test data under test_data. By default every run gets a
+single empty file per data directory; the file count, size
+distribution, barcode layout and compressibility can be set to
+make realistic (large) runs, e.g.:
+
+python make_test_data.py --files 1000 --size-dist lognormal:20M:0.5 --barcodes 12
+"""
 import os
+import sys
+import math
 import random
 import shutil
+from argparse import ArgumentParser
+
+# extension of the files written to each data directory (keyed
+# by the directory's name up to any _pass/_fail/_skip suffix)
+FILE_EXTENSIONS = {"fastq": "fastq.gz", "pod5": "pod5", "fast5": "fast5", "bam": "bam"}
+
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+# data is written in chunks of this size, each compressible by
+# the requested fraction (a run of repeated fastq-like text),
+# the remainder being random bytes
+CHUNK_SIZE = 1024 * 1024
+REPEATED_TEXT = b"@read\nACGTACGTTGCAACGT\n+\nIIIIIIIIIIIIIIII\n"
+
 
 def get_random_hexstring(magnitude):
     return hex(round(random.random() * magnitude))[2:]
 
-def make_run(basedir, subdirs, flowcellid, runhex, is_finished):
+
+def parse_size(size):
+    size = size.strip().upper().rstrip("B")
+    if size[-1:] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def get_size_sampler(size_dist):
+    """
+    Returns a function drawing file sizes from a distribution
+    given as fixed:SIZE, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA
+    (sizes in bytes or with a K/M/G/T suffix)
+    """
+    kind, *values = size_dist.split(":")
+    if kind == "fixed" and len(values) == 1:
+        size = parse_size(values[0])
+        return lambda: size
+    if kind == "uniform" and len(values) == 2:
+        low, high = parse_size(values[0]), parse_size(values[1])
+        return lambda: random.randint(low, high)
+    if kind == "lognormal" and len(values) == 2:
+        mu, sigma = math.log(max(parse_size(values[0]), 1)), float(values[1])
+        return lambda: round(random.lognormvariate(mu, sigma))
+    raise ValueError(f"Invalid size distribution {size_dist}")
+
+
+def write_data(path, size, compressibility):
+    repeated = REPEATED_TEXT * (CHUNK_SIZE // len(REPEATED_TEXT) + 1)
+    with open(path, "wb") as fout:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, CHUNK_SIZE)
+            n_repeated = int(chunk * compressibility)
+            fout.write(repeated[:n_repeated])
+            fout.write(random.randbytes(chunk - n_repeated))
+            remaining -= chunk
+
+
+def get_data_dirs(subdir, barcodes):
+    """
+    Returns the directories files of a data directory are written
+    to: the directory itself, or, if barcoded, one directory per
+    barcode plus unclassified (pod5 is never split by barcode)
+    """
+    if not barcodes or subdir == "pod5":
+        return [subdir]
+    dirs = [os.path.join(subdir, f"barcode{i:02d}") for i in range(1, barcodes + 1)]
+    return dirs + [os.path.join(subdir, "unclassified")]
+
+
+def make_run(
+    basedir,
+    subdirs,
+    flowcellid,
+    runhex,
+    is_finished,
+    n_files=1,
+    get_size=lambda: 0,
+    barcodes=0,
+    compressibility=0.0,
+):
+    """
+    Make a run directory with n_files files under each of its data
+    directories (e.g. fastq_pass, pod5), plus the report files
+    """
     os.makedirs(basedir)
     for subdir in subdirs:
         os.makedirs(os.path.join(basedir, subdir))
     if is_finished:
-        sequencing_summary = f'sequencing_summary_{flowcellid}_{runhex}_{get_random_hexstring(1e8)}.txt'
+        sequencing_summary = (
+            f"sequencing_summary_{flowcellid}_{runhex}_{get_random_hexstring(1e8)}.txt"
+        )
         sequencing_summary = os.path.join(basedir, sequencing_summary)
-        open(sequencing_summary, 'a').close()
-    random_fastq_pass = os.path.join(basedir, 'fastq_pass', f'{get_random_hexstring(1e8)}.fastq.gz')
-    random_fastq_fail = os.path.join(basedir, 'fastq_fail', f'{get_random_hexstring(1e8)}.fastq.gz')
-    random_pod5 = os.path.join(basedir, 'pod5', f'{get_random_hexstring(1e8)}.pod5')
+        open(sequencing_summary, "a").close()
+    for subdir in subdirs:
+        file_type, _, state = subdir.partition("_")
+        if file_type not in FILE_EXTENSIONS:
+            continue
+        data_dirs = get_data_dirs(subdir, barcodes)
+        for data_dir in data_dirs:
+            os.makedirs(os.path.join(basedir, data_dir), exist_ok=True)
+        for i in range(n_files):
+            # named as MinKNOW does, e.g. PAK1234_pass_barcode01_7e194c_0.fastq.gz
+            data_dir = data_dirs[i % len(data_dirs)]
+            barcode = os.path.basename(data_dir) if data_dir != subdir else ""
+            name = "_".join(filter(None, [flowcellid, state, barcode, runhex, str(i)]))
+            write_data(
+                os.path.join(basedir, data_dir, f"{name}.{FILE_EXTENSIONS[file_type]}"),
+                get_size(),
+                compressibility,
+            )
     report_hexstring = get_random_hexstring(1e8)
-    random_report = os.path.join(basedir, f'report_{report_hexstring}.html')
-    random_json = os.path.join(basedir, f'report_{report_hexstring}.json')
-    open(random_fastq_pass, 'a').close()
-    open(random_fastq_fail, 'a').close()
-    open(random_pod5, 'a').close()
-    open(random_report, 'a').close()
-    open(random_json, 'a').close()
-
-### create test data ###
-
-# directories found under every promethION run
-subdirs = ['pod5', 'fastq_pass', 'fastq_fail', 'other_reports']
-
-# some example values
-date = '20221208'
-affiliation = 'wehi'
-lab = 'bowden'
-flowcellid = 'PAK1234'
-
-# specify runs and whether they have finished
-runs = {'runa': True, 'runb': True, 'runc': False}
-samples = ['sample_a', 'sample_b']
-
-# remake test directories
-#if os.path.exists('test_data'):
-#    shutil.rmtree('test_data')
-for run in runs:
-    for sample in samples:
-        runhex = get_random_hexstring(1e8)
-        basedir = f'test_data/{date}_{affiliation}_{lab}_{run}/{sample}/{date}_1111_2F_{flowcellid}_{runhex}'
-        make_run(basedir, subdirs, flowcellid, runhex, runs[run])
-
-        # make a second run
-        runhex = get_random_hexstring(1e8)
-        basedir = f'test_data/{date}_{affiliation}_{lab}_{run}/{sample}/{date}_1111_2F_{flowcellid}_{runhex}'
-        make_run(basedir, subdirs, flowcellid, runhex, runs[run])
-
-# make a test dirs that is meant to be ignored
-os.makedirs('test_data/TEST_a')
-
-# make a test dir that doesn't follow the pattern but still needs to be processed
-os.makedirs('test_data/TEST_b')
-runhex = get_random_hexstring(1e8)
-sample = samples[0]
-basedir = f'test_data/TEST_b/{sample}/{date}_1111_2F_{flowcellid}_{runhex}'
-make_run(basedir, subdirs, flowcellid, runhex, True)
+    random_report = os.path.join(basedir, f"report_{report_hexstring}.html")
+    random_json = os.path.join(basedir, f"report_{report_hexstring}.json")
+    open(random_report, "a").close()
+    open(random_json, "a").close()
+
+
+def parse_args(args):
+    parser = ArgumentParser(description="Create test data.")
+    parser.add_argument(
+        "--output", default="test_data", help="Directory to create the test data in."
+    )
+    parser.add_argument(
+        "--files",
+        type=int,
+        default=1,
+        help="Number of files per data directory of each run.",
+    )
+    parser.add_argument(
+        "--size-dist",
+        default="fixed:0",
+        help="File size distribution: fixed:SIZE, uniform:MIN:MAX "
+        "or lognormal:MEDIAN:SIGMA, e.g. lognormal:20M:0.5.",
+    )
+    parser.add_argument(
+        "--barcodes",
+        type=int,
+        default=0,
+        help="Split pass/fail directories into this many barcode directories.",
+    )
+    parser.add_argument(
+        "--compressibility",
+        type=float,
+        default=0.0,
+        help="Fraction (0-1) by which the data can be compressed.",
+    )
+    parser.add_argument("--seed", type=int, help="Random seed.")
+    parser.add_argument(
+        "--clean", action="store_true", help="Remove the output directory first."
+    )
+    args = parser.parse_args(args)
+    if not 0 <= args.compressibility <= 1:
+        parser.error("--compressibility must be between 0 and 1")
+    return args
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    random.seed(args.seed)
+    run_options = {
+        "n_files": args.files,
+        "get_size": get_size_sampler(args.size_dist),
+        "barcodes": args.barcodes,
+        "compressibility": args.compressibility,
+    }
+
+    ### create test data ###
+
+    # directories found under every promethION run
+    subdirs = ["pod5", "fastq_pass", "fastq_fail", "other_reports"]
+
+    # some example values
+    date = "20221208"
+    affiliation = "wehi"
+    lab = "bowden"
+    flowcellid = "PAK1234"
+
+    # specify runs and whether they have finished
+    runs = {"runa": True, "runb": True, "runc": False}
+    samples = ["sample_a", "sample_b"]
+
+    # remake test directories
+    if args.clean and os.path.exists(args.output):
+        shutil.rmtree(args.output)
+    for run in runs:
+        for sample in samples:
+            runhex = get_random_hexstring(1e8)
+            basedir = f"{args.output}/{date}_{affiliation}_{lab}_{run}/{sample}/{date}_1111_2F_{flowcellid}_{runhex}"
+            make_run(basedir, subdirs, flowcellid, runhex, runs[run], **run_options)
+
+            # make a second run
+            runhex = get_random_hexstring(1e8)
+            basedir = f"{args.output}/{date}_{affiliation}_{lab}_{run}/{sample}/{date}_1111_2F_{flowcellid}_{runhex}"
+            make_run(basedir, subdirs, flowcellid, runhex, runs[run], **run_options)
+
+    # make a test dirs that is meant to be ignored
+    os.makedirs(f"{args.output}/TEST_a")
+
+    # make a test dir that doesn't follow the pattern but still needs to be processed
+    os.makedirs(f"{args.output}/TEST_b")
+    runhex = get_random_hexstring(1e8)
+    sample = samples[0]
+    basedir = f"{args.output}/TEST_b/{sample}/{date}_1111_2F_{flowcellid}_{runhex}"
+    make_run(basedir, subdirs, flowcellid, runhex, True, **run_options)
+
+
+if __name__ == "__main__":
+    main()
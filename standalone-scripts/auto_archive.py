@@ -15,18 +15,49 @@ in a transfer directory for egress.
 import os
 import sys
 import re
+import json
+import gzip
+import tarfile
+import contextlib
 import subprocess
+import shutil
 import glob
 import logging
 import time
+import hashlib
+import threading
+import heapq
+import zlib
+import select
+import struct
+import ctypes
+import ctypes.util
+import stat
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from argparse import ArgumentParser
 from datetime import datetime
 import yaml
 
+# archive, checksum, metrics and throttling helpers are shared with the workflow
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow', 'scripts'))
+from archiver import (AUTO_MIN_SAVING, AUTO_SAMPLE_BYTES, AUTO_SAMPLE_FILES, CODEC_EXTENSIONS,
+                      format_checksum_line, get_compress_cmd, get_compression, parse_size)
+from checksum_cache import ChecksumCache
+from io_throttle import make_throttle, set_idle_priority
+from job_metrics import JobMetrics, ProgressLogger, replace_file, write_metrics
+from run_lease import LeaseManager
+
 POSSIBLE_FILE_TYPES = ['reports', 'fastq', 'fast5']
 
 end_of_run_file_regex = re.compile(r'^sequencing_summary\w*\.txt')
 
+# read buffer size used when hashing files
+CHECKSUM_BUFFER_SIZE = 4 * 1024 * 1024
+
+# per-thread read buffers, reused across files
+_thread_buffers = threading.local()
+
 def parse_args(args):
     '''
     Parse command line arguments
@@ -36,6 +67,10 @@ def parse_args(args):
 
         python auto_archive.py config.yaml
 
+        or, to keep running and archive runs as they finish:
+
+        python auto_archive.py --watch config.yaml
+
         Config file should contain:
 
         data_dir: <path_to_data_directory>
@@ -46,6 +81,9 @@ def parse_args(args):
                         metavar='CONFIG',
                         type=str,
                         help='Config file.')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='Keep running, archiving runs as they finish.')
     return parser.parse_args(args)
 
 def init_logging(log_filename):
@@ -55,13 +93,353 @@ def init_logging(log_filename):
     logging.basicConfig(filename=log_filename,
                         level=logging.DEBUG,
                         filemode='w',
-                        format='%(asctime)s %(levelname)s - %(message)s',
+                        format='%(asctime)s %(levelname)s [%(threadName)s] - %(message)s',
                         datefmt="%Y-%m-%dT%H:%M:%S%z")
     logging.info('Auto-archiver started')
 
-def run_tar(tar_file, files_to_archive, run_dir_full, file_type, threads=1):
+def choose_auto_codec(run_dir_full, files_to_archive):
+    '''
+    Sample the first few non-empty files to archive and
+    return 'pigz' if they compress well enough, else 'none'
+    '''
+    raw_bytes, compressed_bytes, files_sampled = 0, 0, 0
+    paths = [os.path.join(run_dir_full, file) for file in files_to_archive]
+    files = (file for path in paths for file in
+             (sorted(get_files(path)) if os.path.isdir(path) else [path]))
+    for file in files:
+        if files_sampled >= AUTO_SAMPLE_FILES:
+            break
+        try:
+            size = os.path.getsize(file)
+            if size == 0:
+                continue
+            with open(file, 'rb') as fin:
+                fin.seek(max(0, size // 2 - AUTO_SAMPLE_BYTES // 2))
+                data = fin.read(AUTO_SAMPLE_BYTES)
+        except OSError:
+            continue
+        raw_bytes += len(data)
+        compressed_bytes += len(zlib.compress(data, 1))
+        files_sampled += 1
+    if raw_bytes == 0 or compressed_bytes / raw_bytes > 1 - AUTO_MIN_SAVING:
+        return 'none'
+    return 'pigz'
+
+def write_job_metrics(metrics, status='ok'):
     '''
-    Archive data using tar and pigz (if using multi-threading)
+    Log a finished job's metrics (a JobMetrics) and
+    write them to its metrics_dir, if set
+    '''
+    record = metrics.record(status)
+    logging.info('%s job finished (%s): %d files, %d bytes read, %d bytes written '
+                 'in %.1fs (%.1fs CPU).', metrics.stage, status, metrics.files,
+                 metrics.bytes_read, metrics.bytes_written, record['wall_seconds'],
+                 record['cpu_seconds'])
+    if metrics.metrics_dir:
+        write_metrics(record, metrics.metrics_dir)
+
+def get_file_size(path):
+    '''
+    Size of a regular file, 0 for anything else
+    '''
+    st = os.lstat(path)
+    return st.st_size if stat.S_ISREG(st.st_mode) else 0
+
+def get_archive_members(run_dir_full, files_to_archive):
+    '''
+    Yield the members tar would add for files_to_archive
+    (directories followed by their contents), in sorted order
+    '''
+    for file in files_to_archive:
+        yield file
+        full_path = os.path.join(run_dir_full, file)
+        if os.path.isdir(full_path) and not os.path.islink(full_path):
+            yield from get_archive_members(
+                run_dir_full, [os.path.join(file, name) for name in sorted(os.listdir(full_path))])
+
+def get_member_size(run_dir_full, member):
+    '''
+    Number of bytes member takes up in an uncompressed tar
+    '''
+    full_path = os.path.join(run_dir_full, member)
+    is_file = os.path.isfile(full_path) and not os.path.islink(full_path)
+    size = os.lstat(full_path).st_size if is_file else 0
+    return tarfile.BLOCKSIZE + -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+def read_journal(journal_file):
+    '''
+    Read the committed segment records of a checkpointed
+    archive, ignoring a torn final line
+    '''
+    records = []
+    if not os.path.exists(journal_file):
+        return records
+    with open(journal_file, 'r') as journal:
+        for line in journal:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    return records
+
+def sha1_region(fin, start, end):
+    '''
+    Calculate sha1 digest of bytes start to end of fin
+    '''
+    sha1 = hashlib.sha1()
+    fin.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        data = fin.read(min(CHECKSUM_BUFFER_SIZE, remaining))
+        if not data:
+            break
+        sha1.update(data)
+        remaining -= len(data)
+    return sha1.hexdigest()
+
+def get_committed_segments(partial_file, journal_file, members):
+    '''
+    Get the journal records of the segments of partial_file that
+    are intact and still match the members to archive
+    '''
+    records = read_journal(journal_file)
+    if not records or not os.path.exists(partial_file):
+        return []
+    committed = []
+    size = os.path.getsize(partial_file)
+    with open(partial_file, 'rb') as fin:
+        start = 0
+        for record in records:
+            end, n_members = record['offset'], record['members']
+            if end > size or n_members > len(members) or \
+                    members[n_members - 1] != record['last_member'] or \
+                    sha1_region(fin, start, end) != record['sha1']:
+                logging.warning('Segment %d of %s is invalid; discarding it and later segments.',
+                                record['segment'], partial_file)
+                break
+            committed.append(record)
+            start = end
+    return committed
+
+class _SegmentSink:
+    '''
+    Write-only file object counting the bytes written,
+    as tarfile requires a position to write to a pipe
+    '''
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.position = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+def get_compressor(codec, threads, level=None):
+    '''
+    Returns the command compressing stdin to stdout for codec,
+    using single-threaded gzip if pigz is not installed
+    '''
+    if codec == 'pigz' and shutil.which('pigz') is None:
+        return ['gzip', '-c'] + ([f'-{level}'] if level is not None else [])
+    return get_compress_cmd(codec, threads, level)
+
+@contextlib.contextmanager
+def segment_writer(fout, codec, threads=1, level=None):
+    '''
+    Open a stream compressing one segment onto the end of fout;
+    each segment is a complete gzip member or zstd frame, so
+    the segments concatenate into a single valid archive
+    '''
+    if codec == 'none':
+        yield _SegmentSink(fout)
+    elif codec == 'pigz' and threads == 1:
+        compresslevel = int(level) if level is not None else 6
+        with gzip.GzipFile(filename='', mode='wb', fileobj=fout, mtime=0,
+                           compresslevel=compresslevel) as gzout:
+            yield _SegmentSink(gzout)
+    else:
+        fout.flush()
+        proc = subprocess.Popen(get_compressor(codec, threads, level),
+                                stdin=subprocess.PIPE,
+                                stdout=fout)
+        try:
+            yield _SegmentSink(proc.stdin)
+        finally:
+            proc.stdin.close()
+            return_code = proc.wait()
+            fout.seek(0, os.SEEK_END)
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, proc.args)
+
+def list_archive(tar_file, codec):
+    '''
+    Get the member names of an archive
+    '''
+    if codec == 'zstd':
+        proc = subprocess.Popen(['zstd', '-q', '-d', '-c', tar_file], stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            names = [tarinfo.name for tarinfo in tar]
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+        return names
+    with tarfile.open(tar_file, mode='r:*') as tar:
+        return tar.getnames()
+
+class _ThrottledReader:
+    '''
+    Read-only file object pacing reads through an IOThrottle
+    '''
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.wait(len(data))
+        return data
+
+def add_throttled(tar, full_path, arcname, throttle):
+    '''
+    Add a single file or directory to tar, reading it through throttle
+    '''
+    tarinfo = tar.gettarinfo(full_path, arcname=arcname)
+    if tarinfo is None:
+        return
+    if tarinfo.isreg():
+        with open(full_path, 'rb') as fin:
+            tar.addfile(tarinfo, _ThrottledReader(fin, throttle))
+    else:
+        tar.addfile(tarinfo)
+
+def write_throttled_archive(tar_file, files_to_archive, run_dir_full,
+                            codec, threads, level, throttle, log_tar_output):
+    '''
+    Write an archive with tar, reading its output at the throttled rate;
+    tar blocks once the pipe is full, so its reads are paced too.
+    Each line of tar's verbose output is passed to log_tar_output.
+    Returns tar's return code
+    '''
+    with open(tar_file, 'wb') as fout, segment_writer(fout, codec, threads, level) as sink:
+        proc = subprocess.Popen(['tar', '-cpvf', '-'] + files_to_archive,
+                                cwd=run_dir_full,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+
+        def log_stderr():
+            for line in proc.stderr:
+                log_tar_output(line)
+
+        logger = threading.Thread(target=log_stderr, daemon=True)
+        logger.start()
+        while True:
+            data = proc.stdout.read(CHECKSUM_BUFFER_SIZE)
+            if not data:
+                break
+            throttle.wait(len(data))
+            sink.write(data)
+        logger.join()
+        return proc.wait()
+
+def write_checkpointed_archive(tar_file, files_to_archive, run_dir_full,
+                               codec, threads, level, segment_size, progress=None,
+                               throttle=None):
+    '''
+    Write a tar archive as a series of segments of about segment_size
+    bytes (uncompressed), appended to tar_file.partial. Each segment
+    is synced to disk and then recorded in tar_file.journal, so if
+    archiving is interrupted, calling this again continues after the
+    last committed segment (and verifies the archive once complete).
+    Progress is reported to progress (a ProgressLogger), and reads
+    paced by throttle (an IOThrottle), if given. Returns 0 on success.
+    '''
+    partial_file = f'{tar_file}.partial'
+    journal_file = f'{tar_file}.journal'
+    members = list(get_archive_members(run_dir_full, files_to_archive))
+    committed = get_committed_segments(partial_file, journal_file, members)
+    resumed = len(committed) > 0
+    offset = committed[-1]['offset'] if resumed else 0
+    start = committed[-1]['members'] if resumed else 0
+    done = resumed and committed[-1]['final']
+    if resumed:
+        logging.info('Resuming %s after %d committed segments (%d of %d members).',
+                     tar_file, len(committed), start, len(members))
+        if progress is not None:
+            done_files = [os.path.join(run_dir_full, member) for member in members[:start]]
+            done_files = [file for file in done_files if not os.path.isdir(file)]
+            progress.update(len(done_files), sum(map(get_file_size, done_files)))
+
+    # keep only the verified records, replacing the journal atomically
+    with open(f'{journal_file}.tmp', 'w') as journal:
+        journal.writelines(json.dumps(record) + '\n' for record in committed)
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(f'{journal_file}.tmp', journal_file)
+
+    mode = 'r+b' if os.path.exists(partial_file) else 'wb'
+    with open(partial_file, mode) as fout, open(journal_file, 'a') as journal:
+        fout.truncate(offset)
+        fout.seek(offset)
+        segment = len(committed)
+        while not done:
+            end, segment_bytes = start, 0
+            while end < len(members):
+                member_bytes = get_member_size(run_dir_full, members[end])
+                if end > start and segment_bytes + member_bytes > segment_size:
+                    break
+                segment_bytes += member_bytes
+                end += 1
+            done = end == len(members)
+
+            with segment_writer(fout, codec, threads, level) as sink:
+                tar = tarfile.open(fileobj=sink, mode='w', format=tarfile.GNU_FORMAT)
+                for member in members[start:end]:
+                    full_path = os.path.join(run_dir_full, member)
+                    if throttle is not None:
+                        add_throttled(tar, full_path, member, throttle)
+                    else:
+                        tar.add(full_path, arcname=member, recursive=False)
+                    if progress is not None and not os.path.isdir(full_path):
+                        progress.update(nbytes=get_file_size(full_path))
+                # only the last segment ends the archive
+                if done:
+                    tar.close()
+            fout.flush()
+            os.fsync(fout.fileno())
+
+            segment_end = fout.tell()
+            with open(partial_file, 'rb') as fin:
+                digest = sha1_region(fin, offset, segment_end)
+            record = {'segment': segment, 'members': end, 'last_member': members[end - 1],
+                      'offset': segment_end, 'sha1': digest, 'final': done}
+            journal.write(json.dumps(record) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+            segment, start, offset = segment + 1, end, segment_end
+
+    if resumed and list_archive(partial_file, codec) != members:
+        logging.error('Resumed archive %s does not match its source; starting again.', tar_file)
+        os.remove(partial_file)
+        os.remove(journal_file)
+        return 1
+
+    os.replace(partial_file, tar_file)
+    os.remove(journal_file)
+    return 0
+
+def run_tar(tar_file, files_to_archive, run_dir_full, file_type, threads=1,
+            codec=None, level=None, segment_size=0, metrics_dir='', io_throttle=None):
+    '''
+    Archive data using tar, compressing with gzip, pigz (if
+    using multi-threading) or zstd depending on codec. If
+    segment_size is set, the archive is checkpointed so
+    that it can be resumed if interrupted. Reads are throttled
+    as set by io_throttle. Progress is logged periodically
+    and the job's metrics written to metrics_dir
     '''
     # check that all files/folders exist
     for file in files_to_archive:
@@ -70,35 +448,92 @@ def run_tar(tar_file, files_to_archive, run_dir_full, file_type, threads=1):
             logging.error('%s does not exist!', full_file_path)
             return
 
-    # do not use gzip compression if multithreaded (handled by pigz)
-    # or archiving fastqs (already in gz format)
-    tar_args = '-cpvf' if file_type == 'fastq' or threads > 1 else '-czpvf'
-    if threads > 1 and file_type != 'fastq':
+    if codec is None:
+        codec, level = get_compression({}, file_type)
+    if codec == 'pigz' and threads > 1 and shutil.which('pigz') is None:
+        logging.warning('pigz is not installed, compressing %s with gzip.', tar_file)
+
+    run_dir = os.path.split(run_dir_full)[1]
+    metrics = JobMetrics('archive', {'run': run_dir, 'file_type': file_type}, metrics_dir,
+                         per_thread=True)
+    # size of each member to archive, None for directories
+    member_sizes = {}
+    for member in get_archive_members(run_dir_full, files_to_archive):
+        full_path = os.path.join(run_dir_full, member)
+        is_dir = os.path.isdir(full_path) and not os.path.islink(full_path)
+        member_sizes[member] = None if is_dir else get_file_size(full_path)
+    file_sizes = [size for size in member_sizes.values() if size is not None]
+    progress = ProgressLogger(os.path.basename(tar_file), len(file_sizes), sum(file_sizes),
+                              write=logging.info)
+    throttle = make_throttle(io_throttle, run_dir_full, logging.warning)
+
+    def log_tar_output(line):
+        # tar -v lists each member as it is added (directories with
+        # a trailing slash); anything else is a message from tar
+        line = bytes.decode(line).strip()
+        member = line.rstrip('/')
+        if member in member_sizes:
+            size = member_sizes[member]
+            progress.update(files=int(size is not None), nbytes=size or 0)
+        elif line:
+            logging.info(line)
+
+    # checkpointed archives are written in segments by python's tarfile;
+    # otherwise use tar's own gzip compression if single-threaded, or pipe
+    # through pigz or zstd; do not compress if codec is 'none' (e.g.,
+    # for fastqs, which are already in gz format)
+    if segment_size:
+        try:
+            return_code = write_checkpointed_archive(tar_file, files_to_archive, run_dir_full,
+                                                     codec, threads, level, segment_size,
+                                                     progress, throttle)
+        except (OSError, subprocess.CalledProcessError, tarfile.TarError) as error:
+            logging.error('Could not write %s: %s', tar_file, error)
+            return_code = 1
+    elif throttle is not None:
+        try:
+            return_code = write_throttled_archive(tar_file, files_to_archive, run_dir_full,
+                                                  codec, threads, level, throttle,
+                                                  log_tar_output)
+        except (OSError, subprocess.CalledProcessError) as error:
+            logging.error('Could not write %s: %s', tar_file, error)
+            return_code = 1
+    elif codec == 'none' or (codec == 'pigz' and threads == 1 and level is None):
+        tar_args = '-cpvf' if codec == 'none' else '-czpvf'
+        proc = subprocess.Popen(['tar', tar_args, tar_file] + files_to_archive,
+                                 cwd=run_dir_full,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+        for line in proc.stdout:
+            log_tar_output(line)
+        return_code = proc.wait()
+    else:
         with open(tar_file, 'w') as tout:
-            proc0 = subprocess.Popen(['tar', tar_args, '-'] + files_to_archive,
+            proc0 = subprocess.Popen(['tar', '-cpvf', '-'] + files_to_archive,
                                      cwd=run_dir_full,
                                      stdout=subprocess.PIPE,
                                      stderr=subprocess.PIPE)
-            proc1 = subprocess.Popen(['pigz', '-p', str(threads), '-k'],
+            proc1 = subprocess.Popen(get_compressor(codec, threads, level),
                                      stdin=proc0.stdout,
                                      stdout=tout,
                                      stderr=subprocess.PIPE)
+            proc0.stdout.close()
             for line in proc0.stderr:
-                logging.info(bytes.decode(line).strip())
+                log_tar_output(line)
 
             for line in proc1.stderr:
                 logging.info(bytes.decode(line).strip())
-            return_code = proc1.wait()
-    else:
-        proc = subprocess.Popen(['tar', tar_args, tar_file] + files_to_archive,
-                                 cwd=run_dir_full,
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT)
-        for line in proc.stdout:
-            logging.info(bytes.decode(line).strip())
-        return_code = proc.wait()
+            return_code = proc1.wait() or proc0.wait()
+    progress.finish()
+    if throttle is not None:
+        logging.info('%s: %s.', os.path.basename(tar_file), throttle.summary())
+
+    metrics.files = progress.files
+    metrics.bytes_read = progress.bytes
+    if os.path.exists(tar_file):
+        metrics.bytes_written = os.path.getsize(tar_file)
+    write_job_metrics(metrics, 'ok' if return_code == 0 else 'failed')
 
-    run_dir = os.path.split(run_dir_full)[1]
     success_file = os.path.join(run_dir_full, f'{run_dir}_{file_type}_archive.success')
     if return_code == 0:
         open(success_file, 'w').close()
@@ -106,11 +541,12 @@ def run_tar(tar_file, files_to_archive, run_dir_full, file_type, threads=1):
     else:
         logging.error('An error occured archiving %s for %s.', file_type, run_dir)
 
-def make_archive(run_dir_full, transfer_dir_full, file_type, threads):
+def make_archive(run_dir_full, transfer_dir_full, file_type, threads, compression=None,
+                 segment_size=0, metrics_dir='', io_throttle=None):
     '''
     Given directories for project, sample and run dirs,
-    make tar.gz of report files and fast5 files, and
-    make tar file for fastq files
+    make archives of report, fastq and fast5 files,
+    compressed as configured for each file type
     '''
     tmp, run_dir = os.path.split(run_dir_full)
     sample_dir = os.path.split(tmp)[1]
@@ -124,9 +560,6 @@ def make_archive(run_dir_full, transfer_dir_full, file_type, threads):
         logging.info('Skipped %s for run %s due to presence of success file.', file_type, run_dir)
         return
 
-    ext = 'tar' if file_type == 'fastq' else 'tar.gz'
-    tar_file = os.path.join(dest_dir, f'{run_dir}_{file_type}.{ext}')
-    tar_file = os.path.abspath(tar_file) # need absolute path for tar to get put in right place
     files_to_archive = []
 
     if file_type == 'reports':
@@ -140,7 +573,18 @@ def make_archive(run_dir_full, transfer_dir_full, file_type, threads):
     elif file_type == 'fastq':
         files_to_archive = ['fastq_pass', 'fastq_fail']
 
-    run_tar(tar_file, files_to_archive, run_dir_full, file_type, threads=threads)
+    codec, level = get_compression(compression, file_type)
+    if codec == 'auto':
+        codec = choose_auto_codec(run_dir_full, files_to_archive)
+        logging.info('Using %s compression for %s of run %s.', codec, file_type, run_dir)
+
+    ext = CODEC_EXTENSIONS[codec]
+    tar_file = os.path.join(dest_dir, f'{run_dir}_{file_type}.{ext}')
+    tar_file = os.path.abspath(tar_file) # need absolute path for tar to get put in right place
+
+    run_tar(tar_file, files_to_archive, run_dir_full, file_type, threads=threads,
+            codec=codec, level=level, segment_size=segment_size, metrics_dir=metrics_dir,
+            io_throttle=io_throttle)
 
 def get_files(directory):
     '''
@@ -152,9 +596,60 @@ def get_files(directory):
         for file in filenames:
             yield os.path.join(dirpath, file)
 
-def calculate_checksums(run_dir_full, transfer_dir_full, checksum_filename):
+def sha1_file(file, throttle=None):
+    '''
+    Calculate sha1 digest of a file, reading through
+    a reusable per-thread buffer (paced by throttle,
+    an IOThrottle, if given)
+    '''
+    buf = getattr(_thread_buffers, 'buf', None)
+    if buf is None:
+        buf = _thread_buffers.buf = bytearray(CHECKSUM_BUFFER_SIZE)
+    view = memoryview(buf)
+    sha1 = hashlib.sha1()
+    with open(file, 'rb') as fin:
+        while True:
+            nbytes = fin.readinto(buf)
+            if not nbytes:
+                break
+            if throttle is not None:
+                throttle.wait(nbytes)
+            sha1.update(view[:nbytes])
+    return sha1.hexdigest()
+
+def iter_checksums(files, workers=1, throttle=None):
+    '''
+    Hash files using a bounded pool of worker threads,
+    yielding (file, digest, error) in the order given
+    '''
+    workers = max(1, int(workers))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for file in files:
+            pending.append((file, executor.submit(sha1_file, file, throttle)))
+            # bound the number of queued files so memory stays flat
+            if len(pending) >= workers * 4:
+                yield _pop_checksum(pending)
+        while pending:
+            yield _pop_checksum(pending)
+
+def _pop_checksum(pending):
+    file, future = pending.popleft()
+    try:
+        return file, future.result(), None
+    except OSError as error:
+        return file, None, error
+
+def calculate_checksums(run_dir_full, transfer_dir_full, checksum_filename, workers=1,
+                        metrics_dir='', io_throttle=None, cache_dir=''):
     '''
     Calculate sha1sum for all files in run directory
+    (with reads throttled as set by io_throttle),
+    logging progress periodically and writing the
+    job's metrics to metrics_dir. Files unchanged
+    since their checksums were cached in cache_dir
+    are not hashed again. The checksum file is
+    rewritten sorted, with one line per file.
     '''
     dest_dir = os.path.join(transfer_dir_full, 'checksums')
     os.makedirs(dest_dir, exist_ok=True)
@@ -167,20 +662,48 @@ def calculate_checksums(run_dir_full, transfer_dir_full, checksum_filename):
         logging.info('Skipped checksums for run %s due to presence of success file.', run_dir)
         return
 
+    metrics = JobMetrics('checksums', {'run': run_dir}, metrics_dir, per_thread=True)
+    files = sorted(file for file in get_files(run_dir_full)
+                   if os.path.splitext(file)[1] != '.success')
+    # cached by path relative to the run directory
+    cache = ChecksumCache(os.path.join(cache_dir, f'{run_dir}_checksums.jsonl')
+                          if cache_dir else None, run_dir_full)
+    file_stats = {file: os.lstat(file) for file in files}
+    checksums = {}
+    for file in files:
+        digest = cache.lookup(os.path.relpath(file, run_dir_full), file_stats[file])
+        if digest is not None:
+            checksums[file] = digest
+    files = [file for file in files if file not in checksums]
+    file_sizes = {file: get_file_size(file) for file in files}
+    progress = ProgressLogger(checksum_filename, len(files), sum(file_sizes.values()),
+                              write=logging.info)
+    throttle = make_throttle(io_throttle, run_dir_full, logging.warning)
+
     error = 0
-    with open(checksum_file, 'a') as cfile:
-        for file in get_files(run_dir_full):
-            if os.path.splitext(file)[1] == '.success':
-                continue
-            proc = subprocess.Popen(['shasum', '-a', '1', file],
-                                     stdout=cfile,
-                                     stderr=subprocess.PIPE)
-            for line in proc.stderr:
-                logging.error(line)
+    for file, digest, file_error in iter_checksums(files, workers, throttle):
+        if file_error is not None:
+            logging.error('Could not calculate checksum for %s: %s', file, file_error)
+            error = 1
+            continue
+        checksums[file] = digest
+        cache.add(os.path.relpath(file, run_dir_full), digest, file_stats[file])
+        progress.update(nbytes=file_sizes[file])
+    progress.finish()
+    if throttle is not None:
+        logging.info('%s: %s.', checksum_filename, throttle.summary())
+    if cache.hits:
+        logging.info('Reused %d cached checksums for run %s.', cache.hits, run_dir)
 
-            # check for errors
-            return_code = proc.wait()
-            error = return_code if return_code != 0 else error
+    # rewritten rather than appended to, so a run processed again has no duplicates
+    replace_file(checksum_file, ''.join(format_checksum_line(checksums[file], file)
+                                        for file in sorted(checksums)))
+    cache.save()
+
+    metrics.files = progress.files
+    metrics.bytes_read = progress.bytes
+    metrics.bytes_written = os.path.getsize(checksum_file)
+    write_job_metrics(metrics, 'ok' if error == 0 else 'failed')
 
     if error == 0:
         open(success_file, 'w').close()
@@ -200,51 +723,495 @@ def get_project_dirs(data_dir, proj_dir_regex):
             project_dirs.append(proj_dir)
     return project_dirs
 
-def archive_runs_if_complete(data_dir, proj_dir, file_types, config):
+def scan_dir(path):
+    '''
+    Returns the (name, is_dir) entries of path in listing
+    order, using the types cached by os.scandir, or None
+    if path is not a directory.
+    '''
+    try:
+        with os.scandir(path) as entries:
+            return [(entry.name, entry.is_dir()) for entry in entries]
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+def scan_run_dir(run_dir_full):
+    '''
+    Returns the ctime of the first end of run file
+    in run_dir_full, or None if the run is unfinished.
+    '''
+    names = [name for name, _ in scan_dir(run_dir_full) or []]
+    eor_files = list(filter(end_of_run_file_regex.match, names))
+    if not eor_files:
+        return None
+    try:
+        return os.path.getctime(os.path.join(run_dir_full, eor_files[0]))
+    except FileNotFoundError:
+        return None
+
+def discover_runs(data_dir, proj_dirs, workers=1):
+    '''
+    Scan the sample and run directories of each project
+    directory one level at a time, with up to workers
+    threads, returning a list per project (in proj_dirs
+    order) of (sample_dir, run_dir, end of run file ctime
+    or None) in listing order.
+    '''
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        proj_scans = pool.map(scan_dir, [os.path.join(data_dir, proj_dir)
+                                         for proj_dir in proj_dirs])
+        samples = [(i, sample_dir)
+                   for i, entries in enumerate(proj_scans)
+                   for sample_dir, is_dir in entries or [] if is_dir]
+        sample_scans = pool.map(scan_dir, [os.path.join(data_dir, proj_dirs[i], sample_dir)
+                                           for i, sample_dir in samples])
+        runs = [(i, sample_dir, run_dir)
+                for (i, sample_dir), entries in zip(samples, sample_scans)
+                for run_dir, is_dir in entries or [] if is_dir]
+        run_paths = [os.path.join(data_dir, proj_dirs[i], sample_dir, run_dir)
+                     for i, sample_dir, run_dir in runs]
+        ctimes = pool.map(scan_run_dir, run_paths)
+        project_runs = [[] for _ in proj_dirs]
+        for (i, sample_dir, run_dir), ctime in zip(runs, ctimes):
+            project_runs[i].append((sample_dir, run_dir, ctime))
+    return project_runs
+
+class ArchiveScheduler:
+    '''
+    Runs archive and checksum jobs concurrently within a global
+    budget of cores, limiting the number of jobs reading from
+    any one filesystem at the same time.
+    '''
+    def __init__(self, max_threads, io_jobs_per_filesystem=2):
+        self.max_threads = max(1, int(max_threads))
+        self.io_jobs_per_filesystem = max(1, int(io_jobs_per_filesystem))
+        self.threads_available = self.max_threads
+        self.filesystem_jobs = {}
+        self.queue = []
+        self.running = 0
+        self.cond = threading.Condition()
+
+    def submit(self, name, path, threads, func, *args, **kwargs):
+        '''
+        Queue func(*args, **kwargs) as a job that uses the given
+        number of threads and reads from the filesystem holding path.
+        '''
+        filesystem = os.stat(path).st_dev
+        job = (name, filesystem, min(max(1, threads), self.max_threads), func, args, kwargs)
+        with self.cond:
+            self.queue.append(job)
+            self._dispatch()
+
+    def _dispatch(self):
+        # must be called with self.cond held
+        for job in list(self.queue):
+            name, filesystem, threads, _, _, _ = job
+            if threads > self.threads_available:
+                continue
+            if self.filesystem_jobs.get(filesystem, 0) >= self.io_jobs_per_filesystem:
+                continue
+            self.queue.remove(job)
+            self.threads_available -= threads
+            self.filesystem_jobs[filesystem] = self.filesystem_jobs.get(filesystem, 0) + 1
+            self.running += 1
+            threading.Thread(target=self._run, args=(job,), name=name, daemon=True).start()
+
+    def _run(self, job):
+        name, filesystem, threads, func, args, kwargs = job
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            logging.exception('Job %s failed.', name)
+        finally:
+            with self.cond:
+                self.threads_available += threads
+                self.filesystem_jobs[filesystem] -= 1
+                self.running -= 1
+                self._dispatch()
+                self.cond.notify_all()
+
+    def wait(self):
+        '''
+        Block until all submitted jobs have finished.
+        '''
+        with self.cond:
+            self.cond.wait_for(lambda: not self.queue and self.running == 0)
+
+def make_scheduler(config):
+    '''
+    Return an ArchiveScheduler if a global thread
+    budget is configured, otherwise None (sequential).
+    '''
+    max_threads = int(config.get('max_threads', 0))
+    if max_threads <= 0:
+        return None
+    return ArchiveScheduler(max_threads, config.get('io_jobs_per_filesystem', 2))
+
+def make_lease_manager(config):
+    '''
+    Return a LeaseManager if a lease directory
+    is configured, otherwise None (single host).
+    '''
+    leases = config.get('leases') or {}
+    if not leases.get('lease_dir'):
+        return None
+    return LeaseManager(leases['lease_dir'], leases.get('duration', 300),
+                        leases.get('heartbeat', 60), logging.warning)
+
+def get_lease_name(run_dir_full):
+    '''
+    Returns the lease name of a run: its project,
+    sample and run directories joined by __
+    '''
+    parts = os.path.normpath(os.path.abspath(run_dir_full)).split(os.sep)
+    return '__'.join(parts[-3:])
+
+def release_claim(leases, name):
+    '''
+    Release the lease on name, logging an error
+    if it was lost while the run was processed.
+    '''
+    if not leases.is_held(name):
+        logging.error('Lease on %s was lost while archiving it.', name)
+    leases.release(name)
+
+def archive_run(run_dir_full, transfer_dir_full, file_types, config, scheduler=None,
+                leases=None, on_skip=None):
+    '''
+    Calculate checksums (if enabled) and make
+    archives for a finished run. If a scheduler
+    is given, jobs are queued rather than run.
+    If leases are given, the run is claimed once
+    before its jobs are run or queued, and released
+    when its last job completes; on_skip(run_dir_full)
+    is called if another process holds it instead.
+    '''
+    run_dir = os.path.split(run_dir_full)[1]
+    calc_checksums = bool(config['calculate_checksums'])
+    threads = int(config['threads'])
+    checksum_workers = int(config.get('checksum_workers', 1))
+    metrics_dir = config.get('metrics_dir', '')
+    io_throttle = config.get('io_throttle') or {}
+    checksum_cache_dir = config.get('checksum_cache_dir', '')
+
+    lease_name = get_lease_name(run_dir_full)
+    if leases is not None and not leases.acquire(lease_name):
+        logging.info('Run %s is claimed by another process, skipping.', lease_name)
+        if on_skip:
+            on_skip(run_dir_full)
+        return
+
+    logging.info('Making archives...')
+    jobs = []
+    if calc_checksums:
+        logging.info('Calculating checksums for run %s', run_dir)
+        checksum_filename = f'{run_dir}_checksums.sha1'
+        jobs.append(('checksums', checksum_workers, calculate_checksums,
+                     (run_dir_full, transfer_dir_full, checksum_filename),
+                     {'workers': checksum_workers, 'metrics_dir': metrics_dir,
+                      'io_throttle': io_throttle, 'cache_dir': checksum_cache_dir}))
+    compression = config.get('compression')
+    segment_size = parse_size(config.get('checkpoint_segment_size', 0))
+    for file_type in file_types:
+        # uncompressed archives only use tar's thread
+        codec, _ = get_compression(compression, file_type)
+        archive_threads = 1 if codec == 'none' else threads
+        jobs.append((file_type, archive_threads, make_archive,
+                     (run_dir_full, transfer_dir_full, file_type, threads, compression,
+                      segment_size, metrics_dir, io_throttle), {}))
+
+    if scheduler is None:
+        try:
+            for _, _, func, args, kwargs in jobs:
+                func(*args, **kwargs)
+        finally:
+            if leases is not None:
+                release_claim(leases, lease_name)
+        return
+    if not jobs:
+        if leases is not None:
+            release_claim(leases, lease_name)
+        return
+
+    # the run's lease is released by whichever of its jobs completes last
+    pending = [len(jobs)]
+    pending_lock = threading.Lock()
+
+    def run_job(func, *args, **kwargs):
+        try:
+            func(*args, **kwargs)
+        finally:
+            with pending_lock:
+                pending[0] -= 1
+                last = pending[0] == 0
+            if last and leases is not None:
+                release_claim(leases, lease_name)
+
+    for name, job_threads, func, args, kwargs in jobs:
+        scheduler.submit(f'{run_dir}/{name}', run_dir_full, job_threads,
+                         run_job, func, *args, **kwargs)
+
+def archive_runs_if_complete(data_dir, proj_dir, file_types, config, scheduler=None,
+                             leases=None, runs=None):
     '''
     Checks whether run is complete, if so,
     create one archive each for reports,
-    fast5 and fastq files.
+    fast5 and fastq files (skipping runs
+    claimed by another process). runs, if
+    given, are the project's runs found by
+    discover_runs.
     '''
     logging.info('Processing %s...', proj_dir)
 
     transfer_dir = config['transfer_dir']
     time_delay = config['time_delay']
-    calc_checksums = bool(config['calculate_checksums'])
-    threads = int(config['threads'])
 
-    sample_dirs = os.listdir(os.path.join(data_dir, proj_dir))
     transfer_dir_full = os.path.join(data_dir, proj_dir, transfer_dir)
+    if runs is None:
+        runs = discover_runs(data_dir, [proj_dir], config.get('discovery_workers', 1))[0]
 
-    # iterate through sample dirs
-    for sample_dir in sample_dirs:
-        full_sample_dir = os.path.join(data_dir, proj_dir, sample_dir)
-        if not os.path.isdir(full_sample_dir):
+    # check whether each run is finished
+    for sample_dir, run_dir, eor_ctime in runs:
+        if eor_ctime is None:
             continue
-        run_dirs = os.listdir(full_sample_dir)
+        run_dir_full = os.path.join(data_dir, proj_dir, sample_dir, run_dir)
+        logging.info('Run %s finished! Checking time delay...', run_dir)
+        if time.time() - eor_ctime > time_delay:
+            archive_run(run_dir_full, transfer_dir_full, file_types, config, scheduler,
+                        leases)
+        else:
+            logging.info('Run %s has not been complete for %f seconds yet, skipping.',
+                         run_dir, time_delay)
+
+class InotifyWatcher:
+    '''
+    Reports names created in watched directories
+    using Linux inotify (via ctypes).
+    '''
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}
+        self.wds = {}
+
+    def add_watch(self, path):
+        if path in self.wds:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         self.IN_CREATE | self.IN_MOVED_TO)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Could not watch {path}')
+        self.paths[wd] = path
+        self.wds[path] = wd
 
-        # check whether each run is finished
-        for run_dir in run_dirs:
-            run_dir_full = os.path.join(data_dir, proj_dir, sample_dir, run_dir)
-            if not os.path.isdir(run_dir_full):
+    def remove_watch(self, path):
+        wd = self.wds.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def wait(self, timeout):
+        '''
+        Wait up to timeout seconds for events, returning a list of
+        (directory, name) pairs, or None if events were lost.
+        '''
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        events = []
+        data = os.read(self.fd, 64 * 1024)
+        offset = 0
+        overflow = False
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & self.IN_Q_OVERFLOW:
+                overflow = True
+            elif mask & self.IN_IGNORED:
+                path = self.paths.pop(wd, None)
+                self.wds.pop(path, None)
+            elif wd in self.paths:
+                events.append((self.paths[wd], name))
+        return None if overflow else events
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingWatcher:
+    '''
+    Reports names created in watched directories by
+    periodically re-listing them; used where inotify
+    is unavailable (e.g., network filesystems).
+    '''
+    def __init__(self, poll_interval):
+        self.poll_interval = poll_interval
+        self.listings = {}
+
+    def add_watch(self, path):
+        if path not in self.listings:
+            self.listings[path] = set(os.listdir(path))
+
+    def remove_watch(self, path):
+        self.listings.pop(path, None)
+
+    def wait(self, timeout):
+        '''
+        Sleep until the next poll (or timeout), returning
+        (directory, name) pairs created since the last poll.
+        '''
+        if timeout is None or timeout > self.poll_interval:
+            timeout = self.poll_interval
+        time.sleep(timeout)
+        events = []
+        for path, previous in list(self.listings.items()):
+            try:
+                current = set(os.listdir(path))
+            except OSError:
+                self.listings.pop(path)
                 continue
-            run_contents = os.listdir(run_dir_full)
-
-            eor_files = list(filter(end_of_run_file_regex.match, run_contents))
-            if len(eor_files) > 0:
-                logging.info('Run %s finished! Checking time delay...', run_dir)
-                run_file = os.path.join(run_dir_full, eor_files[0])
-                if time.time() - os.path.getctime(run_file) > time_delay:
-                    logging.info('Making archives...')
-                    if calc_checksums:
-                        logging.info('Calculating checksums for run %s', run_dir)
-                        checksum_filename = f'{run_dir}_checksums.sha1'
-                        calculate_checksums(run_dir_full, transfer_dir_full, checksum_filename)
-                    for file_type in file_types:
-                        make_archive(run_dir_full, transfer_dir_full, file_type, threads)
-                else:
-                    logging.info('Run %s has not been complete for %f seconds yet, skipping.',
-                                 run_dir, time_delay)
+            events.extend((path, name) for name in sorted(current - previous))
+            self.listings[path] = current
+        return events
+
+    def close(self):
+        self.listings = {}
+
+def make_watcher(poll_interval, use_inotify=True):
+    '''
+    Return an inotify watcher if supported,
+    otherwise fall back to polling.
+    '''
+    if use_inotify and sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher()
+        except (OSError, AttributeError) as error:
+            logging.warning('inotify unavailable (%s), falling back to polling.', error)
+    return PollingWatcher(poll_interval)
+
+def watch_runs(data_dir, proj_dir_regex, extra_dirs, file_types, config,
+               stop_event=None, max_sleep=60, scheduler=None, leases=None):
+    '''
+    Watch data_dir for runs that finish (i.e., gain an end of
+    run file) and archive each one once time_delay has elapsed.
+    Runs claimed by another process are checked again once
+    their lease could have expired. Runs until stop_event is set.
+    '''
+    transfer_dir = config['transfer_dir']
+    time_delay = config['time_delay']
+    poll_interval = float(config.get('watch_poll_interval', 30))
+    use_inotify = bool(config.get('watch_use_inotify', True))
+    extra_dirs = extra_dirs or []
+
+    watcher = make_watcher(poll_interval, use_inotify)
+    timers = []
+    scheduled = set()
+    # runs skipped as claimed elsewhere (appended by scheduler threads)
+    skipped = deque()
+
+    def watch(path):
+        try:
+            watcher.add_watch(path)
+        except OSError as error:
+            logging.error('Could not watch %s: %s', path, error)
+
+    def on_run_file(run_dir_full, name):
+        if run_dir_full in scheduled or not end_of_run_file_regex.match(name):
+            return
+        run_file = os.path.join(run_dir_full, name)
+        due = os.path.getctime(run_file) + time_delay
+        logging.info('Run %s finished! Archiving in %.0f seconds.',
+                     os.path.basename(run_dir_full), max(0, due - time.time()))
+        heapq.heappush(timers, (due, run_dir_full))
+        scheduled.add(run_dir_full)
+        watcher.remove_watch(run_dir_full)
+
+    def on_run_dir(run_dir_full):
+        if not os.path.isdir(run_dir_full) or run_dir_full in scheduled:
+            return
+        watch(run_dir_full)
+        # catch files created before the watch was in place
+        for name in sorted(os.listdir(run_dir_full)):
+            on_run_file(run_dir_full, name)
+
+    def on_sample_dir(sample_dir_full):
+        if not os.path.isdir(sample_dir_full):
+            return
+        watch(sample_dir_full)
+        for run_dir in sorted(os.listdir(sample_dir_full)):
+            on_run_dir(os.path.join(sample_dir_full, run_dir))
+
+    def on_project_dir(proj_dir):
+        proj_dir_full = os.path.join(data_dir, proj_dir)
+        is_project_dir = re.match(proj_dir_regex, proj_dir) or proj_dir in extra_dirs
+        if not is_project_dir or not os.path.isdir(proj_dir_full):
+            return
+        logging.info('Watching project directory %s.', proj_dir)
+        watch(proj_dir_full)
+        for sample_dir in sorted(os.listdir(proj_dir_full)):
+            if sample_dir != transfer_dir:
+                on_sample_dir(os.path.join(proj_dir_full, sample_dir))
+
+    def scan():
+        watch(data_dir)
+        for proj_dir in sorted(os.listdir(data_dir)):
+            on_project_dir(proj_dir)
+        for proj_dir in extra_dirs:
+            on_project_dir(proj_dir)
+
+    def on_event(path, name):
+        depth = os.path.relpath(path, data_dir).count(os.sep) + 1 \
+            if path != data_dir else 0
+        if depth == 0:
+            on_project_dir(name)
+        elif depth == 1 and name != transfer_dir:
+            on_sample_dir(os.path.join(path, name))
+        elif depth == 2:
+            on_run_dir(os.path.join(path, name))
+        elif depth == 3:
+            on_run_file(path, name)
+
+    logging.info('Watching %s for finished runs...', data_dir)
+    scan()
+    try:
+        while stop_event is None or not stop_event.is_set():
+            timeout = max_sleep
+            if timers:
+                timeout = min(timeout, max(0, timers[0][0] - time.time()))
+            events = watcher.wait(timeout)
+            if events is None:
+                logging.warning('Filesystem events were lost, rescanning %s.', data_dir)
+                scan()
+            else:
+                for path, name in events:
+                    on_event(path, name)
+
+            while timers and timers[0][0] <= time.time():
+                _, run_dir_full = heapq.heappop(timers)
+                proj_dir_full = os.path.dirname(os.path.dirname(run_dir_full))
+                transfer_dir_full = os.path.join(proj_dir_full, transfer_dir)
+                archive_run(run_dir_full, transfer_dir_full, file_types, config, scheduler,
+                            leases, skipped.append)
+
+            retry = set()
+            while skipped:
+                retry.add(skipped.popleft())
+            for run_dir_full in retry - {run for _, run in timers}:
+                heapq.heappush(timers, (time.time() + leases.duration, run_dir_full))
+    finally:
+        watcher.close()
+        if scheduler is not None:
+            scheduler.wait()
 
 def main():
     '''
@@ -283,10 +1250,31 @@ def main():
             logging.error('Invalid file type %s specified.', file_type)
             sys.exit()
 
+    io_throttle = config.get('io_throttle') or {}
+    if str(io_throttle.get('idle_priority', False)).lower() == 'true':
+        # before any scheduler thread starts, so that they inherit it
+        set_idle_priority(logging.warning)
+
+    scheduler = make_scheduler(config)
+    leases = make_lease_manager(config)
+    if args.watch:
+        try:
+            watch_runs(data_dir, proj_dir_regex, extra_dirs, file_types, config,
+                       scheduler=scheduler, leases=leases)
+        finally:
+            if leases is not None:
+                leases.close()
+        return
+
     project_dirs = get_project_dirs(data_dir, proj_dir_regex)
     project_dirs = project_dirs + extra_dirs if extra_dirs else project_dirs
-    for proj_dir in project_dirs:
-        archive_runs_if_complete(data_dir, proj_dir, file_types, config)
+    project_runs = discover_runs(data_dir, project_dirs, config.get('discovery_workers', 1))
+    for proj_dir, runs in zip(project_dirs, project_runs):
+        archive_runs_if_complete(data_dir, proj_dir, file_types, config, scheduler, leases, runs)
+    if scheduler is not None:
+        scheduler.wait()
+    if leases is not None:
+        leases.close()
 
     logging.info('Done!')
 
@@ -0,0 +1,386 @@
+'''
+Module      : benchmark_auto_archive
+Description : Benchmarks for the auto_archive program.
+License     : TBD
+Portability : POSIX
+Builds synthetic runs in a temporary directory and times
+auto_archive stages against their previous implementations.
+
+Usage:
+
+python benchmark_auto_archive.py checksums --files 20000 --size 4096
+python benchmark_auto_archive.py scheduler --runs 8 --max-threads 8
+python benchmark_auto_archive.py discovery --runs 2000 --latency-ms 2 --workers 1 16
+python benchmark_auto_archive.py stages --files 1000 --size-dist lognormal:4M:0.5 --output new.json
+
+Stages results are written in the same format as the workflow's
+(.test/benchmark_workflow.py), which compares two results files.
+'''
+import os
+import sys
+import glob
+import time
+import random
+import shutil
+import logging
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+import auto_archive as aa
+
+# the synthetic data generator and results format are shared with the workflow
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '.test'))
+import benchmark_workflow as bw
+
+def parse_args(args):
+    '''
+    Parse command line arguments
+    '''
+    parser = ArgumentParser(description='Benchmark auto_archive stages.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    checksums = subparsers.add_parser('checksums',
+                                      help='Per-file shasum subprocesses vs. checksum engine, '
+                                           'and a re-run using the checksum cache.')
+    checksums.add_argument('--files', type=int, default=5000,
+                           help='Number of files in the synthetic run.')
+    checksums.add_argument('--size', type=int, default=4096,
+                           help='Size of each file in bytes.')
+    checksums.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                           help='Checksum worker counts to benchmark.')
+
+    scheduler = subparsers.add_parser('scheduler',
+                                      help='Sequential archiving vs. concurrent scheduler.')
+    scheduler.add_argument('--runs', type=int, default=8,
+                           help='Number of synthetic runs.')
+    scheduler.add_argument('--files', type=int, default=200,
+                           help='Number of files per run.')
+    scheduler.add_argument('--size', type=int, default=256 * 1024,
+                           help='Size of each file in bytes.')
+    scheduler.add_argument('--threads', type=int, default=1,
+                           help='Threads per archive job (> 1 requires pigz).')
+    scheduler.add_argument('--max-threads', type=int, default=os.cpu_count(),
+                           help='Global thread budget for the scheduler.')
+    scheduler.add_argument('--io-jobs', type=int, default=4,
+                           help='Concurrent jobs per filesystem.')
+
+    discovery = subparsers.add_parser('discovery',
+                                      help='Serial vs. concurrent scans for finished runs.')
+    discovery.add_argument('--runs', type=int, default=2000,
+                           help='Number of finished runs in the synthetic data directory.')
+    discovery.add_argument('--latency-ms', type=float, default=2,
+                           help='Latency added to each metadata call (stat, listing), '
+                                'as on a network filesystem.')
+    discovery.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16],
+                           help='Discovery worker counts to benchmark.')
+
+    stages = subparsers.add_parser('stages',
+                                   help='Time of each archiving stage on one synthetic run.')
+    bw.add_data_arguments(stages)
+    stages.add_argument('--threads', type=int, default=1,
+                        help='Threads per archive (> 1 requires pigz).')
+    stages.add_argument('--checksum-workers', type=int, default=4,
+                        help='Checksum worker threads.')
+    stages.add_argument('--codec', action='append', default=[], metavar='TYPE=CODEC',
+                        help='Compression codec of a file type, e.g. fast5=zstd.')
+    stages.add_argument('--repeat', type=int, default=3,
+                        help='Number of runs; the median is reported.')
+    stages.add_argument('--output', help='JSON file to write the results to.')
+    return parser.parse_args(args)
+
+def make_synthetic_run(run_dir, n_files, file_size):
+    '''
+    Create a run directory containing n_files of
+    random data split over the usual subdirectories
+    '''
+    subdirs = ['fastq_pass', 'fastq_fail', 'fast5_pass', 'fast5_fail']
+    for subdir in subdirs:
+        os.makedirs(os.path.join(run_dir, subdir), exist_ok=True)
+    data = random.randbytes(file_size) if file_size else b''
+    for i in range(n_files):
+        subdir = subdirs[i % len(subdirs)]
+        ext = 'fastq' if subdir.startswith('fastq') else 'fast5'
+        with open(os.path.join(run_dir, subdir, f'{i:08d}.{ext}'), 'wb') as fout:
+            fout.write(data)
+
+def subprocess_checksums(run_dir_full, checksum_file):
+    '''
+    Previous implementation: one shasum process per file
+    '''
+    with open(checksum_file, 'w') as cfile:
+        for file in aa.get_files(run_dir_full):
+            subprocess.run(['shasum', '-a', '1', file], stdout=cfile, check=True)
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    return time.perf_counter() - start
+
+def benchmark_checksums(args):
+    '''
+    Compare the per-file subprocess checksums with
+    the in-process checksum engine
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='aa_bench_')
+    try:
+        run_dir = os.path.join(tmp_dir, 'sample', 'run')
+        transfer_dir = os.path.join(tmp_dir, '_transfer')
+        make_synthetic_run(run_dir, args.files, args.size)
+        total_mb = args.files * args.size / 1e6
+
+        print(f'{args.files} files, {total_mb:.1f} MB')
+        print(f'{"method":<24}{"seconds":>10}{"files/s":>12}{"MB/s":>10}')
+
+        def report(name, seconds):
+            print(f'{name:<24}{seconds:>10.2f}{args.files / seconds:>12.0f}'
+                  f'{total_mb / seconds:>10.1f}')
+
+        baseline = os.path.join(tmp_dir, 'baseline.sha1')
+        report('shasum per file', timed(subprocess_checksums, run_dir, baseline))
+
+        for workers in args.workers:
+            checksum_filename = f'workers_{workers}.sha1'
+            seconds = timed(aa.calculate_checksums, run_dir, transfer_dir,
+                            checksum_filename, workers=workers)
+            os.remove(os.path.join(run_dir, 'run_checksums.success'))
+            report(f'engine ({workers} workers)', seconds)
+
+            # output must match shasum line for line
+            with open(baseline) as fin:
+                expected = sorted(fin)
+            with open(os.path.join(transfer_dir, 'checksums', checksum_filename)) as fin:
+                assert sorted(fin) == expected, 'checksum output differs from shasum'
+
+        # a run processed again: the first pass fills the cache,
+        # the second only checks that the files are unchanged
+        cache_dir = os.path.join(tmp_dir, 'checksum_cache')
+        workers = max(args.workers)
+        for name in ['engine, cold cache', 'engine, cached re-run']:
+            seconds = timed(aa.calculate_checksums, run_dir, transfer_dir, 'cached.sha1',
+                            workers=workers, cache_dir=cache_dir)
+            os.remove(os.path.join(run_dir, 'run_checksums.success'))
+            report(name, seconds)
+        with open(os.path.join(transfer_dir, 'checksums', 'cached.sha1')) as fin:
+            assert sorted(fin) == expected, 'cached checksum output differs from shasum'
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def reset_run(run_dir):
+    '''
+    Remove success markers so a run is archived again
+    '''
+    for success_file in glob.glob(os.path.join(run_dir, '*.success')):
+        os.remove(success_file)
+
+def benchmark_scheduler(args):
+    '''
+    Compare archiving runs one job at a time with the
+    concurrent scheduler under a global thread budget
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='aa_bench_')
+    try:
+        proj_dir = '20230101_wehi_lab_bench'
+        run_dirs = []
+        for i in range(args.runs):
+            run_dir = os.path.join(tmp_dir, proj_dir, f'sample_{i % 2}', f'run_{i:04d}')
+            make_synthetic_run(run_dir, args.files, args.size)
+            os.makedirs(os.path.join(run_dir, 'other_reports'))
+            open(os.path.join(run_dir, 'sequencing_summary_bench.txt'), 'w').close()
+            run_dirs.append(run_dir)
+        total_mb = args.runs * args.files * args.size / 1e6
+        file_types = ['reports', 'fastq', 'fast5']
+
+        print(f'{args.runs} runs, {total_mb:.1f} MB')
+        print(f'{"method":<32}{"seconds":>10}{"runs/s":>10}{"MB/s":>10}')
+        configs = [('sequential', 0),
+                   (f'scheduler ({args.max_threads} threads)', args.max_threads)]
+        for name, max_threads in configs:
+            config = {'transfer_dir': '_transfer',
+                      'time_delay': 0,
+                      'calculate_checksums': True,
+                      'checksum_workers': 1,
+                      'threads': args.threads,
+                      'max_threads': max_threads,
+                      'io_jobs_per_filesystem': args.io_jobs}
+            shutil.rmtree(os.path.join(tmp_dir, proj_dir, '_transfer'), ignore_errors=True)
+            for run_dir in run_dirs:
+                reset_run(run_dir)
+
+            start = time.perf_counter()
+            scheduler = aa.make_scheduler(config)
+            aa.archive_runs_if_complete(tmp_dir, proj_dir, file_types, config, scheduler)
+            if scheduler is not None:
+                scheduler.wait()
+            seconds = time.perf_counter() - start
+            print(f'{name:<32}{seconds:>10.2f}{args.runs / seconds:>10.2f}'
+                  f'{total_mb / seconds:>10.1f}')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+class SlowMetadataOS:
+    '''
+    Stands in for the os module (or os.path) of auto_archive,
+    adding latency seconds to each metadata call
+    '''
+    SLOW_CALLS = {'stat', 'lstat', 'scandir', 'listdir', 'isdir', 'exists', 'getctime'}
+
+    def __init__(self, latency, module=os):
+        self.latency = latency
+        self.module = module
+        if module is os:
+            self.path = SlowMetadataOS(latency, os.path)
+
+    def __getattr__(self, name):
+        attr = getattr(self.module, name)
+        if name not in self.SLOW_CALLS:
+            return attr
+        def slow_call(*args, **kwargs):
+            time.sleep(self.latency)
+            return attr(*args, **kwargs)
+        return slow_call
+
+def previous_discovery(data_dir, proj_dirs):
+    '''
+    Find finished runs as archive_runs_if_complete did before
+    discover_runs: a listing, isdir and ctime call at a time
+    '''
+    project_runs = []
+    for proj_dir in proj_dirs:
+        runs = []
+        for sample_dir in aa.os.listdir(os.path.join(data_dir, proj_dir)):
+            full_sample_dir = os.path.join(data_dir, proj_dir, sample_dir)
+            if not aa.os.path.isdir(full_sample_dir):
+                continue
+            for run_dir in aa.os.listdir(full_sample_dir):
+                run_dir_full = os.path.join(full_sample_dir, run_dir)
+                if not aa.os.path.isdir(run_dir_full):
+                    continue
+                eor_files = list(filter(aa.end_of_run_file_regex.match,
+                                        aa.os.listdir(run_dir_full)))
+                ctime = None
+                if eor_files:
+                    ctime = aa.os.path.getctime(os.path.join(run_dir_full, eor_files[0]))
+                runs.append((sample_dir, run_dir, ctime))
+        project_runs.append(runs)
+    return project_runs
+
+def benchmark_discovery(args):
+    '''
+    Compare scanning a data directory for finished runs one
+    metadata call at a time with concurrent scans, with a
+    latency added to each call
+    '''
+    tmp_dir = tempfile.mkdtemp(prefix='aa_bench_')
+    real_os = aa.os
+    try:
+        data_dir = os.path.join(tmp_dir, 'data')
+        bw.make_synthetic_data_dir(data_dir, args.runs, 0)
+        proj_dirs = sorted(os.listdir(data_dir))
+        aa.os = SlowMetadataOS(args.latency_ms / 1000)
+
+        print(f'{args.runs} runs in {len(proj_dirs)} projects, '
+              f'{args.latency_ms:g} ms per metadata call')
+        print(f'{"method":<32}{"seconds":>10}{"runs/s":>10}')
+        methods = [('previous (serial)', previous_discovery, ())]
+        methods += [(f'discover_runs ({workers} workers)', aa.discover_runs, (workers,))
+                    for workers in args.workers]
+        expected = None
+        for name, func, func_args in methods:
+            start = time.perf_counter()
+            project_runs = func(data_dir, proj_dirs, *func_args)
+            seconds = time.perf_counter() - start
+            finished = [run[:2] for runs in project_runs for run in runs if run[2] is not None]
+            if expected is None:
+                expected = finished
+            elif finished != expected:
+                raise RuntimeError(f'{name} found different runs.')
+            print(f'{name:<32}{seconds:>10.2f}{args.runs / seconds:>10.0f}')
+    finally:
+        aa.os = real_os
+        shutil.rmtree(tmp_dir)
+
+def get_size(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+def time_stages(run_dir, transfer_dir, file_types, compression, args):
+    '''
+    Archive a run one stage at a time, returning the time of
+    each stage. Listing and hashing the archives (as done when
+    validating them) are timed after the archives are made.
+    '''
+    stages = {}
+
+    def run_stage(name, n_bytes, func, *func_args, **kwargs):
+        stages[name] = {'jobs': 1, 'seconds': timed(func, *func_args, **kwargs),
+                        'bytes': n_bytes}
+
+    run_stage('checksums', get_size(aa.get_files(run_dir)), aa.calculate_checksums,
+              run_dir, transfer_dir, 'run_checksums.sha1', workers=args.checksum_workers)
+    for file_type in file_types:
+        sources = glob.glob(os.path.join(run_dir, f'{file_type}_*'))
+        if file_type == 'reports':
+            sources = glob.glob(os.path.join(run_dir, '*.*')) + [os.path.join(run_dir, 'other_reports')]
+        n_bytes = get_size(file for source in sources for file in
+                           (aa.get_files(source) if os.path.isdir(source) else [source]))
+        run_stage(f'archive_{file_type}', n_bytes, aa.make_archive,
+                  run_dir, transfer_dir, file_type, args.threads, compression)
+
+    archives = sorted(glob.glob(os.path.join(transfer_dir, '*', '*', '*.tar*')))
+
+    def list_archives():
+        for archive in archives:
+            aa.list_archive(archive, 'zstd' if archive.endswith('.tar.zst') else None)
+
+    run_stage('list', get_size(archives), list_archives)
+    run_stage('archive_checksums', get_size(archives),
+              lambda: list(aa.iter_checksums(archives, args.checksum_workers)))
+    stages['archive_checksums']['jobs'] = stages['list']['jobs'] = len(archives)
+    return stages
+
+def benchmark_stages(args):
+    '''
+    Time each archiving stage of auto_archive on a run
+    made by the test data generator
+    '''
+    compression = dict(codec.split('=', 1) for codec in args.codec)
+    file_types = ['reports', 'fastq', 'fast5']
+    tmp_dir = tempfile.mkdtemp(prefix='aa_bench_')
+    try:
+        run_dir = os.path.join(tmp_dir, 'sample', '20230101_1111_2F_PAK1234_0bench0')
+        transfer_dir = os.path.join(tmp_dir, '_transfer')
+        n_files, n_bytes = bw.make_synthetic_run(
+            run_dir, args, ['fastq_pass', 'fastq_fail', 'fast5_pass', 'fast5_fail', 'other_reports'])
+
+        wall_times, repeats = [], []
+        for _ in range(args.repeat):
+            shutil.rmtree(transfer_dir, ignore_errors=True)
+            reset_run(run_dir)
+            start = time.perf_counter()
+            repeats.append(time_stages(run_dir, transfer_dir, file_types, compression, args))
+            wall_times.append(time.perf_counter() - start)
+
+        stages = bw.summarise_repeats(repeats)
+        for name, stage in stages.items():
+            stage['bytes'] = repeats[0][name]['bytes']
+        results = bw.make_results('auto_archive', args, n_files, n_bytes, wall_times, stages)
+        bw.write_results(results, args.output)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def main():
+    '''
+    Main function
+    '''
+    logging.disable(logging.CRITICAL)
+    args = parse_args(sys.argv[1:])
+    if args.benchmark == 'checksums':
+        benchmark_checksums(args)
+    elif args.benchmark == 'scheduler':
+        benchmark_scheduler(args)
+    elif args.benchmark == 'discovery':
+        benchmark_discovery(args)
+    elif args.benchmark == 'stages':
+        benchmark_stages(args)
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,19 @@ Generates a new set of test files for each run.
 '''
 import pytest
 import auto_archive as aa
+import io_throttle
+import transfer_coordinator as tc
+import run_lease
 import os
 import random
 import shutil
 import glob
+import threading
+import time
+import hashlib
+import signal
+import multiprocessing
+import json
 
 def get_random_hexstring(magnitude):
     return hex(round(random.random() * magnitude))[2:]
@@ -80,6 +89,27 @@ def test_calculate_checksums():
         checksum_contents.append(line)
     len(checksum_contents) == 6
 
+def test_calculate_checksums_workers():
+    run_dir = os.listdir('test/20221208_wehi_bowden_runb/sample_b')[0]
+    run_dir_full = f'test/20221208_wehi_bowden_runb/sample_b/{run_dir}'
+    contents = b'@read\nACGT\n+\n!!!!\n'
+    with open(os.path.join(run_dir_full, 'fastq_pass', 'data.fastq'), 'wb') as f:
+        f.write(contents)
+    aa.calculate_checksums(run_dir_full,
+                           'test/20221208_wehi_bowden_runb/_transfer',
+                           'workers_checksums.sha1',
+                           workers=4)
+    checksum_file = 'test/20221208_wehi_bowden_runb/_transfer/checksums/workers_checksums.sha1'
+    with open(checksum_file, 'r') as f:
+        checksum_contents = f.readlines()
+
+    files = sorted(aa.get_files(run_dir_full))
+    files = [file for file in files if not file.endswith('.success')]
+    assert [line.split('  ', 1)[1].strip() for line in checksum_contents] == files
+    expected_line = f'{hashlib.sha1(contents).hexdigest()}  {run_dir_full}/fastq_pass/data.fastq\n'
+    assert expected_line in checksum_contents
+    assert os.path.exists(os.path.join(run_dir_full, f'{run_dir}_checksums.success'))
+
 def test_make_archive():
     project_dirs = aa.get_project_dirs('test', proj_dir_regex)
     project_dirs_truth = ['20221208_wehi_bowden_runa',
@@ -146,5 +176,595 @@ def test_archive_runs_if_complete():
     assert len(fastq_tar) == 1
     assert len(report_tar) == 1
 
+@pytest.mark.skipif(shutil.which('zstd') is None, reason='requires zstd')
+def test_make_archive_compression():
+    compression = {'fastq': {'codec': 'zstd', 'level': 3},
+                   'fast5': 'none',
+                   'reports': 'auto'}
+    proj_dir = '20221211_wehi_bowden_codec'
+    runhex = get_random_hexstring(1e8)
+    basedir = f'test/{proj_dir}/sample_a/{date}_1111_2F_{flowcellid}_{runhex}'
+    make_run(basedir, subdirs, flowcellid, runhex, True)
+    with open(os.path.join(basedir, 'other_reports', 'report.txt'), 'w') as f:
+        f.write('pore_activity\tstrand\n' * 10000)
+    with open(os.path.join(basedir, 'fast5_pass', 'random.fast5'), 'wb') as f:
+        f.write(random.randbytes(100000))
+
+    for file_type in file_types:
+        aa.make_archive(basedir, f'test/{proj_dir}/_transfer', file_type, 2, compression)
+
+    transfer_dir = f'test/{proj_dir}/_transfer'
+    assert len(glob.glob(f'{transfer_dir}/fastq/sample_a/*_fastq.tar.zst')) == 1
+    assert len(glob.glob(f'{transfer_dir}/fast5/sample_a/*_fast5.tar')) == 1
+    assert len(glob.glob(f'{transfer_dir}/reports/sample_a/*_reports.tar.gz')) == 1
+
+    # auto codec stores incompressible data uncompressed
+    assert aa.choose_auto_codec(basedir, ['fast5_pass']) == 'none'
+    assert aa.choose_auto_codec(basedir, ['other_reports']) == 'pigz'
+    with pytest.raises(ValueError):
+        aa.get_compression({'fastq': 'lzma'}, 'fastq')
+
+def test_archive_metrics(caplog):
+    config = {'transfer_dir': '_transfer',
+              'time_delay': 0,
+              'calculate_checksums': True,
+              'threads': 1,
+              'metrics_dir': 'test/metrics'}
+    proj_dir = '20221212_wehi_bowden_metrics'
+    runhex = get_random_hexstring(1e8)
+    basedir = f'test/{proj_dir}/sample_a/{date}_1111_2F_{flowcellid}_{runhex}'
+    make_run(basedir, subdirs, flowcellid, runhex, True)
+    for i in range(20):
+        with open(os.path.join(basedir, 'fastq_pass', f'{i}.fastq'), 'wb') as f:
+            f.write(b'@read\nACGT\n+\n!!!!\n' * (i + 1))
+
+    with caplog.at_level('INFO'):
+        aa.archive_runs_if_complete('test', proj_dir, file_types, config)
+
+    with open('test/metrics/jobs.jsonl') as f:
+        records = [json.loads(line) for line in f]
+    by_stage = {(record['stage'], record['labels'].get('file_type')): record for record in records}
+    assert set(by_stage) == {('checksums', None), ('archive', 'reports'),
+                             ('archive', 'fastq'), ('archive', 'fast5')}
+    fastq = by_stage[('archive', 'fastq')]
+    assert fastq['status'] == 'ok'
+    assert fastq['files'] == 22
+    assert fastq['bytes_read'] == sum(18 * (i + 1) for i in range(20))
+    assert fastq['bytes_written'] == os.path.getsize(
+        glob.glob(f'test/{proj_dir}/_transfer/fastq/sample_a/*_fastq.tar')[0])
+    assert by_stage[('checksums', None)]['files'] == 26
+    assert all(record['wall_seconds'] >= 0 and record['peak_rss_bytes'] > 0
+               for record in records)
+
+    with open('test/metrics/nanopore_archive.prom') as f:
+        prom = f.read()
+    assert 'nanopore_archive_jobs_total{stage="archive"} 3' in prom
+    assert 'nanopore_archive_jobs_total{stage="checksums"} 1' in prom
+
+    # files are not logged one by one, only a progress line per job
+    messages = [record.getMessage() for record in caplog.records]
+    assert not any(message.endswith('0.fastq') for message in messages)
+    assert any(message.startswith(f'{os.path.basename(basedir)}_fastq.tar: 22/22 files')
+               for message in messages)
+
+@pytest.mark.parametrize('codec', ['none', 'pigz'])
+def test_io_throttle(codec, caplog):
+    mb = 1024**2
+
+    # reads are paced to the maximum rate
+    throttle = io_throttle.IOThrottle(max_rate=8 * mb)
+    start = time.monotonic()
+    for _ in range(16):
+        throttle.wait(mb)
+    assert time.monotonic() - start >= 2 - io_throttle.BURST_SECONDS - 0.1
+
+    # the rate halves while the device is slow, then recovers to the maximum
+    stats = {'ios': 0, 'ms': 0}
+    read_stats = lambda: [stats['ios'], 0, 0, stats['ms'], 0, 0, 0, 0, 0, 0, 0]
+    throttle = io_throttle.IOThrottle(max_rate=100 * mb, max_latency_ms=10,
+                                     read_stats=read_stats)
+    now = throttle._sample_time
+    stats.update(ios=100, ms=5000)
+    throttle.bytes = 50 * mb
+    throttle._adapt(now + 1)
+    assert throttle.rate == 25 * mb and throttle.backoffs == 1
+    for i in range(2, 20):
+        stats['ios'] += 100
+        stats['ms'] += 100
+        throttle._adapt(now + i)
+    assert throttle.rate == 100 * mb and throttle.backoffs == 1
+
+    # throttled archives are complete
+    proj_dir = f'20221213_wehi_bowden_throttle_{codec}'
+    runhex = get_random_hexstring(1e8)
+    basedir = f'test/{proj_dir}/sample_a/{date}_1111_2F_{flowcellid}_{runhex}'
+    make_run(basedir, subdirs, flowcellid, runhex, True)
+    with open(os.path.join(basedir, 'fast5_pass', 'random.fast5'), 'wb') as f:
+        f.write(random.randbytes(4 * mb))
+    throttle_config = {'max_rate': '16M', 'max_latency_ms': 1000}
+    with caplog.at_level('INFO'):
+        aa.make_archive(basedir, f'test/{proj_dir}/_transfer', 'fast5', 1, {'fast5': codec},
+                        io_throttle=throttle_config)
+    tar_file = glob.glob(f'test/{proj_dir}/_transfer/fast5/sample_a/*_fast5.tar*')[0]
+    assert sorted(aa.list_archive(tar_file, codec)) == \
+        sorted(aa.get_archive_members(basedir, ['fast5_pass', 'fast5_fail']))
+    assert any('Throttled reads' in record.getMessage() for record in caplog.records)
+
+def _crash_on_call(func, n_calls):
+    calls = [0]
+    def wrapper(*args, **kwargs):
+        calls[0] += 1
+        if calls[0] >= n_calls:
+            os._exit(1)
+        return func(*args, **kwargs)
+    return wrapper
+
+def _archive_with_crash(tar_file, files, run_dir, codec, segment_size, crash_point):
+    # runs in a forked child, so patching module attributes is safe
+    target, n_calls = crash_point
+    if target == 'fsync':
+        aa.os.fsync = _crash_on_call(aa.os.fsync, n_calls)
+    elif target == 'write':
+        aa._SegmentSink.write = _crash_on_call(aa._SegmentSink.write, n_calls)
+    aa.write_checkpointed_archive(tar_file, files, run_dir, codec, 1, None, segment_size)
+
+@pytest.mark.parametrize('codec', ['none', 'pigz'])
+def test_checkpointed_archive_resume(codec):
+    proj_dir = f'20221212_wehi_bowden_resume_{codec}'
+    runhex = get_random_hexstring(1e8)
+    basedir = f'test/{proj_dir}/sample_a/{date}_1111_2F_{flowcellid}_{runhex}'
+    make_run(basedir, subdirs, flowcellid, runhex, True)
+    for i in range(40):
+        subdir = 'fastq_pass' if i % 3 else 'fastq_fail'
+        with open(os.path.join(basedir, subdir, f'reads_{i:02d}.fastq'), 'wb') as f:
+            f.write(random.randbytes(random.randint(0, 3000)))
+    files = ['fastq_pass', 'fastq_fail']
+    segment_size = 4096
+
+    expected = os.path.abspath(f'test/{proj_dir}/expected.tar')
+    assert aa.write_checkpointed_archive(expected, files, basedir, codec, 1, None, segment_size) == 0
+
+    # kill the archiver at random points until an attempt completes
+    tar_file = os.path.abspath(f'test/{proj_dir}/resumed.tar')
+    ctx = multiprocessing.get_context('fork')
+    for _ in range(30):
+        crash_point = random.choice([('fsync', random.randint(1, 25)),
+                                     ('write', random.randint(1, 150)),
+                                     ('signal', random.uniform(0, 0.05))])
+        proc = ctx.Process(target=_archive_with_crash,
+                           args=(tar_file, files, basedir, codec, segment_size, crash_point))
+        proc.start()
+        if crash_point[0] == 'signal':
+            time.sleep(crash_point[1])
+            os.kill(proc.pid, signal.SIGKILL)
+        proc.join()
+        if os.path.exists(tar_file):
+            break
+        # sometimes leave a torn record at the end of the journal
+        if os.path.exists(f'{tar_file}.journal') and random.random() < 0.3:
+            with open(f'{tar_file}.journal', 'a') as journal:
+                journal.write('{"segment": ')
+
+    # resume through run_tar, which should complete the archive
+    if not os.path.exists(tar_file):
+        aa.run_tar(tar_file, files, basedir, 'fastq', codec=codec, segment_size=segment_size)
+        assert os.path.exists(os.path.join(basedir, f'{os.path.basename(basedir)}_fastq_archive.success'))
+    assert not os.path.exists(f'{tar_file}.partial')
+    assert not os.path.exists(f'{tar_file}.journal')
+    with open(expected, 'rb') as f1, open(tar_file, 'rb') as f2:
+        assert f1.read() == f2.read()
+    assert aa.list_archive(tar_file, codec) == list(aa.get_archive_members(basedir, files))
+
+def test_checksum_cache(monkeypatch):
+    proj_dir = '20221212_wehi_bowden_cache'
+    runhex = get_random_hexstring(1e8)
+    run_dir = f'{date}_1111_2F_{flowcellid}_{runhex}'
+    run_dir_full = f'test/{proj_dir}/sample_a/{run_dir}'
+    make_run(run_dir_full, subdirs, flowcellid, runhex, True)
+    transfer_dir = f'test/{proj_dir}/_transfer'
+    cache_dir = f'test/{proj_dir}/checksum_cache'
+    checksum_file = f'{transfer_dir}/checksums/cache_checksums.sha1'
+
+    hashed = []
+    sha1_file = aa.sha1_file
+    def counting_sha1_file(file, throttle=None):
+        hashed.append(file)
+        return sha1_file(file, throttle)
+    monkeypatch.setattr(aa, 'sha1_file', counting_sha1_file)
+
+    def process_again():
+        hashed.clear()
+        os.remove(os.path.join(run_dir_full, f'{run_dir}_checksums.success'))
+        aa.calculate_checksums(run_dir_full, transfer_dir, 'cache_checksums.sha1',
+                               workers=2, cache_dir=cache_dir)
+
+    aa.calculate_checksums(run_dir_full, transfer_dir, 'cache_checksums.sha1',
+                           workers=2, cache_dir=cache_dir)
+    files = sorted(file for file in aa.get_files(run_dir_full) if not file.endswith('.success'))
+    assert sorted(hashed) == files
+    with open(checksum_file) as f:
+        first = f.readlines()
+
+    # nothing is hashed again, and the checksum file is not appended to
+    process_again()
+    assert hashed == []
+    with open(checksum_file) as f:
+        assert f.readlines() == first
+
+    # only new and changed files are hashed
+    changed = os.path.join(run_dir_full, 'fastq_pass', 'changed.fastq')
+    with open(changed, 'wb') as f:
+        f.write(b'@read\nACGT\n+\n!!!!\n')
+    process_again()
+    assert hashed == [changed]
+    with open(changed, 'ab') as f:
+        f.write(b'@read\nACGT\n+\n!!!!\n')
+    process_again()
+    assert hashed == [changed]
+    with open(checksum_file) as f:
+        lines = f.readlines()
+    assert len(lines) == len(first) + 1
+    assert lines == sorted(lines, key=lambda line: line.split('  ', 1)[1])
+    assert f'{hashlib.sha1(open(changed, "rb").read()).hexdigest()}  {changed}\n' in lines
+
+def test_archive_scheduler():
+    config = {'transfer_dir': '_transfer',
+              'time_delay': 0,
+              'calculate_checksums': True,
+              'threads': 1,
+              'checksum_workers': 2,
+              'max_threads': 3,
+              'io_jobs_per_filesystem': 2}
+    proj_dir = '20221210_wehi_bowden_sched'
+    run_dirs = []
+    for sample in samples:
+        for _ in range(2):
+            runhex = get_random_hexstring(1e8)
+            basedir = f'test/{proj_dir}/{sample}/{date}_1111_2F_{flowcellid}_{runhex}'
+            make_run(basedir, subdirs, flowcellid, runhex, True)
+            run_dirs.append(basedir)
+
+    scheduler = aa.make_scheduler(config)
+    aa.archive_runs_if_complete('test', proj_dir, file_types, config, scheduler)
+    scheduler.wait()
+
+    assert scheduler.threads_available == config['max_threads']
+    for basedir in run_dirs:
+        run_dir = os.path.basename(basedir)
+        for file_type in file_types:
+            assert os.path.exists(os.path.join(basedir, f'{run_dir}_{file_type}_archive.success'))
+        assert os.path.exists(os.path.join(basedir, f'{run_dir}_checksums.success'))
+    for sample in samples:
+        assert len(glob.glob(f'test/{proj_dir}/_transfer/fastq/{sample}/*_fastq.tar')) == 2
+        assert len(glob.glob(f'test/{proj_dir}/_transfer/fast5/{sample}/*_fast5.tar.gz')) == 2
+
+@pytest.mark.parametrize('use_inotify', [True, False])
+def test_watch_runs(use_inotify):
+    config = {'transfer_dir': '_transfer',
+              'time_delay': 0,
+              'calculate_checksums': True,
+              'threads': 1,
+              'watch_poll_interval': 0.1,
+              'watch_use_inotify': use_inotify}
+    proj_dir = f'20221209_wehi_bowden_watch{int(use_inotify)}'
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=aa.watch_runs,
+                               args=('test', proj_dir_regex, [], ['fastq'], config),
+                               kwargs={'stop_event': stop_event, 'max_sleep': 0.1})
+    watcher.start()
+    try:
+        # run appears while the watcher is running, then finishes
+        runhex = get_random_hexstring(1e8)
+        basedir = f'test/{proj_dir}/sample_a/{date}_1111_2F_{flowcellid}_{runhex}'
+        make_run(basedir, subdirs, flowcellid, runhex, False)
+        time.sleep(0.5)
+        assert not glob.glob(f'test/{proj_dir}/_transfer/fastq/sample_a/*_fastq.tar')
+
+        open(os.path.join(basedir, f'sequencing_summary_{flowcellid}_{runhex}.txt'), 'w').close()
+        for _ in range(100):
+            if os.path.exists(os.path.join(basedir, f'{os.path.basename(basedir)}_fastq_archive.success')):
+                break
+            time.sleep(0.1)
+    finally:
+        stop_event.set()
+        watcher.join()
+
+    assert len(glob.glob(f'test/{proj_dir}/_transfer/fastq/sample_a/*_fastq.tar')) == 1
+    assert len(glob.glob(f'test/{proj_dir}/_transfer/checksums/*_checksums.sha1')) == 1
+
+def _hold_lease(lease_dir, name):
+    # runs in a forked child that holds (and renews) a lease until killed
+    leases = aa.LeaseManager(lease_dir, duration=1, heartbeat=0.1)
+    assert leases.acquire(name)
+    while True:
+        time.sleep(1)
+
+def _archive_with_leases(proj_dir, config, log_file):
+    # runs in a forked child, so patching module attributes is safe
+    run_tar = aa.run_tar
+    def logged_run_tar(tar_file, *args, **kwargs):
+        run_dir = os.path.basename(tar_file).rsplit('_', 1)[0]
+        generation, = [generation for name, (generation, _) in leases.held.items()
+                       if name.endswith(f'__{run_dir}')]
+        with open(log_file, 'a') as f:
+            f.write(f'{os.getpid()} {generation} {tar_file}\n')
+        time.sleep(0.05)
+        return run_tar(tar_file, *args, **kwargs)
+    aa.run_tar = logged_run_tar
+    leases = aa.make_lease_manager(config)
+    scheduler = aa.make_scheduler(config)
+    aa.archive_runs_if_complete('test', proj_dir, file_types, config, scheduler, leases)
+    if scheduler is not None:
+        scheduler.wait()
+    leases.close()
+
+@pytest.mark.parametrize('max_threads', [0, 4])
+def test_lease_claiming(max_threads):
+    lease_dir = f'test/leases_{max_threads}'
+    # with a scheduler, each run's checksum and archive jobs are queued
+    # and run one at a time, each starting as the previous one finishes
+    config = {'transfer_dir': '_transfer',
+              'time_delay': 0,
+              'calculate_checksums': True,
+              'threads': 1,
+              'max_threads': max_threads,
+              'io_jobs_per_filesystem': 1,
+              'leases': {'lease_dir': lease_dir, 'duration': 1, 'heartbeat': 0.1}}
+    proj_dir = f'20221213_wehi_bowden_leases{max_threads}'
+    run_dirs = []
+    for sample in samples:
+        for _ in range(3):
+            runhex = get_random_hexstring(1e8)
+            basedir = f'test/{proj_dir}/{sample}/{date}_1111_2F_{flowcellid}_{runhex}'
+            make_run(basedir, subdirs, flowcellid, runhex, True)
+            run_dirs.append(basedir)
+    log_file = f'test/{proj_dir}/archived.txt'
+    ctx = multiprocessing.get_context('fork')
+
+    def archive_in_parallel(n_procs=4):
+        procs = [ctx.Process(target=_archive_with_leases, args=(proj_dir, config, log_file))
+                 for _ in range(n_procs)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+            assert proc.exitcode == 0
+
+    def archived():
+        if not os.path.exists(log_file):
+            return []
+        with open(log_file) as f:
+            return [os.path.basename(line.split()[2]) for line in f]
+
+    def archiving_claims():
+        # the claims (process and lease generation) each run's archives were made under
+        claims = {}
+        with open(log_file) as f:
+            for line in f:
+                pid, generation, tar_file = line.split()
+                run_dir = os.path.basename(tar_file).rsplit('_', 1)[0]
+                claims.setdefault(run_dir, set()).add((pid, generation))
+        return claims
+
+    # a live worker's claim is respected
+    claimed = aa.get_lease_name(run_dirs[0])
+    holder = ctx.Process(target=_hold_lease, args=(lease_dir, claimed), daemon=True)
+    holder.start()
+    for _ in range(50):
+        if os.path.exists(os.path.join(lease_dir, f'{claimed}.0.lease')):
+            break
+        time.sleep(0.1)
+    time.sleep(1.5)
+    archive_in_parallel()
+    expected = sorted(f'{os.path.basename(run_dir)}_{file_type}.{ext}'
+                      for run_dir in run_dirs[1:]
+                      for file_type, ext in [('reports', 'tar.gz'), ('fastq', 'tar'),
+                                             ('fast5', 'tar.gz')])
+    assert sorted(archived()) == expected
+
+    # once it crashes, its lease expires and the run is taken over
+    os.kill(holder.pid, signal.SIGKILL)
+    holder.join()
+    time.sleep(1.5)
+    archive_in_parallel()
+    expected += [f'{os.path.basename(run_dirs[0])}_{file_type}.{ext}'
+                 for file_type, ext in [('reports', 'tar.gz'), ('fastq', 'tar'),
+                                        ('fast5', 'tar.gz')]]
+    assert sorted(archived()) == sorted(expected)
+    # all of a run's jobs are run under a single claim of the run
+    assert all(len(claims) == 1 for claims in archiving_claims().values())
+    for basedir in run_dirs:
+        run_dir = os.path.basename(basedir)
+        assert os.path.exists(os.path.join(basedir, f'{run_dir}_checksums.success'))
+        with open(f'test/{proj_dir}/_transfer/checksums/{run_dir}_checksums.sha1') as f:
+            lines = f.readlines()
+        assert lines and len(lines) == len(set(lines))
+    # released leases are kept (empty), so that their generations are not reused
+    for lease in os.listdir(lease_dir):
+        assert os.path.getsize(os.path.join(lease_dir, lease)) == 0
+
+def test_stale_lease_holder():
+    lease_dir = 'test/stale_leases'
+    holders = [aa.LeaseManager(lease_dir, duration=0.2, heartbeat=60) for _ in range(3)]
+    stale, other, current = holders
+    assert stale.acquire('run')
+    # the first holder stalls past its lease, which is then
+    # taken over, released and claimed again
+    time.sleep(0.3)
+    assert other.acquire('run')
+    other.release('run')
+    assert current.acquire('run')
+    assert current.is_held('run')
+    assert not stale.is_held('run')
+    stale.renew()
+    assert 'run' not in stale.held
+    for holder in holders:
+        holder.close()
+    assert current.acquire('run')
+    current.close()
+
+def test_check_lease_held(monkeypatch):
+    lease_dir = 'test/job_leases'
+    holder = run_lease.LeaseManager(lease_dir, duration=0.2, heartbeat=60)
+    assert holder.acquire('run')
+    # a job started by the holder checks the lease it was passed
+    monkeypatch.setenv(run_lease.LEASE_OWNER_ENV, holder.owner)
+    run_lease.check_lease_held(lease_dir, 'run')
+    run_lease.check_lease_held('', 'other_run')
+    with pytest.raises(run_lease.LeaseLostError):
+        run_lease.check_lease_held(lease_dir, 'other_run')
+    # once the lease is taken over, the job fails
+    time.sleep(0.3)
+    other = run_lease.LeaseManager(lease_dir, duration=0.2, heartbeat=60)
+    assert other.acquire('run')
+    with pytest.raises(run_lease.LeaseLostError):
+        run_lease.check_lease_held(lease_dir, 'run')
+    monkeypatch.setenv(run_lease.LEASE_OWNER_ENV, other.owner)
+    run_lease.check_lease_held(lease_dir, 'run')
+    # without an owner (e.g. leases unused by the workflow) nothing is checked
+    monkeypatch.delenv(run_lease.LEASE_OWNER_ENV)
+    run_lease.check_lease_held(lease_dir, 'other_run')
+    holder.close()
+    other.close()
+
+def _serial_discovery(data_dir, proj_dirs, before_run_scan):
+    # one listing, isdir and ctime call at a time, as before discover_runs
+    project_runs = []
+    for proj_dir in proj_dirs:
+        runs = []
+        for sample_dir in os.listdir(os.path.join(data_dir, proj_dir)):
+            sample_dir_full = os.path.join(data_dir, proj_dir, sample_dir)
+            if not os.path.isdir(sample_dir_full):
+                continue
+            for run_dir in os.listdir(sample_dir_full):
+                run_dir_full = os.path.join(sample_dir_full, run_dir)
+                if not os.path.isdir(run_dir_full):
+                    continue
+                before_run_scan(run_dir_full)
+                ctime = None
+                if os.path.isdir(run_dir_full):
+                    eor_files = list(filter(aa.end_of_run_file_regex.match,
+                                            os.listdir(run_dir_full)))
+                    if eor_files:
+                        ctime = os.path.getctime(os.path.join(run_dir_full, eor_files[0]))
+                runs.append((sample_dir, run_dir, ctime))
+        project_runs.append(runs)
+    return project_runs
+
+def test_discover_runs(monkeypatch):
+    data_dir = 'test/discovery'
+    proj_dirs = [f'2022121{i}_wehi_bowden_disc{i}' for i in range(3)]
+    for i, proj_dir in enumerate(proj_dirs):
+        for sample in samples:
+            for j in range(4):
+                runhex = f'{i}{j}{get_random_hexstring(1e6)}'
+                basedir = f'{data_dir}/{proj_dir}/{sample}/{date}_1111_2F_{flowcellid}_{runhex}'
+                # every third run is still sequencing
+                make_run(basedir, subdirs, flowcellid, runhex, (i + j) % 3 != 0)
+            # files next to samples and runs are skipped
+            open(f'{data_dir}/{proj_dir}/{sample}/notes.txt', 'w').close()
+        open(f'{data_dir}/{proj_dir}/samplesheet.csv', 'w').close()
+    # a finished run (i = 1, j = 1)
+    vanishing = glob.glob(f'{data_dir}/{proj_dirs[1]}/{samples[0]}/*_{flowcellid}_11*')[0]
+
+    def vanish(path):
+        # the run is deleted between its sample's listing and its own scan
+        if os.path.normpath(path) == os.path.normpath(vanishing) and os.path.exists(path):
+            os.rename(vanishing, f'{data_dir}/vanished')
+
+    def restore():
+        if os.path.exists(f'{data_dir}/vanished'):
+            os.rename(f'{data_dir}/vanished', vanishing)
+
+    scan_dir = aa.scan_dir
+    def vanishing_scan_dir(path):
+        vanish(path)
+        return scan_dir(path)
+    monkeypatch.setattr(aa, 'scan_dir', vanishing_scan_dir)
+
+    expected = _serial_discovery(data_dir, proj_dirs, vanish)
+    restore()
+    finished = [run for runs in expected for run in runs if run[2] is not None]
+    assert len(finished) == 15 and len(sum(expected, [])) == 24
+    assert (samples[0], os.path.basename(vanishing), None) in expected[1]
+    for workers in [1, 8]:
+        assert aa.discover_runs(data_dir, proj_dirs, workers) == expected
+        restore()
+
+class SlowTransferClient(tc.LocalTransferClient):
+    '''
+    Local transfer client whose copies take a while, counting
+    how many are running at once
+    '''
+    def __init__(self, fail_pattern=None):
+        super().__init__(fail_pattern=fail_pattern)
+        self.running = 0
+        self.max_running = 0
+        self.counter_lock = threading.Lock()
+
+    def _copy(self, items):
+        with self.counter_lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(0.2)
+            super()._copy(items)
+        finally:
+            with self.counter_lock:
+                self.running -= 1
+
+def _make_transfer_runs(transfer_dir, names):
+    run_transfers = []
+    for name in names:
+        source = os.path.join(transfer_dir, 'src', name)
+        os.makedirs(source)
+        with open(os.path.join(source, 'run_pod5.tar.gz'), 'w') as handle:
+            handle.write(name)
+        run_transfers.append(tc.RunTransfer(name, source, os.path.join(transfer_dir, 'dest', name)))
+    return run_transfers
+
+def test_transfer_coordinator_failed_task():
+    transfer_dir = 'test/transfer_failed'
+    marker_dir = os.path.join(transfer_dir, 'markers')
+    os.makedirs(marker_dir)
+    run_transfers = _make_transfer_runs(transfer_dir, ['run1', 'run2', 'run3_bad', 'run4', 'run5'])
+    client = tc.LocalTransferClient(fail_pattern='_bad')
+    coordinator = tc.TransferCoordinator(client, batch_size=2, max_in_flight=2, poll_interval=0.05,
+                                         delete=True, slots=tc.TaskSlots(f'{transfer_dir}/slots', 2))
+
+    def on_success(run, batch):
+        open(os.path.join(marker_dir, f'{run.name}.transferred'), 'w').close()
+
+    batches = coordinator.run(run_transfers, on_success)
+
+    assert [batch['status'] for batch in batches] == ['ok', 'failed', 'ok']
+    assert sorted(os.listdir(marker_dir)) == ['run1.transferred', 'run2.transferred', 'run5.transferred']
+    # the failed batch is neither confirmed nor deleted from the source
+    assert 'delete' not in batches[1]['tasks']
+    assert sorted(os.listdir(f'{transfer_dir}/src')) == ['run3_bad', 'run4']
+    assert client.max_seen_active <= 2
+
+def test_transfer_coordinator_max_in_flight():
+    transfer_dir = 'test/transfer_in_flight'
+    names = [f'run{i}' for i in range(8)]
+    run_transfers = _make_transfer_runs(transfer_dir, names)
+    client = SlowTransferClient()
+    confirmed = []
+
+    # two coordinators (e.g. two transfer jobs) share two task slots
+    def coordinate(runs, label):
+        coordinator = tc.TransferCoordinator(client, batch_size=1, max_in_flight=2, poll_interval=0.05,
+                                             slots=tc.TaskSlots(f'{transfer_dir}/slots', 2), label=label)
+        coordinator.run(runs, lambda run, batch: confirmed.append(run.name))
 
+    threads = [threading.Thread(target=coordinate, args=(run_transfers[:4], 'first')),
+               threading.Thread(target=coordinate, args=(run_transfers[4:], 'second'))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
+    assert sorted(confirmed) == names
+    assert sorted(os.listdir(f'{transfer_dir}/dest')) == names
+    assert client.max_running <= 2
+    assert client.max_seen_active <= 2
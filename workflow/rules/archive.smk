@@ -1,9 +1,17 @@
+wildcard_constraints:
+    project="[^/]+",
+    sample="[^/]+",
+    run="[^/]+",
+    run_uid="[^_/]+",
+    state="|".join(STATES),
+    shard=r"\d+",
+    barcode=r"barcode\d+",
+
+
 rule calculate_checksums:
     input:
-        [
-            f"{data_dir}/{project}/{sample}/{run}"
-            for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid)
-        ],
+        run=f"{data_dir}/{{project}}/{{sample}}/{{run}}",
+        parts=get_checksum_parts,
     output:
         expand(
             "{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/{{project}}_{{sample}}_{{run_uid}}_checksums.sha1",
@@ -17,19 +25,16 @@ rule calculate_checksums:
     threads: 1
     params:
         data_dir=data_dir,
-        run=run,
-        project=project,
-        sample=sample,
-    shell:
-        """
-        cd {params.data_dir}/{wildcards.project} &&
-            find {wildcards.sample}/{wildcards.run}/* -type f | xargs shasum -a 1 > {output}
-        """
+        metrics_dir=metrics_dir,
+        io_throttle=io_throttle,
+        checksum_cache_dir=checksum_cache_dir,
+    script:
+        "../scripts/calculate_checksums.py"
 
 
 rule calculate_archive_checksums:
     input:
-        get_outputs(file_types),
+        get_archive_checksum_parts,
     output:
         expand(
             "{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/{{project}}_{{sample}}_{{run_uid}}_archives.sha1",
@@ -39,152 +44,329 @@ rule calculate_archive_checksums:
     log:
         "logs/{project}_{sample}_{run}_{run_uid}_archive_checksums.log",
     threads: 1
-    params:
-        data_dir=data_dir,
-        transfer_dir=transfer_dir,
     shell:
         """
-        cd {params.data_dir}/{wildcards.project}/{params.transfer_dir}_{wildcards.sample}_{wildcards.run} &&
-            find . -type f -iname "*tar*" | xargs shasum -a 1 > {output}
+        cat {input} /dev/null > {output}
         """
 
 
-if "pod5" in file_types:
-    for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid):
+# NOTE: archives are written by tar_archive.py, which reads each source
+# file once to calculate its checksum, archive and compress it, and also
+# produces the member list and archive checksum during the same pass.
+# There is one rule per kind of archive, and the codec of each file type
+# is taken from the compression config (see get_archive_extension).
+# Snakemake requires all outputs of a rule to have the same wildcards, so
+# the extension cannot be a wildcard while the member list's name has no
+# extension; the data file types archived by state (or barcode) are
+# therefore split by extension, each set with its own rule named after
+# its file types. If shard_size is set, data archives are split into
+# shards, each built by its own job from the plan_shards checkpoint. With split_by_barcode, each barcode
+# directory of a state (e.g. fastq_pass/barcode01) is archived by its own
+# job, and the state's archive holds the rest (e.g. unclassified)
+for rule_suffix, shard_suffix in [("", ""), ("_shard", "_shard{shard}")]:
+    # checksum parts of shards are kept, so that a
+    # failed shard can be redone without the others
+    part = (lambda path: path) if shard_suffix else temp
+    ext = get_archive_extension("pod5")
+
+    rule:
+        name:
+            f"tar_pod5{rule_suffix}"
+        input:
+            f"{data_dir}/{{project}}/{{sample}}/{{run}}",
+            **get_shard_plan_input(
+                f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/pod5/{{project}}_{{sample}}_{{run_uid}}_pod5",
+                shard_suffix,
+            ),
+        output:
+            tar=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/pod5/{{project}}_{{sample}}_{{run_uid}}_pod5{shard_suffix}.{ext}",
+            txt=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/pod5/{{project}}_{{sample}}_{{run_uid}}_pod5{shard_suffix}_list.txt",
+            summary=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/pod5/{{project}}_{{sample}}_{{run_uid}}_pod5{shard_suffix}_summary.json",
+            **get_index_output(
+                ext,
+                f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/pod5/{{project}}_{{sample}}_{{run_uid}}_pod5{shard_suffix}_index.json.gz",
+            ),
+            checksums=part(
+                f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/parts/{{project}}_{{sample}}_{{run_uid}}_pod5{shard_suffix}.{ext}_checksums.sha1"
+            ),
+            archive_checksum=part(
+                f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/parts/{{project}}_{{sample}}_{{run_uid}}_pod5{shard_suffix}.{ext}_archive.sha1"
+            ),
+        log:
+            f"logs/{{project}}_{{sample}}_{{run}}_{{run_uid}}_pod5{shard_suffix}_tar.log",
+        conda:
+            "../envs/archive.yaml"
+        threads: get_archive_threads(ext)
+        params:
+            data_dir=data_dir,
+            transfer_dir_full=get_transfer_dir_full,
+            project=lambda wildcards: wildcards.project,
+            sample=lambda wildcards: wildcards.sample,
+            run=lambda wildcards: wildcards.run,
+            run_uid=lambda wildcards: wildcards.run_uid,
+            sources=lambda wildcards: [f"{wildcards.sample}/{wildcards.run}/pod5"],
+            pattern=get_archive_pattern("pod5"),
+            codec=get_file_type_codec("pod5"),
+            level=get_archive_level("pod5"),
+            shard=(lambda wildcards: int(wildcards.shard)) if shard_suffix else None,
+            exclude=None,
+            copy_pattern=None,
+            seekable_block_size=seekable_block_size,
+            checksum_cache_dir=checksum_cache_dir,
+            metrics_dir=metrics_dir,
+            io_throttle=io_throttle,
+        script:
+            "../scripts/tar_archive.py"
+
+    for ext, ext_file_types in get_file_types_by_extension(STATE_FILE_TYPES).items():
+
+        rule:
+            name:
+                f"tar_by_state_{'_'.join(ext_file_types)}{rule_suffix}"
+            input:
+                f"{data_dir}/{{project}}/{{sample}}/{{run}}",
+                **get_shard_plan_input(
+                    f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}",
+                    shard_suffix,
+                ),
+            output:
+                tar=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}{shard_suffix}.{ext}",
+                txt=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}{shard_suffix}_list.txt",
+                summary=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}{shard_suffix}_summary.json",
+                **get_index_output(
+                    ext,
+                    f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}{shard_suffix}_index.json.gz",
+                ),
+                checksums=part(
+                    f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/parts/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}{shard_suffix}.{ext}_checksums.sha1"
+                ),
+                archive_checksum=part(
+                    f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/parts/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}{shard_suffix}.{ext}_archive.sha1"
+                ),
+            wildcard_constraints:
+                file_type="|".join(ext_file_types),
+            log:
+                f"logs/{{project}}_{{sample}}_{{run}}_{{run_uid}}_{{file_type}}_{{state}}{shard_suffix}_tar.log",
+            conda:
+                "../envs/archive.yaml"
+            threads: get_archive_threads(ext)
+            params:
+                data_dir=data_dir,
+                transfer_dir_full=get_transfer_dir_full,
+                project=lambda wildcards: wildcards.project,
+                sample=lambda wildcards: wildcards.sample,
+                run=lambda wildcards: wildcards.run,
+                run_uid=lambda wildcards: wildcards.run_uid,
+                sources=lambda wildcards: [
+                    f"{wildcards.sample}/{wildcards.run}/{wildcards.file_type}_{wildcards.state}"
+                ],
+                pattern=lambda wildcards: get_archive_pattern(wildcards.file_type),
+                codec=lambda wildcards: get_file_type_codec(wildcards.file_type),
+                level=lambda wildcards: get_archive_level(wildcards.file_type),
+                shard=(lambda wildcards: int(wildcards.shard)) if shard_suffix else None,
+                exclude=get_barcode_excludes,
+                copy_pattern=None,
+                seekable_block_size=seekable_block_size,
+                checksum_cache_dir=checksum_cache_dir,
+                metrics_dir=metrics_dir,
+                io_throttle=io_throttle,
+            script:
+                "../scripts/tar_archive.py"
 
         rule:
             name:
-                f"tar_{project}_{sample}_{run}_{run_uid}_pod5"
+                f"tar_by_barcode_{'_'.join(ext_file_types)}{rule_suffix}"
             input:
-                f"{data_dir}/{project}/{sample}/{run}",
+                f"{data_dir}/{{project}}/{{sample}}/{{run}}",
+                **get_shard_plan_input(
+                    f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}_{{barcode}}",
+                    shard_suffix,
+                ),
             output:
-                tar=f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/pod5/{project}_{sample}_{run_uid}_pod5.tar.gz",
-                txt=f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/pod5/{project}_{sample}_{run_uid}_pod5_list.txt",
+                tar=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}_{{barcode}}{shard_suffix}.{ext}",
+                txt=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}_{{barcode}}{shard_suffix}_list.txt",
+                summary=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}_{{barcode}}{shard_suffix}_summary.json",
+                **get_index_output(
+                    ext,
+                    f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}_{{barcode}}{shard_suffix}_index.json.gz",
+                ),
+                checksums=part(
+                    f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/parts/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}_{{barcode}}{shard_suffix}.{ext}_checksums.sha1"
+                ),
+                archive_checksum=part(
+                    f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/parts/{{project}}_{{sample}}_{{run_uid}}_{{file_type}}_{{state}}_{{barcode}}{shard_suffix}.{ext}_archive.sha1"
+                ),
+            wildcard_constraints:
+                file_type="|".join(ext_file_types),
             log:
-                f"logs/{project}_{sample}_{run}_{run_uid}_pod5_tar.log",
+                f"logs/{{project}}_{{sample}}_{{run}}_{{run_uid}}_{{file_type}}_{{state}}_{{barcode}}{shard_suffix}_tar.log",
             conda:
                 "../envs/archive.yaml"
-            threads: config["threads"]
+            threads: get_archive_threads(ext)
             params:
                 data_dir=data_dir,
-                project=project,
-                sample=sample,
-                run=run,
-            shell:
-                """
-                cd {params.data_dir}/{params.project} &&
-                    find {params.sample}/{params.run}/pod5 -iname "*.pod5" |
-                    tar -cvf - --files-from - |
-                    pigz -p {threads} > {output.tar} ;
-                tar -tvf <(pigz -dc {output.tar}) >> {output.txt}
-                """
-
-
-for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid):
-    for file_type in file_types:
-        for state in STATES:
-            ext = "tar" if file_type in ["fastq", "bam"] else "tar.gz"
-            threads = 1 if file_type in ["fastq", "bam"] else config["threads"]
-
-            rule:
-                name:
-                    f"tar_{project}_{sample}_{run}_{run_uid}_{file_type}_{state}"
-                input:
-                    f"{data_dir}/{project}/{sample}/{run}",
-                output:
-                    tar=f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/{file_type}/{project}_{sample}_{run_uid}_{file_type}_{state}.{ext}",
-                    txt=f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/{file_type}/{project}_{sample}_{run_uid}_{file_type}_{state}_list.txt",
-                log:
-                    f"logs/{project}_{sample}_{run}_{run_uid}_{file_type}_{state}_tar.log",
-                conda:
-                    "../envs/archive.yaml"
-                threads: threads
-                params:
-                    data_dir=data_dir,
-                    project=project,
-                    sample=sample,
-                    file_type=file_type,
-                    state=state,
-                    run=run,
-                shell:
-                    """
-                    if [[ "{params.file_type}" == "fastq" || "{params.file_type}" == "bam" ]]; then
-                        cd {params.data_dir}/{params.project} &&
-                            find {params.sample}/{params.run}/{params.file_type}_{params.state} -iname "*.{params.file_type}*" |
-                            tar -cvf {output.tar} --files-from - ;
-                        tar -tvf {output.tar} >> {output.txt}
-                    else
-                        cd {params.data_dir}/{params.project} &&
-                            find {params.sample}/{params.run}/{params.file_type}_{params.state} -iname "*.{params.file_type}" |
-                            tar -cvf - --files-from - |
-                            pigz -p {threads} > {output.tar} ;
-                        tar -tvf <(pigz -dc {output.tar}) >> {output.txt}
-                    fi
-                    """
+                transfer_dir_full=get_transfer_dir_full,
+                project=lambda wildcards: wildcards.project,
+                sample=lambda wildcards: wildcards.sample,
+                run=lambda wildcards: wildcards.run,
+                run_uid=lambda wildcards: wildcards.run_uid,
+                sources=lambda wildcards: [
+                    f"{wildcards.sample}/{wildcards.run}/{wildcards.file_type}_{wildcards.state}/{wildcards.barcode}"
+                ],
+                pattern=lambda wildcards: get_archive_pattern(wildcards.file_type),
+                codec=lambda wildcards: get_file_type_codec(wildcards.file_type),
+                level=lambda wildcards: get_archive_level(wildcards.file_type),
+                shard=(lambda wildcards: int(wildcards.shard)) if shard_suffix else None,
+                exclude=None,
+                copy_pattern=None,
+                seekable_block_size=seekable_block_size,
+                checksum_cache_dir=checksum_cache_dir,
+                metrics_dir=metrics_dir,
+                io_throttle=io_throttle,
+            script:
+                "../scripts/tar_archive.py"
 
 
 rule tar_reports:
     input:
-        [
-            f"{data_dir}/{project}/{sample}/{run}"
-            for project, sample, run, run_uid in zip(
-                projects, samples, runs, runs_uid
-            )
-        ],
+        f"{data_dir}/{{project}}/{{sample}}/{{run}}",
     output:
-        tar=expand(
-            "{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/reports/{{project}}_{{sample}}_{{run_uid}}_reports.tar.gz",
-            data_dir=data_dir,
-            transfer_dir=transfer_dir,
+        tar=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/reports/{{project}}_{{sample}}_{{run_uid}}_reports.{get_archive_extension('reports')}",
+        txt=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/reports/{{project}}_{{sample}}_{{run_uid}}_reports_list.txt",
+        summary=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/reports/{{project}}_{{sample}}_{{run_uid}}_reports_summary.json",
+        **get_index_output(
+            get_archive_extension("reports"),
+            f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/reports/{{project}}_{{sample}}_{{run_uid}}_reports_index.json.gz",
         ),
-        txt=expand(
-            "{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/reports/{{project}}_{{sample}}_{{run_uid}}_reports_list.txt",
-            data_dir=data_dir,
-            transfer_dir=transfer_dir,
+        checksums=temp(
+            f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/parts/{{project}}_{{sample}}_{{run_uid}}_reports.{get_archive_extension('reports')}_checksums.sha1"
+        ),
+        archive_checksum=temp(
+            f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/parts/{{project}}_{{sample}}_{{run_uid}}_reports.{get_archive_extension('reports')}_archive.sha1"
         ),
     log:
         "logs/{project}_{sample}_{run}_{run_uid}_reports.log",
     conda:
         "../envs/archive.yaml"
-    threads: config["threads"]
+    threads: get_archive_threads(get_archive_extension("reports"))
     params:
         data_dir=data_dir,
-        transfer_dir=transfer_dir,
-        project=project,
-        sample=sample,
-    shell:
-        """
-        cd {params.data_dir}/{wildcards.project} && tar -cvf - {wildcards.sample}/{wildcards.run}/*.* {wildcards.sample}/{wildcards.run}/other_reports |
-            pigz -p {threads} > {output.tar} ;
-        tar -tvf <(pigz -dc {output.tar}) >> {output.txt} ;
-        reports_transfer_dir={params.data_dir}/{wildcards.project}/{params.transfer_dir}_{wildcards.sample}_{wildcards.run}/reports ;
-        for report_file in {wildcards.sample}/{wildcards.run}/report_*.* ; do
-            report_basename=`basename $report_file`;
-            cp ${{report_file}} ${{reports_transfer_dir}}/{wildcards.project}_{wildcards.sample}_{wildcards.run_uid}_${{report_basename}} ;
-        done
-        """
+        transfer_dir_full=get_transfer_dir_full,
+        project=lambda wildcards: wildcards.project,
+        sample=lambda wildcards: wildcards.sample,
+        run=lambda wildcards: wildcards.run,
+        run_uid=lambda wildcards: wildcards.run_uid,
+        sources=get_report_sources,
+        pattern=None,
+        codec=get_file_type_codec("reports"),
+        level=get_archive_level("reports"),
+        shard=None,
+        exclude=None,
+        copy_pattern="report_*.*",
+        seekable_block_size=seekable_block_size,
+        checksum_cache_dir=checksum_cache_dir,
+        metrics_dir=metrics_dir,
+        io_throttle=io_throttle,
+    script:
+        "../scripts/tar_archive.py"
+
+
+# NOTE: the shards of an archive are planned by a checkpoint when the
+# run is archived, rather than while the DAG is built, so that the
+# source directories are only walked by jobs; the shard jobs (and
+# the rules needing their outputs) are added once the plan exists
+checkpoint plan_shards:
+    input:
+        f"{data_dir}/{{project}}/{{sample}}/{{run}}",
+    output:
+        f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{archive}}_shards.json",
+    wildcard_constraints:
+        file_type="|".join(STATE_FILE_TYPES),
+    log:
+        "logs/{project}_{sample}_{run}_{run_uid}_{file_type}_{archive}_shards.log",
+    conda:
+        "../envs/archive.yaml"
+    threads: 1
+    params:
+        data_dir=data_dir,
+        source=lambda wildcards: get_shard_plan_source(wildcards)[0],
+        exclude=lambda wildcards: get_shard_plan_source(wildcards)[1],
+        pattern=lambda wildcards: get_archive_pattern(wildcards.file_type),
+        shard_size=shard_size,
+    script:
+        "../scripts/plan_shards.py"
+
+
+rule shard_manifest:
+    input:
+        unpack(get_shard_manifest_inputs),
+    output:
+        f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/{{file_type}}/{{project}}_{{sample}}_{{run_uid}}_{{archive}}_manifest.json",
+    wildcard_constraints:
+        file_type="|".join(STATE_FILE_TYPES),
+    log:
+        "logs/{project}_{sample}_{run}_{run_uid}_{file_type}_{archive}_manifest.log",
+    conda:
+        "../envs/archive.yaml"
+    threads: 1
+    params:
+        shard_size=shard_size,
+    script:
+        "../scripts/shard_manifest.py"
+
+
+# NOTE: each archive is verified by its own job, so archives are
+# decompressed and hashed in parallel; verify_run then compares the
+# member checksums with the run's source checksums
+rule verify_archive:
+    input:
+        archive=get_verify_archive,
+    output:
+        temp(
+            f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/verify/{{project}}_{{sample}}_{{run_uid}}_{{archive}}.json"
+        ),
+    wildcard_constraints:
+        archive="[^/]+",
+    log:
+        "logs/{project}_{sample}_{run}_{run_uid}_{archive}_verify.log",
+    conda:
+        "../envs/archive.yaml"
+    threads: 2
+    params:
+        transfer_dir_full=get_transfer_dir_full,
+        metrics_dir=metrics_dir,
+        io_throttle=io_throttle,
+    script:
+        "../scripts/verify_archive.py"
+
+
+rule verify_run:
+    input:
+        checksums=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/{{project}}_{{sample}}_{{run_uid}}_checksums.sha1",
+        parts=get_verify_parts,
+    output:
+        f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/logs/{{project}}_{{sample}}_{{run_uid}}_verify.json",
+    log:
+        "logs/{project}_{sample}_{run}_{run_uid}_verify.log",
+    conda:
+        "../envs/archive.yaml"
+    threads: 1
+    script:
+        "../scripts/verify_run.py"
 
 
 rule archive_complete:
     input:
-        get_outputs(file_types),
+        outputs=get_run_outputs,
+        summaries=get_run_summaries,
     output:
         f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/logs/{{project}}_{{sample}}_{{run_uid}}_file_counts.txt",
     log:
         "logs/{project}_{sample}_{run}_{run_uid}_archive_complete.txt",
     threads: 1
     params:
-        data_dir=data_dir,
-        transfer_dir=transfer_dir,
-        sample=sample,
-        project=project,
-    shell:
-        """
-        transfer_path={params.data_dir}/{wildcards.project}/{params.transfer_dir}_{wildcards.sample}_{wildcards.run}
-        count_file_regex=`echo -e ".*/{wildcards.project}_{wildcards.sample}_{wildcards.run_uid}_[pod5|bam|fast|reports].*_list.txt"`
-        count_files=`find $transfer_path -type f -regex $count_file_regex`
-        tar_count=`cat $count_files | grep -v "/$" | wc -l`
-        sys_file_count=`find {params.data_dir}/{wildcards.project}/{wildcards.sample}/{wildcards.run} -type f | wc -l`
-        echo "{sample} tar file counts: $tar_count" >> {output}
-        echo "{sample} sys file counts: $sys_file_count" >> {output}
-        """
+        file_types=[filetype for filetype in DATA_FILES if filetype in file_types],
+        inventory=get_source_inventory,
+        lease_dir=leases.get("lease_dir", ""),
+    script:
+        "../scripts/archive_complete.py"
@@ -1,7 +1,29 @@
+import atexit
+import functools
+import hashlib
+import json
 import os
 import re
 import sys
-from glob import iglob
+
+sys.path.insert(0, os.path.join(workflow.basedir, "scripts"))
+from archiver import (
+    BARCODE_DIR_REGEX,
+    CODEC_EXTENSIONS,
+    get_archive_codec,
+    get_compression,
+    parse_size,
+)
+from capacity_planner import (
+    ORDERS,
+    RunPlan,
+    format_report,
+    get_file_type,
+    plan_capacity,
+)
+from discovery_index import DiscoveryIndex
+from run_lease import LEASE_OWNER_ENV, LeaseManager, get_lease_name
+from seekable_archive import SEEKABLE_CODECS
 
 # --------------------------------------------------------------------------- #
 # Constants
@@ -9,6 +31,8 @@ from glob import iglob
 DATA_FILES = ["reports", "fastq", "fast5", "pod5", "bam"]
 POSSIBLE_FILE_TYPES = DATA_FILES + ["checksums"]
 STATES = ["pass", "fail", "skip"]
+# file types whose runs hold a directory per state (e.g. fastq_pass)
+STATE_FILE_TYPES = ["fastq", "fast5", "pod5", "bam"]
 
 # --------------------------------------------------------------------------- #
 # Config variables
@@ -24,6 +48,25 @@ ignore_proj_regex = str(config["ignore_proj_regex"]).lower() == "true"
 check_if_complete = str(config["check_if_complete"]).lower() == "true"
 transfer = str(config["transfer"]).lower() == "true"
 delete_on_transfer = str(config["delete_on_transfer"]).lower() == "true"
+discovery_index = DiscoveryIndex(config.get("discovery_index", ""))
+discovery_workers = int(config.get("discovery_workers", 16))
+compression = config.get("compression", {})
+shard_size = parse_size(config.get("shard_size", 0))
+verify_archives = str(config.get("verify_archives", False)).lower() == "true"
+metrics_dir = config.get("metrics_dir", "")
+io_throttle = config.get("io_throttle", {})
+seekable_archives = str(config.get("seekable_archives", False)).lower() == "true"
+seekable_block_size = parse_size(config.get("seekable_block_size", "16M"))
+checksum_cache_dir = config.get("checksum_cache_dir", "")
+split_by_barcode = str(config.get("split_by_barcode", False)).lower() == "true"
+# runs are moved by the Globus flow when deleting, unless set otherwise
+transfer_client = config.get("transfer_client") or (
+    "globus_flow" if delete_on_transfer and config.get("globus_flow_id") else "globus"
+)
+capacity_planner = config.get("capacity_planner", {})
+plan_runs = str(capacity_planner.get("enabled", False)).lower() == "true"
+run_order = capacity_planner.get("order", "discovery")
+leases = config.get("leases", {})
 
 # --------------------------------------------------------------------------- #
 # Input validation
@@ -53,6 +96,24 @@ for file_type in file_types:
         print(f"Invalid file type {file_type} specified.", file=sys.stderr)
         sys.exit()
 
+if transfer_client not in ["globus", "globus_flow", "local"]:
+    print(f"Invalid transfer client {transfer_client} specified.", file=sys.stderr)
+    sys.exit()
+
+if transfer_client == "globus_flow" and not (
+    delete_on_transfer and config.get("globus_flow_id")
+):
+    print(
+        "Invalid parameters: the globus_flow transfer client moves data, so "
+        "requires delete_on_transfer and a globus_flow_id.",
+        file=sys.stderr,
+    )
+    sys.exit()
+
+if run_order not in ORDERS:
+    print(f"Invalid capacity planner order {run_order} specified.", file=sys.stderr)
+    sys.exit()
+
 if ignore_proj_regex and not extra_dirs:
     print(
         "Invalid parameters: extra_dirs must be specified if ignoring project regex.",
@@ -72,20 +133,75 @@ def get_project_dirs(data_dir, proj_dir_regex):
     return.
     """
     project_dirs = []
-    for proj_dir in os.listdir(data_dir):
+    for proj_dir in discovery_index.listdir(data_dir):
         is_project_dir = re.match(proj_dir_regex, proj_dir)
         if is_project_dir:
             project_dirs.append(proj_dir)
     return project_dirs
 
 
+def prefetch_run_dirs(project_dirs):
+    """
+    Checks the directories that run discovery looks in, one
+    level at a time with discovery_workers threads: the project
+    directories, their samples (and transfer directories), then
+    their runs, so that discovery is answered from memory
+    """
+    level = [os.path.join(data_dir, project) for project in project_dirs]
+    for depth in range(3):
+        next_level = []
+        for dir_path, listing in zip(
+            level, discovery_index.prefetch(level, discovery_workers)
+        ):
+            if listing is None or depth == 2:
+                continue
+            next_level.extend(
+                os.path.join(dir_path, d) for d in listing[0] if d != transfer_dir
+            )
+        level = next_level
+
+
+def count_run_files(run_keys):
+    """
+    Returns {(project, sample, run): {file type: [files, None]}},
+    counting the files in each run's directory listings, which are
+    taken one level at a time across all runs with discovery_workers
+    threads (and kept out of the persistent index). Symlinked
+    directories are not followed, as in os.walk. Bytes would need
+    every file stat'ed, so are left unknown
+    """
+    totals = {key: {} for key in run_keys}
+    level = [(key, os.path.join(data_dir, *key)) for key in run_keys]
+    while level:
+        next_level = []
+        listings = discovery_index.prefetch(
+            [dir_path for _, dir_path in level], discovery_workers, persist=False
+        )
+        for (key, dir_path), listing in zip(level, listings):
+            if listing is None:
+                continue
+            dirs, files = listing
+            run_dir = os.path.join(data_dir, *key)
+            for name in files:
+                relpath = os.path.relpath(os.path.join(dir_path, name), run_dir)
+                file_type = get_file_type(relpath) or "other"
+                totals[key].setdefault(file_type, [0, None])[0] += 1
+            next_level.extend(
+                (key, os.path.join(dir_path, d))
+                for d in dirs
+                if not os.path.islink(os.path.join(dir_path, d))
+            )
+        level = next_level
+    return totals
+
+
 def is_run_complete(run_dir):
     """
     Checks whether run is complete for a given sample,
     indicated by presence of sequencing_summary.txt file
     """
     run_complete = []
-    run_contents = os.listdir(run_dir)
+    run_contents = discovery_index.listdir(run_dir)
     eor_files = list(filter(end_of_run_file_regex.match, run_contents))
     run_complete.append(len(eor_files) > 0)
     return any(run_complete)
@@ -106,8 +222,8 @@ def is_run_processing_complete(run_dir, project_dir_full):
     processing_complete_file = os.path.join(project_dir_full, sample, run, cfile_name)
     print(f"Process file: {processing_complete_file}")
 
-    if os.path.exists(transfer_dir_full):
-        files_in_transfer_dir = next(os.walk(transfer_dir_full))[1]
+    if discovery_index.exists(transfer_dir_full):
+        files_in_transfer_dir = discovery_index.subdirs(transfer_dir_full)
         final_file = "transfer.txt" if transfer else "tar_file_counts.txt"
 
         project_name = os.path.basename(project_dir_full)
@@ -123,16 +239,18 @@ def is_run_processing_complete(run_dir, project_dir_full):
         )
 
         log_dir = os.path.join(transfer_dir_full, "logs")
-        files_in_log_dir = next(os.walk(log_dir))[2] if os.path.exists(log_dir) else []
+        files_in_log_dir = discovery_index.files(log_dir)
+        run_transfer_file = f"{project_name}_{sample}_{run_uid}_transfer.txt"
 
         return (
             "archive.success" in files_in_transfer_dir
             or final_file in files_in_transfer_dir
             or final_file_with_projname in files_in_log_dir
             or final_file_legacy in files_in_log_dir
+            or (transfer and run_transfer_file in files_in_log_dir)
         )
 
-    return os.path.exists(processing_complete_file)
+    return discovery_index.exists(processing_complete_file)
 
 
 def is_project_processing_complete(project_dir_full):
@@ -145,7 +263,7 @@ def is_project_processing_complete(project_dir_full):
     directory may have been deleted due to transfer.
     """
     processing_complete_file = os.path.join(project_dir_full, "processing.success")
-    return os.path.exists(processing_complete_file)
+    return discovery_index.exists(processing_complete_file)
 
 
 # --------------------------------------------------------------------------- #
@@ -164,32 +282,354 @@ def get_checksum_outputs():
 def get_report_outputs():
     report_outputs = []
     for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid):
-        report_outputs.append(
-            f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/reports/{project}_{sample}_{run_uid}_reports.tar.gz"
+        for archive in get_archives(project, sample, run, run_uid, "reports"):
+            report_outputs.append(archive)
+            report_outputs.append(get_list_file(archive))
+    return report_outputs
+
+
+def get_archive_sources(project, sample, run, run_uid, filetype):
+    """
+    Returns (output path without extension, source directory)
+    pairs for the archives made for a given run and file type
+    """
+    run_dir = f"{data_dir}/{project}/{sample}/{run}"
+    if filetype == "reports":
+        return [
+            (
+                f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/reports/{project}_{sample}_{run_uid}_reports",
+                run_dir,
+            )
+        ]
+
+    files_under_sample = [
+        f for f in discovery_index.listdir(run_dir) if not f.startswith(".")
+    ]
+    out_prefix = f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/{filetype}/{project}_{sample}_{run_uid}_{filetype}"
+    sources = []
+    if filetype == "pod5":
+        if f"{filetype}" in files_under_sample:
+            sources.append((out_prefix, f"{run_dir}/{filetype}"))
+    for state in STATES:
+        if f"{filetype}_{state}" in files_under_sample:
+            state_dir = f"{run_dir}/{filetype}_{state}"
+            barcodes = get_barcode_dirs(state_dir)
+            # anything outside the barcode directories (e.g. unclassified)
+            if not barcodes or len(discovery_index.listdir(state_dir)) > len(barcodes):
+                sources.append((f"{out_prefix}_{state}", state_dir))
+            sources.extend(
+                (f"{out_prefix}_{state}_{barcode}", f"{state_dir}/{barcode}")
+                for barcode in barcodes
+            )
+    return sources
+
+
+def get_barcode_dirs(source_dir):
+    """
+    Returns the barcode directories directly under a data
+    directory if archives are split by barcode, otherwise []
+    """
+    if not split_by_barcode:
+        return []
+    return sorted(
+        d for d in discovery_index.subdirs(source_dir) if BARCODE_DIR_REGEX.match(d)
+    )
+
+
+def get_barcode_excludes(wildcards):
+    """
+    Returns the barcode directories (relative to the project
+    directory) left out of a state's archive, as each is
+    archived by its own job
+    """
+    state_path = f"{wildcards.sample}/{wildcards.run}/{wildcards.file_type}_{wildcards.state}"
+    return [
+        f"{state_path}/{barcode}"
+        for barcode in get_barcode_dirs(f"{data_dir}/{wildcards.project}/{state_path}")
+    ]
+
+
+def get_file_type_codec(filetype):
+    return get_compression(compression, filetype)[0]
+
+
+def get_archive_extension(filetype):
+    """
+    Returns the archive extension of the codec configured for
+    filetype. Archives of the auto codec are always gzip files
+    (.tar.gz), as the tar job only decides whether to compress
+    them once it samples the files (see tar_archive.py)
+    """
+    codec = get_file_type_codec(filetype)
+    return CODEC_EXTENSIONS["pigz" if codec == "auto" else codec]
+
+
+def get_file_types_by_extension(filetypes):
+    """
+    Groups file types by their archive extension, as {extension:
+    file types}, so that each tar rule makes one kind of archive
+    """
+    groups = {}
+    for filetype in filetypes:
+        groups.setdefault(get_archive_extension(filetype), []).append(filetype)
+    return groups
+
+
+def get_archive_threads(ext):
+    # uncompressed archives only use tar's thread
+    return 1 if ext == CODEC_EXTENSIONS["none"] else config["threads"]
+
+
+def get_archive_pattern(filetype):
+    """
+    Returns the pattern matching the files archived for a data
+    file type; fastq and bam files may carry a compression
+    suffix (e.g. .fastq.gz)
+    """
+    if filetype in ["fastq", "bam"]:
+        return f"*.{filetype}*"
+    return f"*.{filetype}"
+
+
+def is_sharded(filetype):
+    return shard_size > 0 and filetype != "reports"
+
+
+def get_shard_plan(project, sample, run, run_uid, filetype, prefix):
+    """
+    Returns the shard plan of the archive with output prefix; the
+    plan is made by the plan_shards checkpoint, so the shards are
+    only known once it has run
+    """
+    archive = os.path.basename(prefix)[len(f"{project}_{sample}_{run_uid}_") :]
+    return checkpoints.plan_shards.get(
+        project=project,
+        sample=sample,
+        run=run,
+        run_uid=run_uid,
+        file_type=filetype,
+        archive=archive,
+    ).output[0]
+
+
+@functools.lru_cache(maxsize=None)
+def get_shard_count(plan):
+    with open(plan, "r") as f:
+        return len(json.load(f)["shards"])
+
+
+def get_shard_plan_source(wildcards):
+    """
+    Returns the source directory (relative to the project directory)
+    and the barcode directories left out of a plan_shards job's archive
+    """
+    prefix = f"{get_transfer_dir_full(wildcards)}/{wildcards.file_type}/{wildcards.project}_{wildcards.sample}_{wildcards.run_uid}_{wildcards.archive}"
+    for archive_prefix, source_dir in get_archive_sources(
+        wildcards.project,
+        wildcards.sample,
+        wildcards.run,
+        wildcards.run_uid,
+        wildcards.file_type,
+    ):
+        if archive_prefix == prefix:
+            source = os.path.relpath(source_dir, f"{data_dir}/{wildcards.project}")
+            exclude = [
+                os.path.join(source, barcode)
+                for barcode in get_barcode_dirs(source_dir)
+            ]
+            return source, exclude
+    raise ValueError(f"No archive {os.path.basename(prefix)} for run {wildcards.run}.")
+
+
+def get_shard_plan_input(prefix, sharded):
+    """
+    Returns the shard plan input of a tar rule, if it makes shards
+    """
+    if sharded:
+        return {"plan": f"{prefix}_shards.json"}
+    return {}
+
+
+def get_archives(project, sample, run, run_uid, filetype):
+    """
+    Returns the output paths of the archives (or archive
+    shards) made for a given run and file type
+    """
+    archives = []
+    for prefix, _ in get_archive_sources(project, sample, run, run_uid, filetype):
+        ext = get_archive_extension(filetype)
+        if is_sharded(filetype):
+            n_shards = get_shard_count(
+                get_shard_plan(project, sample, run, run_uid, filetype, prefix)
+            )
+            archives.extend(
+                f"{prefix}_shard{shard:04d}.{ext}" for shard in range(1, n_shards + 1)
+            )
+        else:
+            archives.append(f"{prefix}.{ext}")
+    return archives
+
+
+def get_shard_manifests(project, sample, run, run_uid):
+    """
+    Returns the manifests of a run's sharded archives
+    """
+    manifests = []
+    for filetype in DATA_FILES:
+        if filetype in file_types and is_sharded(filetype):
+            manifests.extend(
+                f"{prefix}_manifest.json"
+                for prefix, _ in get_archive_sources(
+                    project, sample, run, run_uid, filetype
+                )
+            )
+    return manifests
+
+
+def get_shard_manifest_inputs(wildcards):
+    """
+    Returns the shards of an archive together with their source
+    and archive checksum parts, in shard order
+    """
+    prefix = f"{get_transfer_dir_full(wildcards)}/{wildcards.file_type}/{wildcards.project}_{wildcards.sample}_{wildcards.run_uid}_{wildcards.archive}"
+    archives = [
+        archive
+        for archive in get_archives(
+            wildcards.project,
+            wildcards.sample,
+            wildcards.run,
+            wildcards.run_uid,
+            wildcards.file_type,
         )
-        report_outputs.append(
-            f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/reports/{project}_{sample}_{run_uid}_reports_list.txt"
+        if archive.startswith(f"{prefix}_shard")
+    ]
+    return {
+        "archives": archives,
+        "checksums": [get_checksum_part(archive, "checksums") for archive in archives],
+        "archive_checksums": [
+            get_checksum_part(archive, "archive") for archive in archives
+        ],
+    }
+
+
+def get_run_archives(project, sample, run, run_uid):
+    """
+    Returns the output paths of every archive made for a given run
+    """
+    archives = []
+    for filetype in DATA_FILES:
+        if filetype in file_types:
+            archives.extend(get_archives(project, sample, run, run_uid, filetype))
+    return archives
+
+
+def get_index_output(ext, index_file):
+    """
+    Returns the member index output of a tar rule, if seekable
+    archives are enabled and the codec of the rule's archive
+    extension can be written seekable
+    """
+    if seekable_archives and get_archive_codec(f".{ext}") in SEEKABLE_CODECS:
+        return {"member_index": index_file}
+    return {}
+
+
+def get_list_file(archive):
+    """
+    Returns the path of the member list written alongside
+    an archive (or archive shard)
+    """
+    for ext in CODEC_EXTENSIONS.values():
+        if archive.endswith(f".{ext}"):
+            return f"{archive[:-len(ext) - 1]}_list.txt"
+    raise ValueError(f"Unknown archive extension for {archive}.")
+
+
+def get_summary_file(archive):
+    """
+    Returns the path of the member summary written alongside
+    an archive (or archive shard)
+    """
+    return f"{get_list_file(archive)[:-len('_list.txt')]}_summary.json"
+
+
+def get_run_summaries(wildcards):
+    """
+    Returns the member summaries of a run's archives, each in the
+    directory of its archive's file type
+    """
+    return [
+        get_summary_file(archive)
+        for archive in get_run_archives(
+            wildcards.project, wildcards.sample, wildcards.run, wildcards.run_uid
         )
-    return report_outputs
+    ]
 
 
-def get_output_by_type(filetype):
-    file_extension = "tar" if filetype in ["fastq", "bam"] else "tar.gz"
+def get_source_inventory(wildcards):
+    """
+    Returns {file type: [files, bytes]} of a run's source files, from
+    the capacity planner's scan or else counted from directory
+    listings (with bytes None). Runs are counted together when the
+    first is needed, except in jobs, which only need their own run
+    """
+    key = (wildcards.project, wildcards.sample, wildcards.run)
+    if key not in source_inventories:
+        run_keys = set(zip(projects, samples, runs)) if is_main_process() else set()
+        source_inventories.update(count_run_files(run_keys | {key}))
+    return source_inventories[key]
+
+
+def get_checksum_part(archive, kind):
+    """
+    Returns the path of the checksum part written alongside
+    an archive; kind is either "checksums" (source files)
+    or "archive" (the archive itself)
+    """
+    transfer_dir_full = os.path.dirname(os.path.dirname(archive))
+    name = os.path.basename(archive)
+    return f"{transfer_dir_full}/checksums/parts/{name}_{kind}.sha1"
+
+
+def get_checksum_parts(wildcards):
+    archives = get_run_archives(
+        wildcards.project, wildcards.sample, wildcards.run, wildcards.run_uid
+    )
+    return [get_checksum_part(archive, "checksums") for archive in archives]
+
+
+def get_archive_checksum_parts(wildcards):
+    archives = get_run_archives(
+        wildcards.project, wildcards.sample, wildcards.run, wildcards.run_uid
+    )
+    return [get_checksum_part(archive, "archive") for archive in archives]
+
 
+def get_archive_level(filetype):
+    return get_compression(compression, filetype)[1]
+
+
+def get_report_sources(wildcards):
+    """
+    Returns the report files and directories under a run,
+    relative to the project directory (equivalent to
+    {sample}/{run}/*.* {sample}/{run}/other_reports)
+    """
+    run_path = os.path.join(wildcards.sample, wildcards.run)
+    report_files = sorted(
+        os.path.join(run_path, f)
+        for f in discovery_index.listdir(f"{data_dir}/{wildcards.project}/{run_path}")
+        if "." in f and not f.startswith(".")
+    )
+    return report_files + [os.path.join(run_path, "other_reports")]
+
+
+def get_output_by_type(filetype):
     outputs = []
     for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid):
-        files_under_sample = [
-            os.path.basename(f) for f in iglob(f"{data_dir}/{project}/{sample}/{run}/*")
-        ]
-        out_prefix = f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/{filetype}/{project}_{sample}_{run_uid}_{filetype}"
-        if filetype == "pod5":
-            if f"{filetype}" in files_under_sample:
-                outputs.append(f"{out_prefix}.{file_extension}")
-                outputs.append(f"{out_prefix}_list.txt")
-        for state in STATES:
-            if f"{filetype}_{state}" in files_under_sample:
-                outputs.append(f"{out_prefix}_{state}.{file_extension}")
-                outputs.append(f"{out_prefix}_{state}_list.txt")
+        for archive in get_archives(project, sample, run, run_uid, filetype):
+            outputs.append(archive)
+            outputs.append(get_list_file(archive))
 
     return outputs
 
@@ -211,6 +651,76 @@ def get_outputs(file_types):
     return outputs
 
 
+def get_transfer_dir_full(wildcards):
+    return f"{data_dir}/{wildcards.project}/{transfer_dir}_{wildcards.sample}_{wildcards.run}"
+
+
+def get_run_outputs(wildcards):
+    """
+    Returns the checksum, archive and shard manifest outputs of a
+    single run, so that rules only depend on the run they process
+    """
+    project, sample, run, run_uid = (
+        wildcards.project,
+        wildcards.sample,
+        wildcards.run,
+        wildcards.run_uid,
+    )
+    outputs = []
+    if "checksums" in file_types:
+        outputs.append(
+            f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/checksums/{project}_{sample}_{run_uid}_checksums.sha1"
+        )
+    outputs.extend(get_run_archives(project, sample, run, run_uid))
+    outputs.extend(get_shard_manifests(project, sample, run, run_uid))
+    return outputs
+
+
+def get_verify_archive(wildcards):
+    """
+    Returns the archive checked by a verify_archive job
+    """
+    name = f"{wildcards.project}_{wildcards.sample}_{wildcards.run_uid}_{wildcards.archive}"
+    for archive in get_run_archives(
+        wildcards.project, wildcards.sample, wildcards.run, wildcards.run_uid
+    ):
+        if os.path.basename(archive) == name:
+            return archive
+    raise ValueError(f"No archive {name} for run {wildcards.run}.")
+
+
+def get_verify_parts(wildcards):
+    transfer_dir_full = get_transfer_dir_full(wildcards)
+    archives = get_run_archives(
+        wildcards.project, wildcards.sample, wildcards.run, wildcards.run_uid
+    )
+    return [
+        f"{transfer_dir_full}/checksums/verify/{os.path.basename(archive)}.json"
+        for archive in archives
+    ]
+
+
+def get_verify_report(wildcards):
+    """
+    Returns the run's verification report if archives are
+    verified, so that transfer rules can be gated on it
+    """
+    if not verify_archives:
+        return []
+    return [
+        f"{get_transfer_dir_full(wildcards)}/logs/{wildcards.project}_{wildcards.sample}_{wildcards.run_uid}_verify.json"
+    ]
+
+
+def get_verify_outputs():
+    if not verify_archives:
+        return []
+    return [
+        f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/logs/{project}_{sample}_{run_uid}_verify.json"
+        for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid)
+    ]
+
+
 def get_final_checksum_outputs():
     final_checksum_outputs = [
         f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/checksums/{project}_{sample}_{run_uid}_archives.sha1"
@@ -235,15 +745,158 @@ def get_archive_complete_outputs():
     return archive_complete_outputs
 
 
+def get_transfer_env():
+    """
+    Returns the conda environment providing the transfer client's CLI
+    """
+    if transfer_client == "globus_flow":
+        return "../envs/globus_automate.yaml"
+    return "../envs/globus.yaml"
+
+
+def get_transfer_runs():
+    return [
+        {"project": project, "sample": sample, "run": run, "run_uid": run_uid}
+        for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid)
+    ]
+
+
+def get_transfer_batches():
+    """
+    Splits the runs ready for transfer into batches of up to
+    transfer_batch_size runs, each transferred by its own job, so
+    that a run only waits for the runs in its batch. Returns
+    {batch id: runs}, with each id named after its batch's runs
+    """
+    if not transfer:
+        return {}
+    batch_size = max(1, int(config.get("transfer_batch_size", 20)))
+    ready = sorted(
+        get_transfer_runs(), key=lambda run: (run["project"], run["sample"], run["run"])
+    )
+    batches = {}
+    for i in range(0, len(ready), batch_size):
+        batch_runs = ready[i : i + batch_size]
+        run_dirs = [
+            f"{run['project']}/{run['sample']}/{run['run']}" for run in batch_runs
+        ]
+        batch_id = hashlib.sha1("\n".join(run_dirs).encode()).hexdigest()[:12]
+        batches[batch_id] = batch_runs
+    return batches
+
+
+def get_transfer_batch(wildcards):
+    return get_transfer_batches()[wildcards.batch_id]
+
+
+def get_transfer_inputs(wildcards):
+    """
+    Returns the outputs that the runs of a transfer batch must have
+    (and, if archives are verified, have passed) before transfer
+    """
+    inputs = {"counts": [], "checksums": [], "verify": []}
+    for run in get_transfer_batch(wildcards):
+        prefix = f"{data_dir}/{run['project']}/{transfer_dir}_{run['sample']}_{run['run']}"
+        name = f"{run['project']}_{run['sample']}_{run['run_uid']}"
+        inputs["counts"].append(f"{prefix}/logs/{name}_file_counts.txt")
+        inputs["checksums"].append(f"{prefix}/checksums/{name}_archives.sha1")
+        if verify_archives:
+            inputs["verify"].append(f"{prefix}/logs/{name}_verify.json")
+    return inputs
+
+
+def get_transfer_marker(project, sample, run, run_uid):
+    """
+    Returns the file marking a run as transferred; when deleting,
+    the transfer directory will be gone, so the run itself is
+    marked as processed
+    """
+    if delete_on_transfer:
+        return f"{data_dir}/{project}/{sample}/{run}/{run_uid}.processing.success"
+    return f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/logs/{project}_{sample}_{run_uid}_transfer.txt"
+
+
+def get_transfer_markers(wildcards):
+    return [get_transfer_marker(**run) for run in get_transfer_batch(wildcards)]
+
+
 def get_transfer_outputs():
-    if transfer:
-        transfer_outputs = [
-            f"{data_dir}/{project}/{transfer_dir}_{sample}_{run}/logs/{project}_{sample}_{run_uid}_transfer.txt"
-            for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid)
+    """
+    Returns each transfer batch's summary. The transfer job marks each
+    run as transferred once its batch's transfer is confirmed, so runs
+    of a failed batch are transferred again
+    """
+    return [
+        f"logs/transfers/transfer_{batch_id}.json"
+        for batch_id in get_transfer_batches()
+    ]
+
+
+def is_main_process():
+    """
+    Whether this process schedules the workflow's jobs, rather than
+    running one of them (jobs parse the workflow again)
+    """
+    mode = getattr(workflow, "mode", None)
+    if mode is not None:
+        from snakemake.common import Mode
+
+        return mode == Mode.default
+    # Snakemake 8 and later
+    from snakemake_interface_executor_plugins.settings import ExecMode
+
+    return getattr(workflow, "exec_mode", ExecMode.DEFAULT) == ExecMode.DEFAULT
+
+
+def is_executing():
+    """
+    Whether this invocation will run jobs, rather than e.g. only
+    dry-running, drawing the DAG, linting or summarising
+    """
+    if "snakemake" not in sys.argv[0]:
+        # e.g. run through the Python API, which is not checked
+        return True
+    # the options are read from the command line, as Snakemake 7
+    # does not pass them to the workflow
+    try:
+        from snakemake import get_argument_parser
+    except ImportError:
+        # Snakemake 8 and later
+        from snakemake.cli import get_argument_parser
+
+    args, _ = get_argument_parser().parse_known_args(sys.argv[1:])
+    return not any(
+        getattr(args, option, None)
+        for option in [
+            "dryrun",
+            "dag",
+            "rulegraph",
+            "filegraph",
+            "d3dag",
+            "lint",
+            "summary",
+            "detailed_summary",
+            "list",
+            "list_target_rules",
+            "touch",
+            "unlock",
         ]
-        return transfer_outputs
-    else:
-        return []
+    )
+
+
+def get_final_outputs():
+    """
+    When deleting on transfer, the runs' outputs are gone once
+    they are transferred, so only their markers are requested
+    """
+    if transfer and delete_on_transfer:
+        return get_transfer_outputs()
+    return (
+        get_final_checksum_outputs()
+        + get_archive_complete_outputs()
+        + get_verify_outputs()
+        + get_transfer_outputs()
+    )
 
 
 # --------------------------------------------------------------------------- #
@@ -264,17 +917,30 @@ for proj_dir in project_dirs:
     print(f"Found project directory {proj_dir}.", file=sys.stdout)
 
 
+# claim runs so that workflows on other hosts sharing data_dir skip
+# them; only the main Snakemake process of an invocation that runs
+# jobs claims runs. Its jobs check that it still holds their run's
+# lease before marking the run complete or transferred
+lease_manager = None
+if leases.get("lease_dir") and is_main_process() and is_executing():
+    lease_manager = LeaseManager(
+        leases["lease_dir"], leases.get("duration", 300), leases.get("heartbeat", 60)
+    )
+    os.environ[LEASE_OWNER_ENV] = lease_manager.owner
+    atexit.register(lease_manager.close)
+
+prefetch_run_dirs(project_dirs)
 projects, samples, runs, runs_uid = [], [], [], []
 for project in project_dirs:
     project_dir_full = os.path.join(data_dir, project)
-    if not os.path.exists(project_dir_full):
+    if not discovery_index.exists(project_dir_full):
         print(
             f"Project directory {project} does not exist; skipping.",
             file=sys.stdout,
         )
         continue
 
-    samples_in_project = next(os.walk(project_dir_full))[1]
+    samples_in_project = discovery_index.subdirs(project_dir_full)
     samples_in_project = filter(
         lambda sample: sample != transfer_dir, samples_in_project
     )
@@ -282,7 +948,7 @@ for project in project_dirs:
     # add both projects and sample to keep their association together
     for sample in samples_in_project:
         sample_dir = os.path.join(project_dir_full, sample)
-        runs_in_samples = next(os.walk(sample_dir))[1]
+        runs_in_samples = discovery_index.subdirs(sample_dir)
 
         if is_project_processing_complete(sample_dir):
             print(
@@ -302,6 +968,14 @@ for project in project_dirs:
                 )
                 continue
             elif not check_if_complete or is_run_complete(run_dir):
+                if lease_manager is not None and not lease_manager.acquire(
+                    get_lease_name(project, sample, run)
+                ):
+                    print(
+                        f"Skipping {run_sample} in project {project} (claimed by another process).",
+                        file=sys.stdout,
+                    )
+                    continue
                 print(
                     f"Found {run_sample} in project {project} for processing.",
                     file=sys.stdout,
@@ -316,6 +990,50 @@ for project in project_dirs:
                     file=sys.stdout,
                 )
 
+discovery_index.save()
+
+# --------------------------------------------------------------------------- #
+# Capacity planning
+# --------------------------------------------------------------------------- #
+# source files of each run by type, compared with its archives by archive_complete
+source_inventories = {}
+if plan_runs and runs:
+    plans = [
+        RunPlan(
+            (project, sample, run, run_uid),
+            f"{project}/{sample}/{run}",
+            os.path.join(data_dir, project, sample, run),
+            os.path.join(data_dir, project),
+            file_types,
+            compression,
+            end_of_run_file_regex,
+        )
+        for project, sample, run, run_uid in zip(projects, samples, runs, runs_uid)
+    ]
+    for plan in plans:
+        source_inventories[plan.key[:3]] = plan.totals
+    reserve = parse_size(capacity_planner.get("free_space_reserve", 0))
+    admitted, deferred = plan_capacity(plans, reserve, run_order)
+    print(
+        format_report(
+            plans, reserve, run_order, parse_size(capacity_planner.get("throughput", 0))
+        ),
+        file=sys.stdout,
+    )
+    for plan in deferred:
+        print(
+            f"Deferring {plan.name}: its estimated output would exceed the "
+            "free space reserve.",
+            file=sys.stdout,
+        )
+        if lease_manager is not None:
+            lease_manager.release(get_lease_name(*plan.key[:3]))
+    projects, samples, runs, runs_uid = (
+        [list(values) for values in zip(*[plan.key for plan in admitted])]
+        if admitted
+        else ([], [], [], [])
+    )
+
 #        print(f"rin sample - {runs_uid}")
 #        print(f" sample - {samples}")
 #        print(f" project - {projects}")
@@ -1,74 +1,39 @@
-if delete_on_transfer:
+if transfer:
 
-    # NOTE: this step uses a Globus data flow, so first we need to create the json file
-    rule create_globus_json_input:
-        input:
-            counts=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/logs/{{project}}_{{sample}}_{{run_uid}}_file_counts.txt",
-            checksums=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/{{project}}_{{sample}}_{{run_uid}}_archives.sha1",
-        output:
-            f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/logs/{{project}}_{{sample}}_{{run_uid}}_globus_input.json",
-        log:
-            "logs/{project}_{sample}_{run}_{run_uid}_create_globus_json.log",
-        conda:
-            "../envs/python.yaml"
-        threads: 1
-        script:
-            "../scripts/create_globus_json_input.py"
-
-    # NOTE: this step will only invoke the transfer but there is no guarantee that it
-    # will be successful. Check the Globus dashboard for the status of the transfer.
-    rule transfer:
-        input:
-            f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/logs/{{project}}_{{sample}}_{{run_uid}}_globus_input.json",
-        output:
-            transfer_file=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/logs/{{project}}_{{sample}}_{{run_uid}}_transfer.txt",
-            complete_file=f"{data_dir}/{{project}}/{{sample}}/{{run}}/{{run_uid}}.processing.success",
-        log:
-            "logs/{project}_{sample}_{run}_{run_uid}_transfer.log",
-        conda:
-            "../envs/globus_automate.yaml"
-        threads: 1
-        params:
-            globus_flow_id=config["globus_flow_id"],
-        shell:
-            """
-            globus-automate flow run \
-                {params.globus_flow_id} \
-                --flow-input {input} \
-                --label "Transfer {wildcards.project}" > {output.transfer_file}
-
-            touch {output.complete_file}
-            """
-
-else:
-
-    # NOTE: this step will only invoke the transfer but there is no guarantee that it
-    # will be successful. Check the Globus dashboard for the status of the transfer.
+    # NOTE: runs ready for transfer are split into batches, each transferred by its
+    # own job as a single transfer task, so a run only waits for the runs in its
+    # batch. Jobs share transfer_max_in_flight task slots, wait until their tasks
+    # have finished and only mark their runs as transferred (or, if deleting, as
+    # processed) once confirmed. The markers are written by the job rather than
+    # being its outputs, as a batch's runs are only known from its id.
     rule transfer:
         input:
-            counts=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/logs/{{project}}_{{sample}}_{{run_uid}}_file_counts.txt",
-            checksums=f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/checksums/{{project}}_{{sample}}_{{run_uid}}_archives.sha1",
+            unpack(get_transfer_inputs),
         output:
-            f"{data_dir}/{{project}}/{transfer_dir}_{{sample}}_{{run}}/logs/{{project}}_{{sample}}_{{run_uid}}_transfer.txt",
+            "logs/transfers/transfer_{batch_id}.json",
         log:
-            "logs/{project}_{sample}_{run}_{run_uid}_transfer.log",
+            "logs/transfers/transfer_{batch_id}.log",
+        wildcard_constraints:
+            batch_id="[0-9a-f]{12}",
         conda:
-            "../envs/globus.yaml"
+            get_transfer_env()
         threads: 1
         params:
+            runs=get_transfer_batch,
+            markers=get_transfer_markers,
             data_dir=data_dir,
             transfer_dir=transfer_dir,
             src_endpoint=config["src_endpoint"],
             dest_endpoint=config["dest_endpoint"],
             dest_path=config["dest_path"],
-        shell:
-            """
-            globus transfer \
-                {params.src_endpoint}:{params.data_dir}/{wildcards.project}/{params.transfer_dir} \
-                {params.dest_endpoint}:{params.dest_path}/{wildcards.project}/{params.transfer_dir} \
-                --recursive \
-                --sync-level checksum \
-                --verify-checksum \
-                --fail-on-quota-errors \
-                --notify on > {output}
-            """
+            delete_on_transfer=delete_on_transfer,
+            client=transfer_client,
+            globus_flow_id=config.get("globus_flow_id", ""),
+            max_in_flight=config.get("transfer_max_in_flight", 2),
+            slot_dir=".snakemake/transfer_slots",
+            poll_interval=config.get("transfer_poll_interval", 60),
+            timeout=config.get("transfer_timeout", 0),
+            metrics_dir=metrics_dir,
+            lease_dir=leases.get("lease_dir", ""),
+        script:
+            "../scripts/transfer_runs.py"
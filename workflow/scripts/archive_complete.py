@@ -0,0 +1,65 @@
+"""
+Compares the members of a run's archives, summed from the
+summaries written alongside them by tar_archive.py, with the
+run's source inventory gathered during discovery, and writes
+both to the run's file counts log. Neither the archives nor
+the run directory are read again. Differences for a file type
+are logged as warnings. If the inventory was counted from
+directory listings, its bytes are unknown (None), and its
+counts include links and other non-directory entries.
+The run is only marked complete while the workflow that started
+the job still holds its lease (if leases are used).
+"""
+import os
+import sys
+import json
+
+from run_lease import check_lease_held, get_lease_name
+
+sys.stderr = open(snakemake.log[0], "w")
+
+sample = snakemake.wildcards.sample
+inventory = snakemake.params.inventory
+
+# summaries are written to the directory of their file type
+summaries_by_type = {}
+for summary_file in snakemake.input.summaries:
+    file_type = os.path.basename(os.path.dirname(summary_file))
+    summaries_by_type.setdefault(file_type, []).append(summary_file)
+
+tar_count = 0
+lines = []
+for file_type in snakemake.params.file_types:
+    summaries = summaries_by_type.get(file_type, [])
+    files, nbytes, members = 0, 0, 0
+    for summary_file in summaries:
+        with open(summary_file, "r") as f:
+            summary = json.load(f)
+        files += summary["files"]
+        nbytes += summary["bytes"]
+        members += summary["files"] + summary["links"] + summary["other"]
+    tar_count += members
+    sys_files, sys_bytes = inventory.get(file_type, [0, None])
+    if sys_bytes is None:
+        tar_text, sys_text = f"{members}", f"{sys_files}"
+    else:
+        tar_text = f"{files} ({nbytes} bytes)"
+        sys_text = f"{sys_files} ({sys_bytes} bytes)"
+    lines.append(f"{sample} {file_type} tar files: {tar_text}, sys files: {sys_text}\n")
+    if summaries and tar_text != sys_text:
+        print(
+            f"Warning: {file_type} counts differ: tar files {tar_text}, "
+            f"sys files {sys_text}.",
+            file=sys.stderr,
+        )
+
+sys_file_count = sum(files for files, _ in inventory.values())
+wildcards = snakemake.wildcards
+check_lease_held(
+    snakemake.params.lease_dir,
+    get_lease_name(wildcards.project, wildcards.sample, wildcards.run),
+)
+with open(snakemake.output[0], "w") as f:
+    f.write(f"{sample} tar file counts: {tar_count}\n")
+    f.write(f"{sample} sys file counts: {sys_file_count}\n")
+    f.writelines(lines)
@@ -0,0 +1,563 @@
+"""
+Streaming archive helpers shared by the workflow scripts.
+
+Every source file is read from disk exactly once: the bytes are
+hashed (sha1, as ``shasum -a 1`` would), appended to the tar stream
+and, optionally, piped through a compressor. The compressed output
+is hashed as it is written and the member listing is produced from
+the same pass, so no stage needs to re-read the run or the archive.
+"""
+import contextlib
+import fnmatch
+import hashlib
+import os
+import re
+import shutil
+import stat
+import subprocess
+import tarfile
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# read/write buffer size used for every copy
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# initial width of the "user/group size" column in GNU tar listings
+TAR_UGSWIDTH = 19
+
+# archive file extension for each compression codec
+CODEC_EXTENSIONS = {"none": "tar", "pigz": "tar.gz", "zstd": "tar.zst"}
+
+# codecs used for file types missing from the compression config
+DEFAULT_CODECS = {"fastq": "none", "bam": "none"}
+DEFAULT_CODEC = "pigz"
+
+# the auto codec compresses a sample of this many bytes from up to
+# AUTO_SAMPLE_FILES files and stores the archive uncompressed unless
+# compression saves at least AUTO_MIN_SAVING of the sample's size
+AUTO_SAMPLE_FILES = 4
+AUTO_SAMPLE_BYTES = 1024 * 1024
+AUTO_MIN_SAVING = 0.1
+
+# tar header and record size, used to bound the size of shards
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+SIZE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+# barcode directories of multiplexed runs (e.g. fastq_pass/barcode01)
+BARCODE_DIR_REGEX = re.compile(r"^barcode\d+$")
+
+
+class HashingReader:
+    """
+    Wraps a source file, hashing every byte read and
+    optionally copying it to one or more sinks. Reads
+    are paced by throttle (an io_throttle.IOThrottle), if given.
+    If the file's digest is already known, it is not hashed again.
+    """
+
+    def __init__(self, fileobj, sinks=None, throttle=None, digest=None):
+        self.fileobj = fileobj
+        self.sinks = sinks or []
+        self.throttle = throttle
+        self.digest = digest
+        self.sha1 = None if digest else hashlib.sha1()
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if self.throttle is not None:
+            self.throttle.wait(len(data))
+        if self.sha1 is not None:
+            self.sha1.update(data)
+        self.bytes_read += len(data)
+        for sink in self.sinks:
+            sink.write(data)
+        return data
+
+    def hexdigest(self):
+        return self.digest or self.sha1.hexdigest()
+
+
+class HashingWriter:
+    """
+    Wraps an output file, hashing every byte written.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha1 = hashlib.sha1()
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.bytes_written += len(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.sha1.hexdigest()
+
+
+def get_compression(compression, file_type):
+    """
+    Returns (codec, level) for a file type from the compression
+    config map, whose values are either a codec name or a
+    mapping with "codec" and (optionally) "level" keys.
+    """
+    setting = (compression or {}).get(file_type)
+    default = DEFAULT_CODECS.get(file_type, DEFAULT_CODEC)
+    level = None
+    if isinstance(setting, dict):
+        codec = setting.get("codec", default)
+        level = setting.get("level")
+    else:
+        codec = setting or default
+    if codec != "auto" and codec not in CODEC_EXTENSIONS:
+        raise ValueError(f"Invalid compression codec {codec} for {file_type}.")
+    return codec, level
+
+
+def get_compress_cmd(codec, threads, level=None):
+    """
+    Returns the command that compresses stdin to stdout
+    for codec, or None if no compression is required.
+    """
+    level_args = [f"-{level}"] if level is not None else []
+    if codec == "pigz":
+        return ["pigz", "-p", str(threads)] + level_args
+    if codec == "zstd":
+        if level is not None and int(level) > 19:
+            level_args = ["--ultra"] + level_args
+        return ["zstd", "-q", "-c", f"-T{threads}"] + level_args
+    return None
+
+
+def get_archive_codec(path):
+    """
+    Returns the codec of an archive from its extension.
+    """
+    for codec, ext in sorted(
+        CODEC_EXTENSIONS.items(), key=lambda item: len(item[1]), reverse=True
+    ):
+        if path.endswith(f".{ext}"):
+            return codec
+    raise ValueError(f"Unknown archive extension for {path}.")
+
+
+def get_decompress_cmd(codec):
+    """
+    Returns the command that decompresses an archive to
+    stdout for codec, or None if it is not compressed.
+    """
+    if codec == "pigz":
+        return ["pigz", "-d", "-c"]
+    if codec == "zstd":
+        return ["zstd", "-q", "-d", "-c"]
+    return None
+
+
+def estimate_compressibility(source_dir):
+    """
+    Returns the compressed to uncompressed size ratio of a sample
+    taken from the middle of the first few non-empty files under
+    source_dir, or None if there is nothing to sample.
+    """
+    raw_bytes = compressed_bytes = files_sampled = 0
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            try:
+                size = os.path.getsize(path)
+                if size == 0:
+                    continue
+                with open(path, "rb") as f:
+                    f.seek(max(0, size // 2 - AUTO_SAMPLE_BYTES // 2))
+                    data = f.read(AUTO_SAMPLE_BYTES)
+            except OSError:
+                continue
+            raw_bytes += len(data)
+            compressed_bytes += len(zlib.compress(data, 1))
+            files_sampled += 1
+            if files_sampled >= AUTO_SAMPLE_FILES:
+                return compressed_bytes / raw_bytes
+    return compressed_bytes / raw_bytes if raw_bytes else None
+
+
+def choose_auto_codec(source_dir):
+    """
+    Returns "pigz" if a sample of the files under source_dir
+    compresses well enough to be worth it, otherwise "none".
+    """
+    ratio = estimate_compressibility(source_dir)
+    if ratio is None or ratio > 1 - AUTO_MIN_SAVING:
+        return "none"
+    return "pigz"
+
+
+def format_checksum_line(digest, path):
+    """
+    Format a checksum line exactly as ``shasum -a 1`` does,
+    including its escaping of backslashes and newlines.
+    """
+    if "\\" in path or "\n" in path:
+        path = path.replace("\\", "\\\\").replace("\n", "\\n")
+        return f"\\{digest}  {path}\n"
+    return f"{digest}  {path}\n"
+
+
+def parse_checksum_line(line):
+    """
+    Inverse of format_checksum_line; returns (digest, path).
+    """
+    line = line.rstrip("\n")
+    escaped = line.startswith("\\")
+    if escaped:
+        line = line[1:]
+    digest, path = line.split("  ", 1)
+    if escaped:
+        path = path.replace("\\n", "\n").replace("\\\\", "\\")
+    return digest, path
+
+
+class TarListing:
+    """
+    Produces member lines identical to ``tar -tvf`` (GNU tar).
+    The size column grows as wider entries are seen, so one
+    instance must be used per archive listing.
+    """
+
+    def __init__(self):
+        self.ugswidth = TAR_UGSWIDTH
+
+    def format(self, tarinfo):
+        modes = stat.filemode(tarinfo.mode)[1:]
+        if tarinfo.islnk():
+            modes = "h" + modes
+        elif tarinfo.issym():
+            modes = "l" + modes
+        elif tarinfo.isdir():
+            modes = "d" + modes
+        else:
+            modes = "-" + modes
+
+        user = tarinfo.uname or str(tarinfo.uid)
+        group = tarinfo.gname or str(tarinfo.gid)
+        size = str(tarinfo.size if tarinfo.isreg() else 0)
+        pad = len(user) + 1 + len(group) + 1 + len(size)
+        self.ugswidth = max(self.ugswidth, pad)
+        size = size.rjust(self.ugswidth - pad + len(size))
+        stamp = time.strftime("%Y-%m-%d %H:%M", time.localtime(tarinfo.mtime))
+
+        name = tarinfo.name + "/" if tarinfo.isdir() else tarinfo.name
+        line = f"{modes} {user}/{group} {size} {stamp} {name}"
+        if tarinfo.islnk():
+            line += f" link to {tarinfo.linkname}"
+        elif tarinfo.issym():
+            line += f" -> {tarinfo.linkname}"
+        return line + "\n"
+
+
+def _walk_sorted(root, relpath, exclude=()):
+    """
+    Yield relpath and everything beneath it (depth first,
+    sorted by name) as paths relative to root, skipping the
+    paths in exclude and everything beneath them.
+    """
+    if relpath in exclude:
+        return
+    yield relpath
+    full_path = os.path.join(root, relpath)
+    if os.path.isdir(full_path) and not os.path.islink(full_path):
+        for entry in sorted(os.listdir(full_path)):
+            yield from _walk_sorted(root, os.path.join(relpath, entry), exclude)
+
+
+def iter_members(root, sources, pattern=None, exclude=None):
+    """
+    Yield paths relative to root to archive. With a pattern this
+    mirrors ``find <source> -iname <pattern>`` (matching files
+    only); without one it mirrors ``tar -c <source>``, which adds
+    directories and everything beneath them. Paths in exclude
+    (relative to root) are left out with everything beneath them.
+    """
+    exclude = set(exclude or [])
+    for source in sources:
+        if not os.path.lexists(os.path.join(root, source)):
+            raise FileNotFoundError(f"{os.path.join(root, source)} does not exist")
+        for relpath in _walk_sorted(root, source, exclude):
+            if pattern is None:
+                yield relpath
+                continue
+            full_path = os.path.join(root, relpath)
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                continue
+            if fnmatch.fnmatchcase(os.path.basename(relpath).lower(), pattern.lower()):
+                yield relpath
+
+
+def parse_size(size):
+    """
+    Returns a size given in bytes or with a binary unit
+    suffix (e.g. "500M", "2T") in bytes; 0 if unset.
+    """
+    if not size:
+        return 0
+    size = str(size).strip().upper().rstrip("B")
+    if size[-1:] in SIZE_UNITS:
+        return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(size)
+
+
+def plan_shards(root, sources, pattern, shard_size, exclude=None):
+    """
+    Splits the members to archive into consecutive shards whose
+    uncompressed tar size is at most shard_size bytes (a larger
+    file gets a shard of its own), returning a list of member
+    lists. The plan only depends on the files present, so the
+    same plan is made when the DAG is built and by each shard's job.
+    """
+    shards, shard, shard_bytes = [], [], 0
+    for relpath in iter_members(root, sources, pattern, exclude):
+        size = os.lstat(os.path.join(root, relpath)).st_size
+        member_bytes = TAR_BLOCK_SIZE + -(-size // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+        if shard and shard_bytes + member_bytes > shard_size:
+            shards.append(shard)
+            shard, shard_bytes = [], 0
+        shard.append(relpath)
+        shard_bytes += member_bytes
+    if shard or not shards:
+        shards.append(shard)
+    return shards
+
+
+class BlockCompressor:
+    """
+    Compresses everything written to it as a series of independent
+    gzip members of block_size uncompressed bytes, compressed in
+    parallel by threads workers and written to out in order. The
+    result is a valid gzip file, and each block's uncompressed
+    offset, compressed offset and compressed size are recorded in
+    blocks, so that any part of it can be decompressed on its own.
+    """
+
+    def __init__(self, out, block_size, level=None, threads=1):
+        self.out = out
+        self.block_size = block_size
+        # pigz levels above 9 (zopfli) have no zlib equivalent
+        self.level = 6 if level is None else min(int(level), 9)
+        self.threads = max(1, int(threads))
+        self.blocks = []
+        self._buffer = bytearray()
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._offset = 0
+        self._compressed_offset = 0
+
+    def _compress(self, block):
+        # wbits=31 writes a gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        return compressor.compress(block) + compressor.flush()
+
+    def _submit(self, block):
+        self._pending.append((len(block), self._executor.submit(self._compress, block)))
+        # bound the blocks held in memory
+        while len(self._pending) > self.threads * 2:
+            self._write_next()
+
+    def _write_next(self):
+        size, future = self._pending.popleft()
+        data = future.result()
+        self.blocks.append([self._offset, self._compressed_offset, len(data)])
+        self.out.write(data)
+        self._offset += size
+        self._compressed_offset += len(data)
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            self._submit(bytes(self._buffer[: self.block_size]))
+            del self._buffer[: self.block_size]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._write_next()
+        self._executor.shutdown()
+
+
+class ArchiveWriter:
+    """
+    Writes a tar archive (compressed via an external command
+    such as pigz or zstd if compress_cmd is given) in a single pass,
+    recording the source file checksums, the member listing
+    and the checksum of the archive itself. Source reads are
+    paced by throttle, if given. If block_size is set, the archive
+    is instead gzip-compressed in independent blocks (see
+    BlockCompressor) using level and threads. The offset and size
+    of each file member's data in the tar stream are kept in members,
+    and the number of members of each type (and the bytes of regular
+    files) in summary. Files with a checksum in checksum_cache (a
+    ChecksumCache) that are unchanged are archived without being
+    hashed again.
+    """
+
+    def __init__(
+        self,
+        root,
+        tar_path,
+        list_path,
+        compress_cmd=None,
+        throttle=None,
+        block_size=0,
+        level=None,
+        threads=1,
+        checksum_cache=None,
+    ):
+        self.root = root
+        self.throttle = throttle
+        self.checksum_cache = checksum_cache
+        self.tar_path = tar_path
+        self.listing = TarListing()
+        self.source_checksums = []
+        self.members = []
+        self.summary = {"files": 0, "dirs": 0, "links": 0, "other": 0, "bytes": 0}
+        self.bytes_read = 0
+        self.file_count = 0
+
+        self._out = open(tar_path, "wb")
+        self._list = open(list_path, "w")
+        self.writer = HashingWriter(self._out)
+        self.archive_digest = None
+        self._proc = None
+        self._pump = None
+        self._pump_error = None
+        self.blocks = None
+        stream = self.writer
+        if block_size:
+            self.blocks = BlockCompressor(self.writer, block_size, level, threads)
+            stream = self.blocks
+        elif compress_cmd:
+            self._proc = subprocess.Popen(
+                compress_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+            )
+            self._pump = threading.Thread(target=self._pump_output, daemon=True)
+            self._pump.start()
+            stream = self._proc.stdin
+
+        self.tar = tarfile.open(
+            fileobj=stream, mode="w|", format=tarfile.GNU_FORMAT, bufsize=CHUNK_SIZE
+        )
+        self.tar.copybufsize = CHUNK_SIZE
+
+    def _pump_output(self):
+        try:
+            while True:
+                data = self._proc.stdout.read(CHUNK_SIZE)
+                if not data:
+                    break
+                self.writer.write(data)
+        except OSError as error:
+            self._pump_error = error
+
+    def add(self, relpath, copy_to=None):
+        """
+        Add relpath (relative to root) to the archive, optionally
+        copying its contents to copy_to in the same read.
+        Returns the sha1 digest for regular files, otherwise None.
+        """
+        full_path = os.path.join(self.root, relpath)
+        tarinfo = self.tar.gettarinfo(full_path, arcname=relpath)
+        if tarinfo is None:
+            # sockets and other unsupported types are skipped by tar too
+            return None
+
+        digest = None
+        if tarinfo.isreg():
+            if self.checksum_cache is not None:
+                digest = self.checksum_cache.lookup(relpath)
+            with open(full_path, "rb") as src:
+                sinks = []
+                if copy_to:
+                    sinks.append(open(copy_to, "wb"))
+                try:
+                    reader = HashingReader(src, sinks, self.throttle, digest)
+                    self.tar.addfile(tarinfo, reader)
+                finally:
+                    for sink in sinks:
+                        sink.close()
+            if copy_to:
+                shutil.copystat(full_path, copy_to)
+            digest = reader.hexdigest()
+            self.source_checksums.append((digest, relpath))
+            self.bytes_read += reader.bytes_read
+            # the data ends the member, padded to a whole number of blocks
+            padded_size = -(-tarinfo.size // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+            data_offset = self.tar.offset - padded_size
+            self.members.append([tarinfo.name, data_offset, tarinfo.size])
+            self.summary["files"] += 1
+            self.summary["bytes"] += tarinfo.size
+        else:
+            self.tar.addfile(tarinfo)
+            if tarinfo.isdir():
+                self.summary["dirs"] += 1
+            elif tarinfo.issym() or tarinfo.islnk():
+                self.summary["links"] += 1
+            else:
+                self.summary["other"] += 1
+
+        if not tarinfo.isdir():
+            self.file_count += 1
+        self._list.write(self.listing.format(tarinfo))
+        return digest
+
+    def close(self):
+        """
+        Finish the archive and return the sha1 of the written file.
+        """
+        if self.archive_digest is not None:
+            return self.archive_digest
+        self.tar.close()
+        if self.blocks is not None:
+            self.blocks.close()
+        if self._proc is not None:
+            self._proc.stdin.close()
+            self._pump.join()
+            return_code = self._proc.wait()
+            if return_code != 0:
+                raise subprocess.CalledProcessError(return_code, self._proc.args)
+            if self._pump_error is not None:
+                raise self._pump_error
+        self._out.close()
+        self._list.close()
+        self.archive_digest = self.writer.hexdigest()
+        return self.archive_digest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            with contextlib.suppress(Exception):
+                self.tar.close()
+            if self.blocks is not None:
+                self.blocks.close()
+            if self._proc is not None:
+                self._proc.kill()
+                self._proc.wait()
+            self._out.close()
+            self._list.close()
@@ -0,0 +1,95 @@
+"""
+Writes the source checksum file for a run. Checksums for
+files already hashed while archiving are taken from the
+parts written by tar_archive.py; any remaining files in the
+run directory are hashed here, unless they are unchanged since
+their checksums were cached. The run's checksum cache is then
+updated for the next time the run is processed.
+"""
+import sys
+import os
+import hashlib
+
+from archiver import CHUNK_SIZE, format_checksum_line, parse_checksum_line
+from checksum_cache import ChecksumCache, get_cache_path
+from io_throttle import make_throttle
+from job_metrics import JobMetrics, ProgressLogger
+
+sys.stderr = open(snakemake.log[0], "w")
+
+wildcards = snakemake.wildcards
+project_dir = os.path.join(snakemake.params.data_dir, wildcards.project)
+run_path = os.path.join(wildcards.sample, wildcards.run)
+throttle = make_throttle(snakemake.params.io_throttle, project_dir)
+checksum_cache = ChecksumCache(
+    get_cache_path(
+        snakemake.params.checksum_cache_dir,
+        wildcards.project,
+        wildcards.sample,
+        wildcards.run_uid,
+    ),
+    project_dir,
+)
+
+with JobMetrics(
+    "checksums", wildcards.items(), snakemake.params.metrics_dir
+) as metrics:
+    checksums = {}
+    for part in snakemake.input.parts:
+        part_mtime_ns = os.stat(part).st_mtime_ns
+        with open(part, "r") as f:
+            for line in f:
+                digest, path = parse_checksum_line(line)
+                checksums[path] = digest
+                # files modified since they were archived are not cached
+                st = checksum_cache.stat(path)
+                if st is not None and st.st_mtime_ns < part_mtime_ns:
+                    checksum_cache.add(path, digest, st)
+
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    progress = ProgressLogger(os.path.basename(snakemake.output[0]))
+    # equivalent of `find {sample}/{run}/* -type f`
+    for dirpath, dirnames, filenames in os.walk(os.path.join(project_dir, run_path)):
+        rel_dir = os.path.relpath(dirpath, project_dir)
+        if rel_dir == run_path:
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            filenames = [f for f in filenames if not f.startswith(".")]
+        for filename in filenames:
+            path = os.path.join(rel_dir, filename)
+            full_path = os.path.join(project_dir, path)
+            if path in checksums or os.path.islink(full_path):
+                continue
+            st = os.stat(full_path)
+            checksums[path] = checksum_cache.lookup(path, st)
+            if checksums[path] is not None:
+                continue
+            sha1 = hashlib.sha1()
+            file_bytes = 0
+            with open(full_path, "rb") as src:
+                while True:
+                    nbytes = src.readinto(buf)
+                    if not nbytes:
+                        break
+                    if throttle is not None:
+                        throttle.wait(nbytes)
+                    sha1.update(view[:nbytes])
+                    file_bytes += nbytes
+            checksums[path] = sha1.hexdigest()
+            checksum_cache.add(path, checksums[path], st)
+            progress.update(nbytes=file_bytes)
+    progress.finish()
+    if throttle is not None:
+        throttle.log()
+    if checksum_cache.hits:
+        print(f"Reused {checksum_cache.hits} cached checksums", file=sys.stderr)
+
+    with open(snakemake.output[0], "w") as f:
+        for path in sorted(checksums):
+            f.write(format_checksum_line(checksums[path], path))
+    checksum_cache.save()
+
+    # files hashed while archiving are counted by the archive jobs
+    metrics.files = progress.files
+    metrics.bytes_read = progress.bytes
+    metrics.bytes_written = os.path.getsize(snakemake.output[0])
@@ -0,0 +1,224 @@
+"""
+Pre-flight capacity planning of pending runs.
+
+Before any job is started, the files of each pending run are
+counted and summed by file type (only small compression samples
+are read), and the size of the run's archives is estimated from
+each file type's codec. Runs are then ordered, e.g. smallest
+first so that the most runs finish soonest, and admitted while
+their estimated outputs leave free_space_reserve bytes free on
+the volume they are written to. Runs that do not fit are left
+for a later invocation of the workflow.
+"""
+import os
+import re
+import shutil
+import stat
+
+from archiver import (
+    AUTO_MIN_SAVING,
+    TAR_BLOCK_SIZE,
+    estimate_compressibility,
+    get_compression,
+)
+from job_metrics import format_duration
+
+ORDERS = ["smallest", "oldest", "discovery"]
+
+# data directories of a run, e.g. pod5, fastq_pass or bam_fail
+DATA_DIR_REGEX = re.compile(r"^(fastq|fast5|pod5|bam)(_(pass|fail|skip))?$")
+
+# member list and checksum lines written for each archived file
+METADATA_BYTES_PER_FILE = 512
+
+MIB, GIB = 2**20, 2**30
+
+
+def get_file_type(relpath):
+    """
+    Returns the file type a file (relative to its run directory)
+    is archived as, or None if it is not archived
+    """
+    top, sep, _ = relpath.partition(os.sep)
+    match = DATA_DIR_REGEX.match(top)
+    if match and sep:
+        return match.group(1)
+    if not sep or top == "other_reports":
+        return "reports"
+    return None
+
+
+def scan_run(run_dir):
+    """
+    Returns {file type: [files, bytes]} of the regular files under
+    run_dir (files that are not archived count as "other"), and
+    the data directories of each file type
+    """
+    totals, data_dirs = {}, {}
+    for dirpath, dirnames, filenames in os.walk(run_dir):
+        dirnames.sort()
+        if dirpath == run_dir:
+            for dirname in dirnames:
+                match = DATA_DIR_REGEX.match(dirname)
+                if match:
+                    data_dirs.setdefault(match.group(1), []).append(
+                        os.path.join(run_dir, dirname)
+                    )
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            file_type = get_file_type(os.path.relpath(path, run_dir)) or "other"
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+            total = totals.setdefault(file_type, [0, 0])
+            total[0] += 1
+            total[1] += st.st_size
+    return totals, data_dirs
+
+
+def estimate_archive_bytes(files, nbytes, codec, source_dirs=()):
+    """
+    Returns the estimated size of an archive of files totalling
+    nbytes with codec, compressed as well as a sample of the
+    files under source_dirs (the auto codec stores the archive
+    uncompressed if that would save too little)
+    """
+    # a header per file, and on average half a block of padding
+    tar_bytes = nbytes + files * (TAR_BLOCK_SIZE + TAR_BLOCK_SIZE // 2)
+    if codec == "none":
+        return tar_bytes
+    ratio = None
+    for source_dir in source_dirs:
+        ratio = estimate_compressibility(source_dir)
+        if ratio is not None:
+            break
+    if ratio is None or (codec == "auto" and ratio > 1 - AUTO_MIN_SAVING):
+        return tar_bytes
+    return int(tar_bytes * ratio)
+
+
+def get_completion_time(run_dir, end_of_run_file_regex=None):
+    """
+    Returns the time a run finished: the modification time of its
+    end of run file (e.g. sequencing summary) if it has one,
+    otherwise that of the run directory
+    """
+    times = [
+        entry.stat().st_mtime
+        for entry in os.scandir(run_dir)
+        if entry.is_file()
+        and end_of_run_file_regex is not None
+        and end_of_run_file_regex.match(entry.name)
+    ]
+    return min(times) if times else os.stat(run_dir).st_mtime
+
+
+class RunPlan:
+    """
+    A pending run's files and bytes by file type, and the
+    estimated size of its outputs under out_dir. The caller's
+    key for the run is kept, to map plans back to runs.
+    """
+
+    def __init__(
+        self,
+        key,
+        name,
+        run_dir,
+        out_dir,
+        file_types,
+        compression,
+        end_of_run_file_regex=None,
+    ):
+        self.key = key
+        self.name = name
+        self.run_dir = run_dir
+        self.out_dir = out_dir
+        self.totals, data_dirs = scan_run(run_dir)
+        self.estimated_bytes = 0
+        for file_type, (files, nbytes) in self.totals.items():
+            if file_type not in file_types:
+                continue
+            codec, _ = get_compression(compression, file_type)
+            self.estimated_bytes += estimate_archive_bytes(
+                files, nbytes, codec, data_dirs.get(file_type, [])
+            )
+            self.estimated_bytes += files * METADATA_BYTES_PER_FILE
+        self.completed = get_completion_time(run_dir, end_of_run_file_regex)
+        self.status = "pending"
+
+    @property
+    def files(self):
+        return sum(files for files, _ in self.totals.values())
+
+    @property
+    def input_bytes(self):
+        return sum(nbytes for _, nbytes in self.totals.values())
+
+
+def order_runs(plans, order):
+    if order == "smallest":
+        return sorted(plans, key=lambda plan: plan.estimated_bytes)
+    if order == "oldest":
+        return sorted(plans, key=lambda plan: plan.completed)
+    return list(plans)
+
+
+def plan_capacity(plans, reserve=0, order="smallest", get_free=None):
+    """
+    Order plans and admit each while its estimated outputs leave
+    at least reserve bytes free on its output volume (given the
+    runs admitted before it). Returns (admitted, deferred).
+    """
+    get_free = get_free or (lambda path: shutil.disk_usage(path).free)
+    free, admitted, deferred = {}, [], []
+    for plan in order_runs(plans, order):
+        device = os.stat(plan.out_dir).st_dev
+        if device not in free:
+            free[device] = get_free(plan.out_dir)
+        if reserve and free[device] - plan.estimated_bytes < reserve:
+            plan.status = "deferred"
+            deferred.append(plan)
+            continue
+        free[device] -= plan.estimated_bytes
+        plan.status = "admitted"
+        admitted.append(plan)
+    return admitted, deferred
+
+
+def format_report(plans, reserve=0, order="smallest", throughput=0):
+    """
+    Returns a report of each run's files, bytes, estimated output
+    and (if throughput, in bytes per second, is given) the time
+    to read it, in processing order, followed by the totals of
+    the admitted runs
+    """
+
+    def duration(nbytes):
+        return format_duration(nbytes / throughput) if throughput else "-"
+
+    reserve_text = f"{reserve / GIB:.1f} GiB" if reserve else "none"
+    lines = [
+        f"Capacity plan (order: {order}, free space reserve: {reserve_text}):",
+        f"{'run':<60}{'files':>9}{'input GiB':>11}{'output GiB':>12}"
+        f"{'duration':>11}  status",
+    ]
+    for plan in order_runs(plans, order):
+        lines.append(
+            f"{plan.name:<60}{plan.files:>9}{plan.input_bytes / GIB:>11.2f}"
+            f"{plan.estimated_bytes / GIB:>12.2f}{duration(plan.input_bytes):>11}"
+            f"  {plan.status}"
+        )
+    admitted = [plan for plan in plans if plan.status != "deferred"]
+    input_bytes = sum(plan.input_bytes for plan in admitted)
+    output_bytes = sum(plan.estimated_bytes for plan in admitted)
+    rate = f" at {throughput / MIB:.0f} MiB/s" if throughput else ""
+    lines.append(
+        f"{len(admitted)} runs to process: {input_bytes / GIB:.2f} GiB in, "
+        f"{output_bytes / GIB:.2f} GiB out (estimated), taking "
+        f"{duration(input_bytes)}{rate}; {len(plans) - len(admitted)} deferred"
+    )
+    return "\n".join(lines)
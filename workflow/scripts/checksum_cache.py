@@ -0,0 +1,87 @@
+"""
+Cache of source file checksums, so that a run that is processed
+again (e.g. after its transfer directory or success marker was
+removed) only has new or changed files hashed.
+
+Each run has its own cache file, a JSON line per file of
+[path, size, mtime_ns, inode, sha1]. A cached checksum is only
+used while the file's size, modification time and inode are
+unchanged.
+"""
+import json
+import os
+import stat
+
+
+def get_cache_path(cache_dir, project, sample, run_uid):
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, f"{project}_{sample}_{run_uid}.jsonl")
+
+
+def get_file_key(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class ChecksumCache:
+    """
+    Checksums of the files under root, loaded from (and saved to)
+    path. A path of None gives an empty cache that is not saved.
+    Only the files looked up or added are kept when saved, so
+    entries of deleted files are dropped.
+    """
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = root
+        self.hits = 0
+        self._entries = {}
+        self._seen = {}
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                for line in f:
+                    relpath, *key, digest = json.loads(line)
+                    self._entries[relpath] = (key, digest)
+
+    def stat(self, relpath):
+        """
+        Returns the stat of a regular file, or None for other types
+        (or if it no longer exists)
+        """
+        try:
+            st = os.lstat(os.path.join(self.root, relpath))
+        except FileNotFoundError:
+            return None
+        return st if stat.S_ISREG(st.st_mode) else None
+
+    def lookup(self, relpath, st=None):
+        """
+        Returns the cached sha1 of relpath if it is unchanged, otherwise None
+        """
+        st = st or self.stat(relpath)
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return None
+        key = get_file_key(st)
+        cached = self._entries.get(relpath)
+        if cached is None or cached[0] != key:
+            return None
+        self._seen[relpath] = (key, cached[1])
+        self.hits += 1
+        return cached[1]
+
+    def add(self, relpath, digest, st=None):
+        st = st or self.stat(relpath)
+        if st is not None and stat.S_ISREG(st.st_mode):
+            self._seen[relpath] = (get_file_key(st), digest)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            for relpath in sorted(self._seen):
+                key, digest = self._seen[relpath]
+                line = json.dumps([relpath, *key, digest], separators=(",", ":"))
+                f.write(f"{line}\n")
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,219 @@
+"""
+Persistent index of directory listings used by run discovery.
+
+Each directory listing is stored together with the directory's
+mtime. On lookup the directory is stat'ed and the stored listing
+is reused if the mtime is unchanged, so only directories that
+have changed since the last run are listed again. Each directory
+is only checked once per process, and many directories can be
+checked concurrently (see prefetch), which hides the latency of
+metadata round-trips on network filesystems.
+
+The index can be rebuilt from the command line:
+
+    python workflow/scripts/discovery_index.py --index <index> --rebuild <data_dir>
+"""
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+# listings of directories modified this recently are not stored, as a
+# further change within the filesystem's mtime granularity would go unseen
+RACY_WINDOW_SECONDS = 2
+
+# directory levels below data_dir that discovery lists:
+# projects, samples, runs and transfer/logs directories
+REBUILD_DEPTH = 3
+
+# directories are checked concurrently in this many chunks per worker
+PREFETCH_CHUNKS_PER_WORKER = 4
+
+
+class DiscoveryIndex:
+    """
+    Directory listing cache backed by an SQLite database.
+    If path is empty, listings are cached in memory only.
+    """
+
+    def __init__(self, path=""):
+        self.path = path
+        self.listings = {}
+        self.dirty = {}
+        # directories already checked against the filesystem by this process
+        self.checked = set()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            conn = self._connect()
+            rows = conn.execute("SELECT path, mtime_ns, dirs, files FROM listings")
+            for dir_path, mtime_ns, dirs, files in rows:
+                self.listings[dir_path] = (
+                    mtime_ns,
+                    json.loads(dirs),
+                    json.loads(files),
+                )
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS listings ("
+            "path TEXT PRIMARY KEY, mtime_ns INTEGER, dirs TEXT, files TEXT)"
+        )
+        return conn
+
+    def scan(self, dir_path, persist=True):
+        """
+        Returns (dirs, files) in dir_path, as from next(os.walk(dir_path))[1:],
+        or None if dir_path is not a directory. Unless persist is set,
+        a new listing is only kept in memory, not written to the index.
+        """
+        if dir_path in self.checked:
+            cached = self.listings.get(dir_path)
+            return None if cached is None else (cached[1], cached[2])
+
+        try:
+            mtime_ns = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            self.checked.add(dir_path)
+            return None
+
+        cached = self.listings.get(dir_path)
+        if cached is not None and cached[0] == mtime_ns:
+            with self.lock:
+                self.hits += 1
+                self.checked.add(dir_path)
+            return cached[1], cached[2]
+
+        dirs, files = [], []
+        try:
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    (dirs if entry.is_dir() else files).append(entry.name)
+        except NotADirectoryError:
+            self.checked.add(dir_path)
+            return None
+
+        with self.lock:
+            self.misses += 1
+            self.listings[dir_path] = (mtime_ns, dirs, files)
+            if persist and time.time_ns() - mtime_ns > RACY_WINDOW_SECONDS * 1e9:
+                self.dirty[dir_path] = self.listings[dir_path]
+            self.checked.add(dir_path)
+        return dirs, files
+
+    def prefetch(self, dir_paths, workers=1, persist=True):
+        """
+        Checks (and if need be lists) dir_paths with up to workers
+        threads, returning their scans in order; later lookups
+        of these directories are then answered from memory.
+        """
+        dir_paths = list(dir_paths)
+        if workers <= 1 or len(dir_paths) <= 1:
+            return [self.scan(dir_path, persist) for dir_path in dir_paths]
+        # a few chunks per worker keeps the per-task overhead low
+        chunk_size = -(-len(dir_paths) // (workers * PREFETCH_CHUNKS_PER_WORKER))
+        chunks = [
+            dir_paths[i : i + chunk_size] for i in range(0, len(dir_paths), chunk_size)
+        ]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            scans = pool.map(
+                lambda chunk: [self.scan(d, persist) for d in chunk], chunks
+            )
+            return [scan for chunk_scans in scans for scan in chunk_scans]
+
+    def listdir(self, dir_path):
+        dirs, files = self.scan(dir_path) or ([], [])
+        return dirs + files
+
+    def subdirs(self, dir_path):
+        return (self.scan(dir_path) or ([], []))[0]
+
+    def files(self, dir_path):
+        return (self.scan(dir_path) or ([], []))[1]
+
+    def exists(self, path):
+        """
+        Checks whether path exists using its parent's listing.
+        """
+        parent, name = os.path.split(os.path.normpath(path))
+        return name in self.listdir(parent)
+
+    def save(self):
+        """
+        Write changed listings to the database.
+        """
+        if not self.path or not self.dirty:
+            return
+        with self._connect() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                [
+                    (dir_path, mtime_ns, json.dumps(dirs), json.dumps(files))
+                    for dir_path, (mtime_ns, dirs, files) in self.dirty.items()
+                ],
+            )
+        conn.close()
+        self.dirty = {}
+
+    def clear(self):
+        self.listings = {}
+        self.dirty = {}
+        self.checked = set()
+        if self.path:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM listings")
+            conn.close()
+
+    def rebuild(self, data_dir, depth=REBUILD_DEPTH, workers=1):
+        """
+        Clear the index and list every directory up to depth
+        levels below data_dir, each level with up to workers threads.
+        """
+        self.clear()
+        level = [data_dir]
+        for _ in range(depth + 1):
+            next_level = []
+            for dir_path, listing in zip(level, self.prefetch(level, workers)):
+                if listing is not None:
+                    next_level.extend(os.path.join(dir_path, d) for d in listing[0])
+            level = next_level
+        self.save()
+
+
+def main():
+    parser = ArgumentParser(description="Manage the run discovery index.")
+    parser.add_argument("--index", required=True, help="Path to index database.")
+    parser.add_argument(
+        "--rebuild", metavar="DATA_DIR", help="Clear and rebuild index for DATA_DIR."
+    )
+    parser.add_argument("--clear", action="store_true", help="Clear the index.")
+    parser.add_argument(
+        "--workers", type=int, default=16, help="Directories listed concurrently."
+    )
+    args = parser.parse_args()
+
+    index = DiscoveryIndex(args.index)
+    if args.clear:
+        index.clear()
+        print(f"Cleared {args.index}.", file=sys.stdout)
+    if args.rebuild:
+        start = time.perf_counter()
+        index.rebuild(args.rebuild, workers=args.workers)
+        print(
+            f"Indexed {len(index.listings)} directories under {args.rebuild} "
+            f"in {time.perf_counter() - start:.1f}s.",
+            file=sys.stdout,
+        )
+
+
+if __name__ == "__main__":
+    main()
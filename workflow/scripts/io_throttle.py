@@ -0,0 +1,204 @@
+"""
+Read throttling for jobs sharing a disk with live sequencing.
+
+Reads are paced to at most max_rate bytes per second. If a latency
+or queue depth limit is set, the device being read is sampled from
+/proc/diskstats and the rate is halved while either is exceeded,
+then raised again gradually once the device has recovered. Jobs can
+also be run at idle I/O priority, which the helper processes they
+start (e.g. pigz, zstd) inherit.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+from archiver import parse_size
+
+DISKSTATS = "/proc/diskstats"
+
+# seconds between device samples (and rate adjustments)
+SAMPLE_INTERVAL = 1.0
+# the rate is never backed off below this (bytes per second)
+MIN_RATE = 10 * 1024**2
+# growth of the rate per sample once the device has recovered
+RECOVERY_FACTOR = 1.25
+# reads may run this many seconds ahead of the rate
+BURST_SECONDS = 0.5
+
+# set once idle I/O priority has been set for this process
+_idle_priority = False
+
+
+def _log_stderr(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def get_device_stats_reader(path):
+    """
+    Returns a function reading the /proc/diskstats counters of the
+    device holding path, or None if the device is not listed
+    (e.g. network and overlay filesystems)
+    """
+    st_dev = os.stat(path).st_dev
+    device = (os.major(st_dev), os.minor(st_dev))
+
+    def read_stats():
+        with open(DISKSTATS) as f:
+            for line in f:
+                fields = line.split()
+                if (int(fields[0]), int(fields[1])) == device:
+                    return [int(field) for field in fields[3:14]]
+        return None
+
+    if not os.path.exists(DISKSTATS) or read_stats() is None:
+        return None
+    return read_stats
+
+
+def get_device_load(before, after, seconds):
+    """
+    Returns the average latency (ms) of the device's I/Os and its
+    average queue depth between two samples of its counters
+    """
+    ios = (after[0] - before[0]) + (after[4] - before[4])
+    io_ms = (after[3] - before[3]) + (after[7] - before[7])
+    latency_ms = io_ms / ios if ios > 0 else 0
+    queue_depth = (after[10] - before[10]) / (seconds * 1000) if seconds > 0 else 0
+    return latency_ms, queue_depth
+
+
+class IOThrottle:
+    """
+    Paces reads (reported via wait) to the current rate, adapting
+    it to the load of the device read from if read_stats is given.
+    A rate of 0 means reads are not paced.
+    """
+
+    def __init__(
+        self,
+        max_rate=0,
+        max_latency_ms=0,
+        max_queue_depth=0,
+        read_stats=None,
+        min_rate=MIN_RATE,
+        interval=SAMPLE_INTERVAL,
+    ):
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.max_latency_ms = max_latency_ms
+        self.max_queue_depth = max_queue_depth
+        self.read_stats = read_stats
+        self.min_rate = min(min_rate, max_rate) if max_rate else min_rate
+        self.interval = interval
+        self.bytes = 0
+        self.backoffs = 0
+        self.slept = 0.0
+        self._lock = threading.Lock()
+        self._start = self._sample_time = self._next = time.monotonic()
+        self._sample_bytes = 0
+        self._stats = read_stats() if read_stats else None
+
+    def _is_congested(self, seconds):
+        stats = self.read_stats()
+        congested = False
+        if stats is not None and self._stats is not None:
+            latency_ms, queue_depth = get_device_load(self._stats, stats, seconds)
+            congested = (self.max_latency_ms and latency_ms > self.max_latency_ms) or (
+                self.max_queue_depth and queue_depth > self.max_queue_depth
+            )
+        self._stats = stats
+        return congested
+
+    def _adapt(self, now):
+        seconds = now - self._sample_time
+        if seconds < self.interval:
+            return
+        measured = (self.bytes - self._sample_bytes) / seconds
+        if self.read_stats and self._is_congested(seconds):
+            current = min(self.rate, measured) if self.rate else measured
+            self.rate = max(self.min_rate, current / 2)
+            self.backoffs += 1
+        elif self.rate and self.rate != self.max_rate:
+            self.rate *= RECOVERY_FACTOR
+            if self.max_rate:
+                self.rate = min(self.rate, self.max_rate)
+            elif self.rate > 4 * measured:
+                # well above what is being read, so no longer limiting
+                self.rate = 0
+        self._sample_time, self._sample_bytes = now, self.bytes
+
+    def wait(self, nbytes):
+        """
+        Record nbytes read, sleeping if reads are ahead of the rate
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.bytes += nbytes
+            self._adapt(now)
+            delay = 0
+            if self.rate:
+                self._next = max(self._next, now - BURST_SECONDS) + nbytes / self.rate
+                delay = self._next - now
+            if delay > 0:
+                self.slept += delay
+        if delay > 0:
+            time.sleep(delay)
+
+    def summary(self):
+        seconds = time.monotonic() - self._start
+        rate = self.bytes / seconds if seconds > 0 else 0
+        ceiling = f"{self.max_rate / 1e6:.1f} MB/s" if self.max_rate else "none"
+        return (
+            f"Throttled reads: {self.bytes / 1e9:.2f} GB at {rate / 1e6:.1f} MB/s "
+            f"effective (ceiling {ceiling}), backed off {self.backoffs} times, "
+            f"paused for {self.slept:.1f}s"
+        )
+
+    def log(self):
+        _log_stderr(self.summary())
+
+
+def set_idle_priority(log=_log_stderr):
+    """
+    Move this process to the idle I/O scheduling class, which
+    threads and processes it starts afterwards inherit
+    """
+    global _idle_priority
+    if _idle_priority:
+        return True
+    if shutil.which("ionice") is None:
+        log("ionice not found; not setting idle I/O priority.")
+        return False
+    proc = subprocess.run(
+        ["ionice", "-c", "3", "-p", str(os.getpid())], capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        log(f"Could not set idle I/O priority: {proc.stderr.strip()}")
+        return False
+    _idle_priority = True
+    return True
+
+
+def make_throttle(settings, path, log=_log_stderr):
+    """
+    Returns an IOThrottle for reads from path configured by settings
+    (the io_throttle config), or None if reads are not throttled.
+    Sets idle I/O priority if configured. Warnings are passed to log.
+    """
+    settings = settings or {}
+    if str(settings.get("idle_priority", False)).lower() == "true":
+        set_idle_priority(log)
+    max_rate = parse_size(settings.get("max_rate", 0))
+    max_latency_ms = float(settings.get("max_latency_ms", 0) or 0)
+    max_queue_depth = float(settings.get("max_queue_depth", 0) or 0)
+    if not (max_rate or max_latency_ms or max_queue_depth):
+        return None
+    read_stats = None
+    if max_latency_ms or max_queue_depth:
+        read_stats = get_device_stats_reader(path)
+        if read_stats is None:
+            log(f"No device statistics for {path}; only the maximum rate applies.")
+    return IOThrottle(max_rate, max_latency_ms, max_queue_depth, read_stats)
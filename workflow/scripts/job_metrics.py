@@ -0,0 +1,234 @@
+"""
+Per-job performance metrics and progress logging.
+
+Each job appends one JSON line (bytes read and written, file
+count, wall and CPU time and peak RSS) to jobs.jsonl under the
+metrics directory, and adds its totals to a Prometheus textfile
+collector file (nanopore_archive.prom) in the same directory.
+"""
+import datetime
+import fcntl
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+JOBS_FILE = "jobs.jsonl"
+PROM_FILE = "nanopore_archive.prom"
+# running totals behind the Prometheus file, updated under its lock
+PROM_STATE_FILE = "prom_state.json"
+PROM_PREFIX = "nanopore_archive"
+
+# (name, type, help) of each Prometheus metric, taken from the job
+# record field of the same name (summed, or the latest for gauges)
+PROM_METRICS = [
+    ("jobs", "counter", "Jobs finished."),
+    ("failed_jobs", "counter", "Jobs that failed."),
+    ("bytes_read", "counter", "Bytes read by jobs."),
+    ("bytes_written", "counter", "Bytes written by jobs."),
+    ("files", "counter", "Files processed by jobs."),
+    ("wall_seconds", "counter", "Wall time of jobs."),
+    ("cpu_seconds", "counter", "CPU time of jobs (including child processes)."),
+    ("peak_rss_bytes", "gauge", "Peak RSS of the last job."),
+    ("last_job_timestamp_seconds", "gauge", "End time of the last job."),
+]
+
+# seconds between progress lines
+PROGRESS_INTERVAL = 30
+
+# CPU time of the calling thread only, for jobs run in threads of a
+# long-running process (e.g. auto_archive.py's scheduler)
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+
+def get_cpu_seconds(who=resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def get_peak_rss_bytes():
+    # ru_maxrss is in kilobytes on Linux
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return max(usage.ru_maxrss, children.ru_maxrss) * 1024
+
+
+class JobMetrics:
+    """
+    Measures a job from creation until the with block exits,
+    then writes its record to metrics_dir (if set). Counters
+    are updated by the job as it goes. If per_thread is set,
+    CPU time is that of the calling thread plus any child
+    processes that finished in the meantime.
+    """
+
+    def __init__(self, stage, labels=None, metrics_dir="", per_thread=False):
+        self.stage = stage
+        self.labels = dict(labels or {})
+        self.metrics_dir = metrics_dir
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.files = 0
+        self._rusage = RUSAGE_THREAD if per_thread else resource.RUSAGE_SELF
+        self._start = time.perf_counter()
+        self._start_cpu = get_cpu_seconds(self._rusage)
+
+    def record(self, status="ok"):
+        wall_seconds = time.perf_counter() - self._start
+        return {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "stage": self.stage,
+            "labels": self.labels,
+            "status": status,
+            "wall_seconds": round(wall_seconds, 3),
+            "cpu_seconds": round(get_cpu_seconds(self._rusage) - self._start_cpu, 3),
+            "peak_rss_bytes": get_peak_rss_bytes(),
+            "bytes_read": self.bytes_read,
+            "bytes_written": self.bytes_written,
+            "files": self.files,
+            "read_mb_per_s": round(self.bytes_read / 1e6 / wall_seconds, 1)
+            if wall_seconds > 0
+            else 0,
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.metrics_dir:
+            status = "ok" if exc_type is None else "failed"
+            write_metrics(self.record(status), self.metrics_dir)
+
+
+def write_metrics(record, metrics_dir):
+    """
+    Append a job record to the JSON lines file and add
+    it to the Prometheus textfile
+    """
+    os.makedirs(metrics_dir, exist_ok=True)
+    line = (json.dumps(record, sort_keys=True) + "\n").encode()
+    # a single O_APPEND write, so lines of concurrent jobs do not interleave
+    fd = os.open(
+        os.path.join(metrics_dir, JOBS_FILE), os.O_WRONLY | os.O_APPEND | os.O_CREAT
+    )
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+    state_path = os.path.join(metrics_dir, PROM_STATE_FILE)
+    with open(os.path.join(metrics_dir, f".{PROM_FILE}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path) as f:
+                state = json.load(f)
+        totals = state.setdefault(record["stage"], {})
+        for name, _, _ in PROM_METRICS:
+            totals.setdefault(name, 0)
+        totals["jobs"] += 1
+        totals["failed_jobs"] += record["status"] != "ok"
+        for name in ["bytes_read", "bytes_written", "files"]:
+            totals[name] += record[name]
+        for name in ["wall_seconds", "cpu_seconds"]:
+            totals[name] = round(totals[name] + record[name], 3)
+        totals["peak_rss_bytes"] = record["peak_rss_bytes"]
+        totals["last_job_timestamp_seconds"] = int(time.time())
+        replace_file(state_path, json.dumps(state, indent=1))
+        replace_file(os.path.join(metrics_dir, PROM_FILE), format_prometheus(state))
+
+
+def replace_file(path, text):
+    """
+    Write text to path atomically (e.g. the textfile
+    collector may read the file at any time)
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def format_prometheus(state):
+    """
+    Format per-stage totals in the Prometheus text format
+    """
+    lines = []
+    for name, metric_type, help_text in PROM_METRICS:
+        metric = f"{PROM_PREFIX}_{name}"
+        if metric_type == "counter":
+            metric = f"{metric}_total"
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for stage in sorted(state):
+            lines.append(f'{metric}{{stage="{stage}"}} {state[stage][name]}')
+    return "\n".join(lines) + "\n"
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class ProgressLogger:
+    """
+    Logs a progress line (files and bytes done, throughput
+    and ETA) at most every interval seconds, in place of
+    logging every file. Lines are passed to write, or
+    printed to stderr if it is not given.
+    """
+
+    def __init__(
+        self, label, total_files=None, total_bytes=None, interval=None, write=None
+    ):
+        self.label = label
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = PROGRESS_INTERVAL if interval is None else interval
+        self.write = write or (lambda line: print(line, file=sys.stderr, flush=True))
+        self.files = 0
+        self.bytes = 0
+        self._start = self._last = time.monotonic()
+
+    def update(self, files=1, nbytes=0):
+        self.files += files
+        self.bytes += nbytes
+        now = time.monotonic()
+        if now - self._last >= self.interval:
+            self._last = now
+            self.log()
+
+    def log(self, done=False):
+        seconds = time.monotonic() - self._start
+        rate = self.bytes / seconds if seconds > 0 else 0
+        files = f"{self.files}" + (f"/{self.total_files}" if self.total_files else "")
+        line = f"{self.label}: {files} files, {self.bytes / 1e9:.2f}"
+        if self.total_bytes:
+            percent = self.bytes / self.total_bytes
+            line += f"/{self.total_bytes / 1e9:.2f} GB ({percent:.0%})"
+        else:
+            line += " GB"
+        line += f", {rate / 1e6:.1f} MB/s"
+        if done:
+            line += f", done in {format_duration(seconds)}"
+        elif self.total_bytes and rate > 0:
+            line += f", ETA {format_duration((self.total_bytes - self.bytes) / rate)}"
+        self.write(line)
+
+    def finish(self):
+        self.log(done=True)
+
+
+def get_tree_size(path):
+    """
+    Returns the number of files under path and their total size
+    """
+    files, size = 0, 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            files += 1
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return files, size
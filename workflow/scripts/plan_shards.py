@@ -0,0 +1,26 @@
+"""
+Plans the shards of a sharded archive, writing the members of
+each shard (see archiver.plan_shards). This is a checkpoint:
+the number of shard jobs is only known once it has run, and
+each shard job archives the members planned for it here.
+"""
+import sys
+import os
+import json
+
+from archiver import plan_shards
+
+sys.stderr = open(snakemake.log[0], "w")
+
+params = snakemake.params
+shards = plan_shards(
+    os.path.join(params.data_dir, snakemake.wildcards.project),
+    [params.source],
+    params.pattern,
+    params.shard_size,
+    params.exclude,
+)
+print(f"Planned {len(shards)} shards of {params.source}", file=sys.stderr)
+
+with open(snakemake.output[0], "w") as f:
+    json.dump({"shard_size": params.shard_size, "shards": shards}, f, indent=1)
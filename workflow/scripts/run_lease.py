@@ -0,0 +1,224 @@
+"""
+Lease-based claiming of runs, so that several hosts (or
+processes) running the workflow on the same data_dir archive
+disjoint runs.
+
+A lease is a file {name}.{generation}.lease in a directory on
+storage shared by every host, holding its owner. Each generation
+is created by linking a complete file into place, so only one
+process can create it and it is never seen empty. Held leases
+are renewed (touched) every heartbeat seconds by a background
+thread. A lease not renewed for duration seconds has expired
+(e.g. its holder crashed) and is taken over by creating the next
+generation; a holder that finds a newer generation, or another
+owner in its file, has lost its lease. Released leases are
+emptied rather than removed, so that generations are never
+reused. duration should be well above any clock skew between
+hosts.
+
+The owner holding a run's leases is passed to the jobs it starts
+in LEASE_OWNER_ENV. Before marking a run complete (or transferred),
+a job checks with check_lease_held that its owner still holds the
+run's lease, and fails if it was lost, so that only the host that
+took the run over marks it. Work already done by the jobs is not
+undone, so duration should also be well above any delay to the
+heartbeat (e.g. a stalled shared filesystem).
+"""
+import contextlib
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+LEASE_OWNER_ENV = "NANOPORE_ARCHIVE_LEASE_OWNER"
+
+
+class LeaseLostError(Exception):
+    pass
+
+
+def _log_stderr(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def get_lease_name(project, sample, run):
+    return f"{project}__{sample}__{run}"
+
+
+class LeaseManager:
+    """
+    Leases held by this process in lease_dir. Claims of a name
+    by this process are counted, and its lease is kept until
+    each claim is released. Take overs and lost leases are
+    reported with log.
+    """
+
+    def __init__(
+        self, lease_dir, duration=300, heartbeat=60, log=_log_stderr, owner=None
+    ):
+        self.lease_dir = lease_dir
+        self.duration = float(duration)
+        self.heartbeat = float(heartbeat)
+        self.log = log
+        self.owner = (
+            owner or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        )
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+        os.makedirs(lease_dir, exist_ok=True)
+
+    def _path(self, name, generation):
+        return os.path.join(self.lease_dir, f"{name}.{generation}.lease")
+
+    def _generations(self, name):
+        generations = []
+        for filename in os.listdir(self.lease_dir):
+            if not filename.endswith(".lease"):
+                continue
+            prefix, _, generation = filename[: -len(".lease")].rpartition(".")
+            if prefix == name and generation.isdigit():
+                generations.append(int(generation))
+        return sorted(generations)
+
+    def _read_owner(self, name, generation):
+        # an empty file is a released lease
+        try:
+            with open(self._path(name, generation), "r") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def _create(self, name, generation):
+        """
+        Creates a generation of name's lease owned by this process,
+        returning False if another process created it first
+        """
+        tmp_path = os.path.join(self.lease_dir, f".{name}.{self.owner}.tmp")
+        with open(tmp_path, "w") as f:
+            f.write(f"{self.owner}\n")
+        try:
+            os.link(tmp_path, self._path(name, generation))
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+        return True
+
+    def acquire(self, name):
+        """
+        Claims name, returning False if another process
+        holds an unexpired lease on it
+        """
+        with self.lock:
+            if name in self.held:
+                generation, count = self.held[name]
+                self.held[name] = (generation, count + 1)
+                return True
+            generations = self._generations(name)
+            generation = 0
+            if generations:
+                latest = self._path(name, generations[-1])
+                try:
+                    age = time.time() - os.stat(latest).st_mtime
+                except FileNotFoundError:
+                    # taken over as we looked; the next invocation claims it
+                    return False
+                if self._read_owner(name, generations[-1]):
+                    if age <= self.duration:
+                        return False
+                    self.log(
+                        f"Lease {os.path.basename(latest)} expired "
+                        f"{age - self.duration:.0f} seconds ago, taking over."
+                    )
+                generation = generations[-1] + 1
+            if not self._create(name, generation):
+                return False
+            for old in generations:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self._path(name, old))
+            self.held[name] = (generation, 1)
+            self._start_heartbeat()
+            return True
+
+    def release(self, name):
+        with self.lock:
+            if name not in self.held:
+                return
+            generation, count = self.held.pop(name)
+            if count > 1:
+                self.held[name] = (generation, count - 1)
+                return
+            if self._is_owner(name, generation):
+                # keep the file, so its generation is not reused
+                with contextlib.suppress(FileNotFoundError):
+                    os.truncate(self._path(name, generation), 0)
+
+    def _is_owner(self, name, generation):
+        return self._read_owner(name, generation) == self.owner and not os.path.exists(
+            self._path(name, generation + 1)
+        )
+
+    def is_held(self, name):
+        """
+        Whether this process still holds the lease on name
+        """
+        with self.lock:
+            if name not in self.held:
+                return False
+            generation, _ = self.held[name]
+            return self._is_owner(name, generation)
+
+    def renew(self):
+        for name in list(self.held):
+            if not self.is_held(name):
+                self.log(f"Lost the lease on {name} to another process.")
+                with self.lock:
+                    self.held.pop(name, None)
+                continue
+            with self.lock, contextlib.suppress(FileNotFoundError, KeyError):
+                os.utime(self._path(name, self.held[name][0]))
+
+    def _start_heartbeat(self):
+        # must be called with self.lock held
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._heartbeat, name="lease-heartbeat", daemon=True
+            )
+            self.thread.start()
+
+    def _heartbeat(self):
+        while not self.stop_event.wait(self.heartbeat):
+            self.renew()
+
+    def close(self):
+        """
+        Stops renewing and releases all leases held
+        """
+        self.stop_event.set()
+        with self.lock:
+            names = list(self.held)
+            for name in names:
+                self.held[name] = (self.held[name][0], 1)
+        for name in names:
+            self.release(name)
+
+
+def check_lease_held(lease_dir, name):
+    """
+    Raises LeaseLostError if the owner that started this job (from
+    LEASE_OWNER_ENV) no longer holds the lease on name. Does nothing
+    if leases are not used, or the owner was not passed to the job
+    """
+    owner = os.environ.get(LEASE_OWNER_ENV)
+    if not lease_dir or not owner:
+        return
+    leases = LeaseManager(lease_dir, owner=owner)
+    generations = leases._generations(name)
+    if not generations or not leases._is_owner(name, generations[-1]):
+        raise LeaseLostError(
+            f"The lease on {name} held by {owner} was lost to another process."
+        )
@@ -0,0 +1,163 @@
+"""
+Member index of seekable archives, for extracting single files.
+
+A seekable archive is a tar archive that is either uncompressed or
+gzip-compressed as a series of independent blocks (see
+archiver.BlockCompressor), so it remains a valid .tar.gz. Its index
+(a gzipped JSON file next to the member list) records the offset and
+size of every file's data in the tar stream, and the uncompressed
+and compressed offsets of every block. A file is then extracted by
+decompressing only the blocks holding it:
+
+    python workflow/scripts/seekable_archive.py extract <archive> <member> [-o <file>]
+    python workflow/scripts/seekable_archive.py list <archive>
+"""
+import bisect
+import gzip
+import json
+import os
+import shutil
+import sys
+import zlib
+from argparse import ArgumentParser
+
+from archiver import CHUNK_SIZE, CODEC_EXTENSIONS, get_archive_codec
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = "_index.json.gz"
+
+# codecs that seekable archives can be written with
+SEEKABLE_CODECS = ["none", "pigz"]
+
+
+def get_index_path(archive):
+    """
+    Returns the index path of an archive, e.g. run_pod5_index.json.gz
+    for run_pod5.tar.gz (as its member list is run_pod5_list.txt)
+    """
+    ext = CODEC_EXTENSIONS[get_archive_codec(archive)]
+    return f"{archive[:-len(ext) - 1]}{INDEX_SUFFIX}"
+
+
+def write_index(index_path, codec, members, blocks=None, block_size=0):
+    """
+    Write the index of an archive: members as [name, offset, size]
+    of each file's data in the tar stream and, for compressed
+    archives, blocks as [offset, compressed offset, compressed size]
+    """
+    index = {
+        "version": INDEX_VERSION,
+        "codec": codec,
+        "block_size": block_size,
+        "blocks": blocks or [],
+        "members": members,
+    }
+    with gzip.open(index_path, "wt") as f:
+        json.dump(index, f, separators=(",", ":"))
+
+
+def read_index(index_path):
+    with gzip.open(index_path, "rt") as f:
+        index = json.load(f)
+    if index.get("version") != INDEX_VERSION:
+        raise ValueError(f"Unsupported index version in {index_path}.")
+    return index
+
+
+def find_member(index, name):
+    """
+    Returns (offset, size) of a member's data, or raises KeyError
+    """
+    name = name.rstrip("/")
+    for member, offset, size in index["members"]:
+        if member == name:
+            return offset, size
+    raise KeyError(f"{name} is not in the archive.")
+
+
+def iter_member_data(archive, index, offset, size):
+    """
+    Yields the size bytes at offset of the archive's tar stream,
+    decompressing only the blocks that hold them
+    """
+    with open(archive, "rb") as f:
+        if not index["blocks"]:
+            f.seek(offset)
+            remaining = size
+            while remaining > 0:
+                data = f.read(min(CHUNK_SIZE, remaining))
+                if not data:
+                    raise ValueError(f"{archive} is truncated.")
+                remaining -= len(data)
+                yield data
+            return
+
+        blocks = index["blocks"]
+        i = bisect.bisect_right([block[0] for block in blocks], offset) - 1
+        skip, remaining = offset - blocks[i][0], size
+        while remaining > 0:
+            if i >= len(blocks):
+                raise ValueError(f"{archive} is truncated.")
+            _, compressed_offset, compressed_size = blocks[i]
+            f.seek(compressed_offset)
+            data = zlib.decompress(f.read(compressed_size), 31)
+            data = data[skip : skip + remaining]
+            skip, remaining, i = 0, remaining - len(data), i + 1
+            yield data
+
+
+def extract_member(archive, name, out, index_path=None):
+    """
+    Write the contents of member name of archive to out (a binary
+    file object), using the archive's index. Returns the member's size.
+    """
+    index = read_index(index_path or get_index_path(archive))
+    offset, size = find_member(index, name)
+    for data in iter_member_data(archive, index, offset, size):
+        out.write(data)
+    return size
+
+
+def parse_args(args):
+    parser = ArgumentParser(description="Use the member index of seekable archives.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    extract = subparsers.add_parser("extract", help="Extract a single member.")
+    extract.add_argument("archive", help="Archive to extract from.")
+    extract.add_argument("member", help="Member to extract (as listed).")
+    extract.add_argument(
+        "-o",
+        "--output",
+        help="File to write to (default: the member's name in the current "
+        "directory; '-' for stdout).",
+    )
+    extract.add_argument("--index", help="Index file (default: next to the archive).")
+    list_parser = subparsers.add_parser("list", help="List the indexed members.")
+    list_parser.add_argument("archive", help="Archive to list.")
+    list_parser.add_argument(
+        "--index", help="Index file (default: next to the archive)."
+    )
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args(sys.argv[1:])
+    index_path = args.index or get_index_path(args.archive)
+    if args.command == "list":
+        for name, _, size in read_index(index_path)["members"]:
+            print(f"{size}\t{name}")
+        return 0
+
+    output = args.output or os.path.basename(args.member)
+    if output == "-":
+        extract_member(args.archive, args.member, sys.stdout.buffer, index_path)
+        return 0
+    tmp_output = f"{output}.tmp"
+    with open(tmp_output, "wb") as out:
+        size = extract_member(args.archive, args.member, out, index_path)
+    shutil.move(tmp_output, output)
+    print(f"Extracted {args.member} ({size} bytes) to {output}", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
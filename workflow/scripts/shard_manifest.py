@@ -0,0 +1,43 @@
+"""
+Writes the manifest of a sharded archive, mapping each
+source file to the shard holding it and recording each
+shard's checksum, size and number of files.
+"""
+import sys
+import os
+import json
+
+from archiver import parse_checksum_line
+
+sys.stderr = open(snakemake.log[0], "w")
+
+shards = []
+files = {}
+for archive, checksums, archive_checksum in zip(
+    snakemake.input.archives,
+    snakemake.input.checksums,
+    snakemake.input.archive_checksums,
+):
+    name = os.path.basename(archive)
+    with open(archive_checksum, "r") as f:
+        digest, _ = parse_checksum_line(f.readline())
+    with open(checksums, "r") as f:
+        members = [parse_checksum_line(line)[1] for line in f]
+    for member in members:
+        files[member] = name
+    shards.append(
+        {
+            "name": name,
+            "sha1": digest,
+            "size": os.path.getsize(archive),
+            "files": len(members),
+        }
+    )
+    print(f"{name}: {len(members)} files", file=sys.stderr)
+
+with open(snakemake.output[0], "w") as f:
+    json.dump(
+        {"shard_size": snakemake.params.shard_size, "shards": shards, "files": files},
+        f,
+        indent=1,
+    )
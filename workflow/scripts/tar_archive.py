@@ -0,0 +1,156 @@
+"""
+Archives one file type of a run in a single read pass,
+writing the archive, its member list and the source and
+archive checksum parts consumed by the checksum rules, and
+a summary of its members (counts by type and bytes) that
+archive_complete compares with the run's source files.
+If params.shard is set, only the members planned for that
+shard by the plan_shards checkpoint are archived. Paths in
+params.exclude (barcode directories archived by their own
+jobs) are left out. If a member index is requested, the
+archive is written in seekable form (see seekable_archive.py).
+The auto codec is resolved here, by sampling the source files:
+its archives are always gzip files, compressed if the sample
+compresses well and otherwise stored (level 0), so that their
+names do not depend on the files.
+Files unchanged since their checksums were cached are not
+hashed again. Progress is logged periodically rather than
+per file.
+"""
+import sys
+import os
+import fnmatch
+import json
+import stat
+
+from archiver import (
+    ArchiveWriter,
+    choose_auto_codec,
+    format_checksum_line,
+    get_compress_cmd,
+    iter_members,
+)
+from checksum_cache import ChecksumCache, get_cache_path
+from io_throttle import make_throttle
+from job_metrics import JobMetrics, ProgressLogger
+from seekable_archive import write_index
+
+sys.stderr = open(snakemake.log[0], "w")
+
+params = snakemake.params
+project_dir = os.path.join(params.data_dir, params.project)
+codec, level = params.codec, params.level
+if codec == "auto":
+    # every shard of a source samples the same files, so they agree
+    sample_dir = os.path.join(project_dir, params.sources[0])
+    if not os.path.isdir(sample_dir):
+        sample_dir = os.path.dirname(sample_dir)
+    if choose_auto_codec(sample_dir) == "pigz":
+        codec = "pigz"
+        print("Auto codec: the sampled files compress, compressing.", file=sys.stderr)
+    else:
+        codec, level = "pigz", 0
+        print(
+            "Auto codec: the sampled files do not compress, storing.", file=sys.stderr
+        )
+compress_cmd = get_compress_cmd(codec, snakemake.threads, level)
+throttle = make_throttle(params.io_throttle, project_dir)
+# the cache is only read here; calculate_checksums.py updates it
+checksum_cache = ChecksumCache(
+    get_cache_path(
+        params.checksum_cache_dir, params.project, params.sample, params.run_uid
+    ),
+    project_dir,
+)
+
+# seekable gzip archives are compressed in blocks by ArchiveWriter
+index_path = getattr(snakemake.output, "member_index", None)
+block_size = params.seekable_block_size if index_path and codec == "pigz" else 0
+if block_size:
+    compress_cmd = None
+
+# report files are copied to the transfer directory during the same read
+copy_dir = os.path.dirname(snakemake.output.tar)
+run_prefix = f"{params.project}_{params.sample}_{params.run_uid}"
+
+
+def get_copy_target(member):
+    if not params.copy_pattern:
+        return None
+    if os.path.dirname(member) != os.path.join(params.sample, params.run):
+        return None
+    if not fnmatch.fnmatchcase(os.path.basename(member), params.copy_pattern):
+        return None
+    return os.path.join(copy_dir, f"{run_prefix}_{os.path.basename(member)}")
+
+
+def get_total_bytes(members):
+    total = 0
+    for member in members:
+        st = os.lstat(os.path.join(project_dir, member))
+        if stat.S_ISREG(st.st_mode):
+            total += st.st_size
+    return total
+
+
+with JobMetrics("archive", snakemake.wildcards.items(), params.metrics_dir) as metrics:
+    if params.shard:
+        with open(snakemake.input.plan, "r") as f:
+            shards = json.load(f)["shards"]
+        if params.shard > len(shards):
+            raise ValueError(
+                f"Shard {params.shard} requested but only {len(shards)} planned."
+            )
+        members = shards[params.shard - 1]
+    else:
+        members = list(
+            iter_members(project_dir, params.sources, params.pattern, params.exclude)
+        )
+
+    progress = ProgressLogger(
+        os.path.basename(snakemake.output.tar), len(members), get_total_bytes(members)
+    )
+    with ArchiveWriter(
+        project_dir,
+        snakemake.output.tar,
+        snakemake.output.txt,
+        compress_cmd,
+        throttle,
+        block_size=block_size,
+        level=level,
+        threads=snakemake.threads,
+        checksum_cache=checksum_cache,
+    ) as writer:
+        for member in members:
+            bytes_read = writer.bytes_read
+            writer.add(member, copy_to=get_copy_target(member))
+            progress.update(nbytes=writer.bytes_read - bytes_read)
+    progress.finish()
+    if throttle is not None:
+        throttle.log()
+    if checksum_cache.hits:
+        print(f"Reused {checksum_cache.hits} cached checksums", file=sys.stderr)
+
+    with open(snakemake.output.checksums, "w") as f:
+        for digest, path in writer.source_checksums:
+            f.write(format_checksum_line(digest, path))
+
+    with open(snakemake.output.summary, "w") as f:
+        json.dump(
+            {"archive": os.path.basename(snakemake.output.tar), **writer.summary}, f
+        )
+        f.write("\n")
+
+    if index_path:
+        blocks = writer.blocks.blocks if writer.blocks is not None else None
+        write_index(index_path, codec, writer.members, blocks, block_size)
+
+    archive_path = os.path.join(
+        ".", os.path.relpath(snakemake.output.tar, params.transfer_dir_full)
+    )
+    with open(snakemake.output.archive_checksum, "w") as f:
+        f.write(format_checksum_line(writer.archive_digest, archive_path))
+
+    metrics.bytes_read = writer.bytes_read
+    metrics.bytes_written = writer.writer.bytes_written
+    metrics.files = writer.file_count
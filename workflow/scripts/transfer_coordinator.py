@@ -0,0 +1,465 @@
+"""
+Batched transfer of run directories with completion polling.
+
+Runs that are ready at the same time are grouped into batches, each
+submitted as a single transfer task, with at most max_in_flight
+tasks active at once (across processes sharing a slot directory). Tasks are polled until they finish, and a
+run is only reported complete (e.g., its success marker written)
+once its transfer, and deletion from the source if requested, has
+succeeded.
+
+The transfer service is reached through a client, so that the
+coordinator can be run against the Globus CLI, a Globus flow or a
+local fake:
+
+    submit_transfer(label, items) -> task id, for (source, destination) items
+    submit_delete(label, paths) -> task id
+    get_status(task_id) -> one of TASK_STATUSES
+    deletes_source -> whether transferring also deletes the source
+"""
+import fcntl
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+
+from job_metrics import JobMetrics, get_tree_size, write_metrics
+
+TASK_ACTIVE = "ACTIVE"
+# Globus pauses tasks (e.g. when credentials expire) as INACTIVE;
+# these may be resumed, so are waited on like active tasks
+TASK_INACTIVE = "INACTIVE"
+TASK_SUCCEEDED = "SUCCEEDED"
+TASK_FAILED = "FAILED"
+TASK_STATUSES = [TASK_ACTIVE, TASK_INACTIVE, TASK_SUCCEEDED, TASK_FAILED]
+
+# submissions refused by the service (e.g. over the per-user task
+# limit) are retried after a poll interval up to this many times
+SUBMIT_ATTEMPTS = 3
+
+
+class TransferError(Exception):
+    pass
+
+
+class GlobusCliClient:
+    """
+    Submits and polls transfer and delete tasks using the globus CLI.
+    """
+
+    deletes_source = False
+
+    def __init__(self, src_endpoint, dest_endpoint):
+        self.src_endpoint = src_endpoint
+        self.dest_endpoint = dest_endpoint
+
+    def _run(self, cmd, lines=None):
+        stdin = "".join(f"{line}\n" for line in lines) if lines else None
+        proc = subprocess.run(cmd, input=stdin, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise TransferError(f"{' '.join(cmd[:3])} failed: {proc.stderr.strip()}")
+        return proc.stdout.strip()
+
+    def submit_transfer(self, label, items):
+        return self._run(
+            [
+                "globus",
+                "transfer",
+                self.src_endpoint,
+                self.dest_endpoint,
+                "--batch",
+                "-",
+                "--label",
+                label,
+                "--sync-level",
+                "checksum",
+                "--verify-checksum",
+                "--fail-on-quota-errors",
+                "--notify",
+                "on",
+                "--format",
+                "unix",
+                "--jmespath",
+                "task_id",
+            ],
+            [
+                f"{shlex.quote(source)} {shlex.quote(destination)} --recursive"
+                for source, destination in items
+            ],
+        )
+
+    def submit_delete(self, label, paths):
+        return self._run(
+            [
+                "globus",
+                "delete",
+                self.src_endpoint,
+                "--batch",
+                "-",
+                "--recursive",
+                "--label",
+                label,
+                "--format",
+                "unix",
+                "--jmespath",
+                "task_id",
+            ],
+            [shlex.quote(path) for path in paths],
+        )
+
+    def get_status(self, task_id):
+        return self._run(
+            [
+                "globus",
+                "task",
+                "show",
+                task_id,
+                "--format",
+                "unix",
+                "--jmespath",
+                "status",
+            ]
+        )
+
+
+class GlobusFlowClient:
+    """
+    Moves runs with a Globus flow (e.g. "Move (copy and delete) files
+    using Globus") using the globus-automate CLI. Each transfer item is
+    started as its own flow run, as the flow takes a single source path;
+    the task id of a batch is its flow run ids joined by commas. The
+    flow deletes each source once it has been copied, so no delete
+    tasks are submitted.
+    """
+
+    deletes_source = True
+
+    def __init__(self, flow_id, src_endpoint, dest_endpoint):
+        self.flow_id = flow_id
+        self.src_endpoint = src_endpoint
+        self.dest_endpoint = dest_endpoint
+        # flow runs already started by source path, so that a batch
+        # that is resubmitted after a partial failure is not moved twice
+        self.started = {}
+
+    def _run(self, cmd):
+        proc = subprocess.run(cmd, capture_output=True, text=True)
+        if proc.returncode != 0:
+            raise TransferError(f"{' '.join(cmd[:3])} failed: {proc.stderr.strip()}")
+        try:
+            return json.loads(proc.stdout)
+        except ValueError:
+            raise TransferError(f"{' '.join(cmd[:3])} returned invalid output")
+
+    def get_flow_input(self, source, destination):
+        name = os.path.basename(source.rstrip("/"))
+        return {
+            "source": {"id": self.src_endpoint, "path": source},
+            "destination": {"id": self.dest_endpoint, "path": destination},
+            "transfer_label": f"Transfer archives for {name}",
+            "delete_label": f"Delete source archives for {name}",
+        }
+
+    def submit_transfer(self, label, items):
+        for source, destination in items:
+            if source in self.started:
+                continue
+            result = self._run(
+                [
+                    "globus-automate",
+                    "flow",
+                    "run",
+                    self.flow_id,
+                    "--flow-input",
+                    json.dumps(self.get_flow_input(source, destination)),
+                    "--label",
+                    label,
+                    "--format",
+                    "json",
+                ]
+            )
+            # older versions of the CLI call the run an action
+            self.started[source] = result.get("run_id") or result["action_id"]
+        return ",".join(self.started[source] for source, _ in items)
+
+    def submit_delete(self, label, paths):
+        raise TransferError("Runs moved by a Globus flow are deleted by the flow")
+
+    def get_status(self, task_id):
+        statuses = [
+            self._run(
+                [
+                    "globus-automate",
+                    "flow",
+                    "run-status",
+                    "--flow-id",
+                    self.flow_id,
+                    run_id,
+                    "--format",
+                    "json",
+                ]
+            )["status"]
+            for run_id in task_id.split(",")
+        ]
+        # the batch has finished once all of its flow runs have
+        for status in [TASK_ACTIVE, TASK_INACTIVE, TASK_FAILED]:
+            if status in statuses:
+                return status
+        return TASK_SUCCEEDED
+
+
+class LocalTransferClient:
+    """
+    Fake transfer service copying (or deleting) directories on the
+    local filesystem in background threads. Submissions beyond
+    max_active active tasks are refused, as a per-user task limit
+    would be, and sources matching fail_pattern fail to transfer.
+    """
+
+    deletes_source = False
+
+    def __init__(self, max_active=None, fail_pattern=None):
+        self.max_active = max_active
+        self.fail_pattern = fail_pattern
+        self.tasks = {}
+        self.max_seen_active = 0
+        self._lock = threading.Lock()
+
+    def _submit(self, label, func, args):
+        with self._lock:
+            active = [
+                task for task in self.tasks.values() if task["status"] == TASK_ACTIVE
+            ]
+            if self.max_active and len(active) >= self.max_active:
+                raise TransferError(f"Too many active tasks ({len(active)})")
+            task_id = f"local-{len(self.tasks) + 1}"
+            self.tasks[task_id] = {"label": label, "status": TASK_ACTIVE}
+            self.max_seen_active = max(self.max_seen_active, len(active) + 1)
+        threading.Thread(target=self._work, args=(task_id, func, args)).start()
+        return task_id
+
+    def _work(self, task_id, func, args):
+        try:
+            func(*args)
+            status = TASK_SUCCEEDED
+        except (OSError, TransferError) as error:
+            print(f"Task {task_id} failed: {error}", file=sys.stderr)
+            status = TASK_FAILED
+        with self._lock:
+            self.tasks[task_id]["status"] = status
+
+    def _copy(self, items):
+        for source, destination in items:
+            if self.fail_pattern and self.fail_pattern in source:
+                raise TransferError(f"Could not transfer {source}")
+            shutil.copytree(source, destination, symlinks=True, dirs_exist_ok=True)
+
+    def _delete(self, paths):
+        for path in paths:
+            shutil.rmtree(path)
+
+    def submit_transfer(self, label, items):
+        return self._submit(label, self._copy, (list(items),))
+
+    def submit_delete(self, label, paths):
+        return self._submit(label, self._delete, (list(paths),))
+
+    def get_status(self, task_id):
+        with self._lock:
+            return self.tasks[task_id]["status"]
+
+
+def make_client(name, src_endpoint, dest_endpoint, max_in_flight, flow_id=None):
+    if name == "globus":
+        return GlobusCliClient(src_endpoint, dest_endpoint)
+    if name == "globus_flow":
+        return GlobusFlowClient(flow_id, src_endpoint, dest_endpoint)
+    if name == "local":
+        return LocalTransferClient(max_active=max_in_flight)
+    raise ValueError(f"Invalid transfer client {name}")
+
+
+class TaskSlots:
+    """
+    Limits the tasks active at once across coordinators, e.g. the
+    transfer jobs of a workflow: each active task holds an exclusive
+    lock on one of n slot files in slot_dir, which is released once
+    the task has finished (or its process has exited).
+    """
+
+    def __init__(self, slot_dir, n):
+        os.makedirs(slot_dir, exist_ok=True)
+        self.paths = [os.path.join(slot_dir, f"slot{i}.lock") for i in range(n)]
+
+    def acquire(self):
+        """
+        Returns a free slot, now held, or None if all slots are held
+        """
+        for path in self.paths:
+            slot = open(path, "a")
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                slot.close()
+                continue
+            return slot
+        return None
+
+    def release(self, slot):
+        slot.close()
+
+
+class RunTransfer:
+    """
+    A run directory to transfer from source to destination.
+    """
+
+    def __init__(self, name, source, destination):
+        self.name = name
+        self.source = source
+        self.destination = destination
+
+
+class TransferCoordinator:
+    """
+    Transfers runs in batches of up to batch_size runs, with at most
+    max_in_flight tasks (transfers and deletions) active at once,
+    polling active tasks every poll_interval seconds. If slots (a
+    TaskSlots) are given, each task also holds a slot while active.
+    If delete is set, each batch's sources are deleted once it has
+    transferred (unless the client's transfers delete them already).
+    Batches are labelled with label and their number.
+    """
+
+    def __init__(
+        self,
+        client,
+        batch_size=20,
+        max_in_flight=2,
+        poll_interval=60,
+        timeout=0,
+        delete=False,
+        metrics_dir="",
+        slots=None,
+        label="Nanopore runs",
+        sleep=time.sleep,
+    ):
+        self.client = client
+        self.batch_size = max(1, int(batch_size))
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.delete = delete
+        self.metrics_dir = metrics_dir
+        self.slots = slots
+        self.label = label
+        self.sleep = sleep
+
+    def make_batches(self, runs):
+        return [
+            runs[i : i + self.batch_size] for i in range(0, len(runs), self.batch_size)
+        ]
+
+    def _submit(self, batch, phase):
+        if phase == "transfer":
+            items = [(run.source, run.destination) for run in batch["runs"]]
+            return self.client.submit_transfer(batch["label"], items)
+        paths = [run.source for run in batch["runs"]]
+        return self.client.submit_delete(f"Delete {batch['label']}", paths)
+
+    def _finish(self, batch, status):
+        batch["status"] = status
+        if self.metrics_dir:
+            write_metrics(batch["metrics"].record(status), self.metrics_dir)
+
+    def run(self, runs, on_success=None):
+        """
+        Transfer runs (a list of RunTransfer), calling on_success(run, batch)
+        for each run once confirmed. Returns the batches, each a dict with
+        the batch's label, runs, task ids and status ("ok", "failed" or
+        "incomplete" if the timeout was reached first).
+        """
+        batches = []
+        for i, batch_runs in enumerate(self.make_batches(runs), start=1):
+            label = f"{self.label} batch {i} ({len(batch_runs)} runs)"
+            metrics = JobMetrics("transfer", {"batch": label}, self.metrics_dir)
+            for run in batch_runs:
+                files, size = get_tree_size(run.source)
+                metrics.files += files
+                metrics.bytes_read += size
+            batches.append(
+                {
+                    "label": label,
+                    "runs": batch_runs,
+                    "tasks": {},
+                    "status": "incomplete",
+                    "metrics": metrics,
+                    "attempts": 0,
+                }
+            )
+
+        start = time.monotonic()
+        queue = deque((batch, "transfer") for batch in batches)
+        active = {}
+        while queue or active:
+            # submit while there is room for more tasks
+            while queue and len(active) < self.max_in_flight:
+                slot = self.slots.acquire() if self.slots else None
+                if self.slots and slot is None:
+                    break
+                batch, phase = queue.popleft()
+                try:
+                    task_id = self._submit(batch, phase)
+                except TransferError as error:
+                    if self.slots:
+                        self.slots.release(slot)
+                    batch["attempts"] += 1
+                    print(
+                        f"Could not submit {batch['label']}: {error}", file=sys.stderr
+                    )
+                    if batch["attempts"] >= SUBMIT_ATTEMPTS:
+                        self._finish(batch, "failed")
+                    else:
+                        queue.appendleft((batch, phase))
+                    break
+                batch["attempts"] = 0
+                batch["tasks"][phase] = task_id
+                active[task_id] = (batch, phase, slot)
+                print(
+                    f"Submitted {phase} task {task_id} for {batch['label']}",
+                    file=sys.stderr,
+                )
+
+            if self.timeout and time.monotonic() - start > self.timeout:
+                print("Timed out waiting for transfers to complete.", file=sys.stderr)
+                break
+            if queue or active:
+                self.sleep(self.poll_interval)
+
+            for task_id, (batch, phase, slot) in list(active.items()):
+                status = self.client.get_status(task_id)
+                if status in [TASK_ACTIVE, TASK_INACTIVE]:
+                    continue
+                del active[task_id]
+                if self.slots:
+                    self.slots.release(slot)
+                print(f"{phase} task {task_id} {status.lower()}", file=sys.stderr)
+                if status != TASK_SUCCEEDED:
+                    self._finish(batch, "failed")
+                elif (
+                    phase == "transfer"
+                    and self.delete
+                    and not self.client.deletes_source
+                ):
+                    queue.appendleft((batch, "delete"))
+                else:
+                    self._finish(batch, "ok")
+                    for run in batch["runs"]:
+                        if on_success is not None:
+                            on_success(run, batch)
+        return batches
@@ -0,0 +1,86 @@
+"""
+Transfers a batch of runs as a single transfer task (see
+transfer_coordinator.py), writing each run's success marker once
+its transfer (and deletion) has been confirmed, and the batch's
+summary once all of its runs have been. No transfer is started,
+and no marker written, once the workflow that started the job has
+lost the lease on one of the batch's runs (if leases are used).
+"""
+import json
+import os
+import sys
+
+from run_lease import check_lease_held, get_lease_name
+from transfer_coordinator import (
+    RunTransfer,
+    TaskSlots,
+    TransferCoordinator,
+    make_client,
+)
+
+sys.stderr = open(snakemake.log[0], "w")
+
+# do not transfer (and delete) data that failed verification
+for report in snakemake.input.verify:
+    with open(report, "r") as f:
+        if json.load(f)["status"] != "ok":
+            sys.exit(f"Archive verification failed, see {report}")
+
+params = snakemake.params
+delete = params.delete_on_transfer
+run_transfers, markers, lease_names = [], {}, {}
+# the markers are in the same order as the runs
+for run, marker in zip(params.runs, params.markers):
+    name = f"{run['project']}_{run['sample']}_{run['run_uid']}"
+    transfer_dir_name = f"{params.transfer_dir}_{run['sample']}_{run['run']}"
+    source = f"{params.data_dir}/{run['project']}/{transfer_dir_name}"
+    destination = f"{params.dest_path}/{run['project']}/{transfer_dir_name}"
+    run_transfers.append(RunTransfer(name, source, destination))
+    markers[name] = marker
+    lease_names[name] = get_lease_name(run["project"], run["sample"], run["run"])
+    check_lease_held(params.lease_dir, lease_names[name])
+
+
+def write_marker(run_transfer, batch):
+    check_lease_held(params.lease_dir, lease_names[run_transfer.name])
+    os.makedirs(os.path.dirname(markers[run_transfer.name]), exist_ok=True)
+    with open(markers[run_transfer.name], "w") as f:
+        json.dump({"label": batch["label"], "tasks": batch["tasks"]}, f)
+    print(f"Transferred {run_transfer.name}", file=sys.stderr)
+
+
+client = make_client(
+    params.client,
+    params.src_endpoint,
+    params.dest_endpoint,
+    params.max_in_flight,
+    flow_id=params.globus_flow_id,
+)
+coordinator = TransferCoordinator(
+    client,
+    batch_size=len(run_transfers),
+    max_in_flight=params.max_in_flight,
+    poll_interval=params.poll_interval,
+    timeout=params.timeout,
+    delete=delete,
+    metrics_dir=params.metrics_dir,
+    slots=TaskSlots(params.slot_dir, max(1, int(params.max_in_flight))),
+    label=f"Nanopore runs {snakemake.wildcards.batch_id}",
+)
+batches = coordinator.run(run_transfers, on_success=write_marker)
+
+summary = [
+    {
+        "label": batch["label"],
+        "tasks": batch["tasks"],
+        "status": batch["status"],
+        "runs": [run_transfer.name for run_transfer in batch["runs"]],
+    }
+    for batch in batches
+]
+print(json.dumps(summary, indent=2), file=sys.stderr)
+if any(batch["status"] != "ok" for batch in batches):
+    sys.exit("Not all runs were transferred, see log for details.")
+
+with open(snakemake.output[0], "w") as f:
+    json.dump(summary, f, indent=2)
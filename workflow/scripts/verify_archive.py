@@ -0,0 +1,88 @@
+"""
+Streams an archive once, hashing each file member as it is
+decompressed, and writes the member checksums together with
+the archive's verification throughput.
+"""
+import sys
+import os
+import json
+import hashlib
+import subprocess
+import tarfile
+import time
+
+from archiver import CHUNK_SIZE, get_archive_codec, get_decompress_cmd
+from io_throttle import make_throttle
+from job_metrics import JobMetrics, ProgressLogger
+
+sys.stderr = open(snakemake.log[0], "w")
+
+archive = snakemake.input.archive
+archive_bytes = os.path.getsize(archive)
+decompress_cmd = get_decompress_cmd(get_archive_codec(archive))
+# reading the archive is paced through the decompressed stream
+throttle = make_throttle(snakemake.params.io_throttle, archive)
+metrics = JobMetrics(
+    "verify", snakemake.wildcards.items(), snakemake.params.metrics_dir
+)
+
+start = time.perf_counter()
+checksums = {}
+member_bytes = 0
+progress = ProgressLogger(os.path.basename(archive))
+with metrics, open(archive, "rb") as src:
+    proc = None
+    stream = src
+    if decompress_cmd is not None:
+        proc = subprocess.Popen(
+            decompress_cmd, stdin=src, stdout=subprocess.PIPE, bufsize=CHUNK_SIZE
+        )
+        stream = proc.stdout
+    with tarfile.open(fileobj=stream, mode="r|", copybufsize=CHUNK_SIZE) as tar:
+        for tarinfo in tar:
+            if not tarinfo.isreg():
+                continue
+            sha1 = hashlib.sha1()
+            member = tar.extractfile(tarinfo)
+            while True:
+                data = member.read(CHUNK_SIZE)
+                if not data:
+                    break
+                if throttle is not None:
+                    throttle.wait(len(data))
+                sha1.update(data)
+            checksums[tarinfo.name] = sha1.hexdigest()
+            member_bytes += tarinfo.size
+            progress.update(nbytes=tarinfo.size)
+    if proc is not None:
+        # drain anything after the end-of-archive marker
+        while proc.stdout.read(CHUNK_SIZE):
+            pass
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    if throttle is not None:
+        throttle.log()
+    metrics.bytes_read = archive_bytes
+    metrics.files = len(checksums)
+seconds = time.perf_counter() - start
+mb_per_s = archive_bytes / 1e6 / seconds if seconds > 0 else 0
+print(
+    f"Verified {archive}: {len(checksums)} files, {member_bytes} bytes "
+    f"in {seconds:.2f}s ({mb_per_s:.1f} MB/s)",
+    file=sys.stderr,
+)
+
+with open(snakemake.output[0], "w") as f:
+    json.dump(
+        {
+            "archive": os.path.relpath(archive, snakemake.params.transfer_dir_full),
+            "files": len(checksums),
+            "member_bytes": member_bytes,
+            "archive_bytes": archive_bytes,
+            "seconds": round(seconds, 3),
+            "mb_per_s": round(mb_per_s, 1),
+            "checksums": checksums,
+        },
+        f,
+    )
@@ -0,0 +1,68 @@
+"""
+Compares the member checksums of every archive of a run with the
+run's source checksum manifest, writing a JSON report that lists
+any mismatches. Transfer (and deletion) only proceeds if the
+report's status is "ok".
+"""
+import sys
+import json
+
+from archiver import parse_checksum_line
+
+sys.stderr = open(snakemake.log[0], "w")
+
+expected = {}
+with open(snakemake.input.checksums, "r") as f:
+    for line in f:
+        digest, path = parse_checksum_line(line)
+        expected[path] = digest
+
+archives = []
+archived = {}
+mismatches = []
+not_in_manifest = []
+for part in snakemake.input.parts:
+    with open(part, "r") as f:
+        result = json.load(f)
+    for path, digest in result.pop("checksums").items():
+        archived[path] = result["archive"]
+        if path not in expected:
+            not_in_manifest.append({"path": path, "archive": result["archive"]})
+        elif digest != expected[path]:
+            mismatches.append(
+                {
+                    "path": path,
+                    "archive": result["archive"],
+                    "expected": expected[path],
+                    "actual": digest,
+                }
+            )
+    archives.append(result)
+    print(
+        f"{result['archive']}: {result['files']} files, " f"{result['mb_per_s']} MB/s",
+        file=sys.stderr,
+    )
+
+# files in the manifest that were not archived, e.g. file types
+# not selected for archiving; reported but do not fail verification
+not_archived = sorted(path for path in expected if path not in archived)
+
+status = "ok" if not mismatches and not not_in_manifest else "failed"
+print(
+    f"Verification {status}: {len(mismatches)} mismatches, "
+    f"{len(not_in_manifest)} files not in manifest",
+    file=sys.stderr,
+)
+
+with open(snakemake.output[0], "w") as f:
+    json.dump(
+        {
+            "status": status,
+            "mismatches": mismatches,
+            "not_in_manifest": not_in_manifest,
+            "not_archived": not_archived,
+            "archives": archives,
+        },
+        f,
+        indent=1,
+    )